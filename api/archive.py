@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import time
+import zlib
+
+import redis
+
+from abc import ABC, abstractmethod
+from typing import Iterator
+from urllib.parse import quote, unquote
+from redis.exceptions import RedisError
+
+from api.redisconfig import get_redis
+
+logger = logging.getLogger(__name__)
+
+# zstd is smaller and faster when the optional zstandard package is installed, zlib otherwise.
+# Blobs are told apart by their magic number so an archive can hold both.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+COMPRESSION_LEVEL = 6
+
+# Set to a directory for an on-disk archive or to "redis" to keep it next to the cache. Unset turns archiving off
+ARCHIVE_LOCATION = os.environ.get("VGMDB_ARCHIVE", "")
+
+_disk_archive = None
+
+def compress_page(content: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(content)
+    return zlib.compress(content, COMPRESSION_LEVEL)
+
+def decompress_page(blob) -> bytes:
+    if bytes(blob[:4]) == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("Archived page is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+def page_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+class PageArchive(ABC):
+    """
+    Raw album pages keyed by catalog and fetch time. Page bodies are stored once per
+    distinct content (sha256), refetching an unchanged page only adds an index entry.
+    """
+    def put(self, catalog: str, content: bytes, fetched_at: float = None) -> str:
+        if isinstance(content, str):
+            content = content.encode()
+        digest = page_digest(content)
+        if not self._has_blob(digest):
+            self._write_blob(digest, compress_page(content))
+        self._add_index(str(catalog), time.time() if fetched_at is None else fetched_at, digest)
+        return digest
+
+    def latest(self, catalog: str) -> bytes | None:
+        history = self.history(catalog)
+        if not history:
+            return None
+        return self.get(history[-1][1])
+
+    @abstractmethod
+    def get(self, digest: str) -> bytes | None:
+        """
+        The decompressed page stored as digest, None if there is none
+        """
+
+    @abstractmethod
+    def history(self, catalog: str) -> list[tuple[float, str]]:
+        """
+        (fetched_at, digest) for every archived fetch of catalog, oldest first
+        """
+
+    @abstractmethod
+    def catalogs(self) -> Iterator[str]:
+        ...
+
+    @abstractmethod
+    def _has_blob(self, digest: str) -> bool:
+        ...
+
+    @abstractmethod
+    def _write_blob(self, digest: str, blob: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def _add_index(self, catalog: str, fetched_at: float, digest: str) -> None:
+        ...
+
+class DiskPageArchive(PageArchive):
+    """
+    root/blobs/<2 hex>/<sha256>.z holds the compressed pages, root/index/<catalog>.jsonl one line per fetch.
+    Blobs are read through mmap so a bulk reparse doesn't copy every file into the heap first.
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(root, "index"), exist_ok=True)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, "blobs", digest[:2], f"{digest}.z")
+
+    def _index_path(self, catalog: str) -> str:
+        return os.path.join(self.root, "index", f"{quote(catalog, safe='')}.jsonl")
+
+    def _has_blob(self, digest: str) -> bool:
+        return os.path.exists(self._blob_path(digest))
+
+    def _write_blob(self, digest: str, blob: bytes) -> None:
+        path = self._blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temp file and renamed so a reader never sees half a blob
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as blob_file:
+            blob_file.write(blob)
+        os.replace(temp_path, path)
+
+    def get(self, digest: str) -> bytes | None:
+        try:
+            with open(self._blob_path(digest), "rb") as blob_file:
+                with mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return decompress_page(mapped)
+        except FileNotFoundError:
+            return None
+
+    def _add_index(self, catalog: str, fetched_at: float, digest: str) -> None:
+        with open(self._index_path(catalog), "a") as index:
+            index.write(json.dumps({"fetched_at": fetched_at, "digest": digest}) + "\n")
+
+    def history(self, catalog: str) -> list[tuple[float, str]]:
+        try:
+            with open(self._index_path(str(catalog))) as index:
+                return [(entry["fetched_at"], entry["digest"]) for entry in map(json.loads, index)]
+        except FileNotFoundError:
+            return []
+
+    def catalogs(self) -> Iterator[str]:
+        for name in sorted(os.listdir(os.path.join(self.root, "index"))):
+            if name.endswith(".jsonl"):
+                yield unquote(name[:-len(".jsonl")])
+
+class RedisPageArchive(PageArchive):
+    """
+    page:blob:<sha256> holds the compressed pages, page:index:<catalog> is a sorted set of digests by fetch time.
+    """
+    def __init__(self, redis_obj: redis.Redis) -> None:
+        self.redis_obj = redis_obj
+
+    def _has_blob(self, digest: str) -> bool:
+        return bool(self.redis_obj.exists(f'page:blob:{digest}'))
+
+    def _write_blob(self, digest: str, blob: bytes) -> None:
+        self.redis_obj.set(f'page:blob:{digest}', blob)
+
+    def get(self, digest: str) -> bytes | None:
+        blob = self.redis_obj.get(f'page:blob:{digest}')
+        return None if blob is None else decompress_page(blob)
+
+    def _add_index(self, catalog: str, fetched_at: float, digest: str) -> None:
+        # A digest is one member, so an unchanged refetch just moves its fetch time forward
+        self.redis_obj.zadd(f'page:index:{catalog}', {digest: fetched_at})
+
+    def history(self, catalog: str) -> list[tuple[float, str]]:
+        return [
+            (fetched_at, digest.decode() if isinstance(digest, bytes) else digest)
+            for digest, fetched_at in self.redis_obj.zrange(f'page:index:{catalog}', 0, -1, withscores=True)
+        ]
+
+    def catalogs(self) -> Iterator[str]:
+        for key in self.redis_obj.scan_iter(match='page:index:*'):
+            yield (key.decode() if isinstance(key, bytes) else key)[len('page:index:'):]
+
+def get_page_archive() -> PageArchive | None:
+    """
+    Returns the archive set up by VGMDB_ARCHIVE or None when archiving is off or unavailable
+    """
+    if not ARCHIVE_LOCATION:
+        return None
+    global _disk_archive
+    if ARCHIVE_LOCATION == "redis":
+        redis_obj = get_redis()
+        return RedisPageArchive(redis_obj) if redis_obj is not None else None
+    if _disk_archive is None or _disk_archive.root != ARCHIVE_LOCATION:
+        try:
+            _disk_archive = DiskPageArchive(ARCHIVE_LOCATION)
+        except OSError:
+            logger.exception("Page archive at %s is not usable", ARCHIVE_LOCATION)
+            return None
+    return _disk_archive
+
+def archive_page(catalog: str, content: bytes) -> None:
+    # Archiving is best effort, a failure here never fails the request that fetched the page
+    archive = get_page_archive()
+    if archive is None:
+        return
+    try:
+        archive.put(catalog, content)
+    except (OSError, RedisError):
+        logger.exception("Error in archiving page %s", catalog)
@@ -0,0 +1,233 @@
+import gc
+import html
+import json
+import logging
+import os
+import platform
+import time
+import tracemalloc
+
+from typing import Any, Callable
+
+from bs4 import BeautifulSoup
+
+from api.vgmdbcrawl import VGMDataForVGMAPI, HTML_PARSER
+
+logger = logging.getLogger(__name__)
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "tests", "examples", "corpus")
+# One baseline per python minor version, allocation sizes change between them
+BASELINE_FILE = os.path.join(CORPUS_DIR, "baseline-{python}.json")
+# The real page the parser tests use is part of the corpus too
+EXAMPLE_PAGE = os.path.join(os.path.dirname(CORPUS_DIR), "example-vgmdb-page.html")
+BENCHMARK_REPEAT = 3
+# Times are compared as multiples of the calibration run so a baseline from one machine holds on another.
+# A stage regresses when it is more than TOLERANCE slower than its baseline and by more than SLACK calibration units
+BENCHMARK_TOLERANCE = 0.5
+BENCHMARK_SLACK = 0.05
+MEMORY_TOLERANCE = 0.25
+MEMORY_SLACK = 64 * 1024 #bytes
+CALIBRATION_ROUNDS = 2
+
+EXTRACTORS = ("title", "game", "albuminfo", "tracks", "covers", "credits")
+CONVERSIONS = ("as_pydantic", "as_db_entry")
+HUGE_PAGE = {"title": "Huge Box Set", "game": "Huge Game", "discs": 20, "tracks_per_disc": 50, "languages": ("en", "ja", "ja-Latn"),
+             "credits": 60, "covers": 40}
+# Layouts the real pages don't cover, generated with synthetic_page when the corpus is loaded.
+# Only real album pages are saved in CORPUS_DIR, these would test nothing but the generator's own markup
+SYNTHETIC_PAGES = {
+    "minimal": {"title": "Minimal Single", "tracks_per_disc": 1, "covers": 1, "catalog": "MIN-0001"},
+    "multi-disc": {"title": "Multi Disc Original Soundtrack", "game": "Multi Disc", "discs": 4, "tracks_per_disc": 15,
+                   "credits": 12, "covers": 3, "catalog": "MULTI-0001~4"},
+    "multi-language": {"title": "Multi Language Soundtrack", "game": "Multi Language", "discs": 2, "tracks_per_disc": 12,
+                       "languages": ("en", "ja", "ja-Latn"), "credits": 10, "covers": 2, "catalog": "LANG-0001~2"},
+    "huge": HUGE_PAGE,
+}
+
+def synthetic_page(title: str, game: str = None, discs: int = 1, tracks_per_disc: int = 10, languages: tuple[str, ...] = ("en",),
+                   credits: int = 0, covers: int = 0, catalog: str = "BENCH-0001") -> str:
+    """
+    An album page in vgmdb's markup: the title in every language, the info table, one tracklist tab
+    per language, credits with a name per language and a cover gallery. Only the parts the extractors read.
+    """
+    def localized(text: str, css_class: str) -> str:
+        return "".join(f'<span class="{css_class}" lang="{lang}">{html.escape(text if lang == "en" else f"{text} ({lang})")}</span>' for lang in languages)
+
+    parts = [f'<html><head><title>{html.escape(title)} - VGMdb</title></head><body>',
+             f'<h1>{localized(title, "albumtitle")} </h1>']
+    parts.append('<table id="album_infobit_large" cellpadding="1" cellspacing="1">')
+    for key, value in (("Catalog Number", catalog), ("Release Date", "Mar 29, 2017"), ("Publish Format", "Commercial"),
+                       ("Media Format", f"{discs} CD"), ("Classification", "Original Soundtrack")):
+        parts.append(f'<tr><td nowrap="nowrap"><span class="label"><b>{key}</b></span></td><td>{value}</td></tr>')
+    parts.append('</table>')
+    if game:
+        parts.append(f'<a href="/product/1234">{localized(game, "productname")}</a>')
+    if credits:
+        parts.append('<div id="collapse_credits"><div><table id="album_infobit_large"><tbody>')
+        for n in range(credits):
+            parts.append(f'<tr class="maincred"><td nowrap="nowrap"><span class="label"><b>{localized(f"Role {n}", "artistname")}</b></span></td>'
+                         f'<td width="100%"><a href="/artist/{n}">{localized(f"Artist {n}", "artistname")}</a></td></tr>')
+        parts.append('</tbody></table></div></div>')
+    if discs:
+        parts.append('<div id="tracklist">')
+        for lang in languages:
+            parts.append(f'<span class="tl" id="tl-{lang}">')
+            for disc in range(1, discs + 1):
+                parts.append(f'<span style="font-size:8pt"><b>Disc {disc} [{catalog}]</b></span><br /><br />'
+                             '<table cellpadding="1" cellspacing="0" border="0" class="role">')
+                for track in range(1, tracks_per_disc + 1):
+                    name = f"Track {disc}-{track}" if lang == "en" else f"Track {disc}-{track} ({lang})"
+                    parts.append(f'<tr class="rolebit"><td class="smallfont"><span class="label">{track:02}</span></td>'
+                                 f'<td class="smallfont" width="100%" colspan="2">\n\n{html.escape(name)}</td>\n\n'
+                                 f'<td class="smallfont" align="right" nowrap="nowrap"><span class="time">{track % 7 + 1}:{track % 60:02}</span>\n\n</td></tr>')
+                parts.append('</table>')
+            parts.append('</span>')
+        parts.append('</div>')
+    if covers:
+        parts.append('<div class="covertab" id="cover_gallery"><table><tr>')
+        parts.extend(f'<td><a href="https://media.vgm.io/albums/00/0000/cover-{n}.jpg" class="highslide">Cover {n}</a></td>' for n in range(covers))
+        parts.append('</tr></table></div>')
+    parts.append('</body></html>')
+    return "\n".join(parts)
+
+def load_corpus(directory: str = CORPUS_DIR) -> dict[str, bytes]:
+    """
+    The example page and every real album page saved in directory, plus the SYNTHETIC_PAGES
+    """
+    corpus = {}
+    if os.path.exists(EXAMPLE_PAGE):
+        with open(EXAMPLE_PAGE, "rb") as page:
+            corpus["example"] = page.read()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".html"):
+            with open(os.path.join(directory, name), "rb") as page:
+                corpus[name[:-len(".html")]] = page.read()
+    for name, spec in SYNTHETIC_PAGES.items():
+        corpus[name] = synthetic_page(**spec).encode()
+    return corpus
+
+def _parsed(page: bytes, parser: str) -> VGMDataForVGMAPI:
+    vgmdata = VGMDataForVGMAPI("benchmark", parser=parser)
+    vgmdata.fetch_vals_from_webpage(content=page)
+    return vgmdata
+
+def _best_time(setup: Callable[[], Any], run: Callable[[Any], Any], repeat: int) -> float:
+    # Best of repeat, every round on a fresh setup so no cached_property carries over
+    best = float("inf")
+    for _ in range(repeat):
+        subject = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(subject)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def calibrate(repeat: int = BENCHMARK_REPEAT) -> float:
+    """
+    Seconds this machine takes for a fixed parsing workload that does not use any code under test
+    """
+    page = synthetic_page("Calibration", discs=2, tracks_per_disc=20)
+
+    def workload(_):
+        for _ in range(CALIBRATION_ROUNDS):
+            BeautifulSoup(page, "html.parser").find_all("tr")
+
+    return _best_time(lambda: None, workload, repeat)
+
+def benchmark_page(page: bytes, repeat: int = BENCHMARK_REPEAT, parser: str = HTML_PARSER) -> dict[str, Any]:
+    """
+    Best-of-repeat seconds for parsing the page, for each extractor on its own and for the full
+    conversions (every extractor included), plus the peak memory of parsing and converting it once
+    """
+    seconds = {"parse": _best_time(lambda: None, lambda _: _parsed(page, parser), repeat)}
+    for extractor in EXTRACTORS:
+        seconds[extractor] = _best_time(lambda: _parsed(page, parser), lambda vgmdata: getattr(vgmdata, extractor), repeat)
+    seconds["as_pydantic"] = _best_time(lambda: _parsed(page, parser), lambda vgmdata: vgmdata.as_pydantic(), repeat)
+    seconds["as_db_entry"] = _best_time(lambda: _parsed(page, parser),
+                                        lambda vgmdata: vgmdata.as_db_entry(rating=0, year_listened=2024), repeat)
+
+    gc.collect()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    vgmdata = _parsed(page, parser)
+    vgmdata.as_pydantic()
+    vgmdata.as_db_entry(rating=0, year_listened=2024)
+    peak_memory = tracemalloc.get_traced_memory()[1] - start
+    if not tracing:
+        tracemalloc.stop()
+    return {"size": len(page), "seconds": seconds, "peak_memory": peak_memory}
+
+def run_benchmarks(corpus: dict[str, bytes], repeat: int = BENCHMARK_REPEAT, parser: str = HTML_PARSER) -> dict[str, Any]:
+    calibration = calibrate(repeat)
+    pages = {}
+    for name, page in corpus.items():
+        result = benchmark_page(page, repeat, parser)
+        result["relative"] = {stage: round(value / calibration, 4) for stage, value in result["seconds"].items()}
+        result["seconds"] = {stage: round(value, 6) for stage, value in result["seconds"].items()}
+        pages[name] = result
+    return {"parser": parser, "python": platform.python_version(), "calibration": calibration, "pages": pages}
+
+def python_minor(version: str = None) -> str:
+    # "3.10.12" -> "3.10", patch releases don't change allocation sizes
+    return ".".join((version or platform.python_version()).split(".")[:2])
+
+def baseline_file(python: str = None) -> str:
+    return BASELINE_FILE.format(python=python_minor(python))
+
+def uncompared(report: dict[str, Any], baseline: dict[str, Any]) -> list[str]:
+    """
+    One line for each check compare can't make against this baseline, empty when it makes all of them
+    """
+    if report["parser"] != baseline["parser"]:
+        return [f"baseline was taken with {baseline['parser']}, not {report['parser']}, nothing is compared"]
+    if python_minor(report["python"]) != python_minor(baseline["python"]):
+        return [f"baseline was taken on python {baseline['python']}, not {report['python']}, peak memory is not compared"]
+    return []
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], tolerance: float = BENCHMARK_TOLERANCE) -> list[str]:
+    """
+    Returns one line per stage or page that got slower or hungrier than the baseline allows, empty when none did.
+    What it leaves out for a baseline from another parser or python is in uncompared
+    """
+    if report["parser"] != baseline["parser"]:
+        return []
+    compare_memory = python_minor(report["python"]) == python_minor(baseline["python"])
+    regressions = []
+    for name, result in report["pages"].items():
+        base = baseline["pages"].get(name)
+        if base is None:
+            continue
+        for stage, value in result["relative"].items():
+            allowed = base["relative"].get(stage, float("inf")) * (1 + tolerance) + BENCHMARK_SLACK
+            if value > allowed:
+                regressions.append(f"{name} {stage}: {value:.2f} calibration units, baseline {base['relative'][stage]:.2f}")
+        allowed_memory = base["peak_memory"] * (1 + MEMORY_TOLERANCE) + MEMORY_SLACK
+        if compare_memory and result["peak_memory"] > allowed_memory:
+            regressions.append(f"{name} peak memory: {result['peak_memory']} bytes, baseline {base['peak_memory']}")
+    return regressions
+
+def format_report(report: dict[str, Any]) -> str:
+    stages = ("parse",) + EXTRACTORS + CONVERSIONS
+    lines = [f"parser {report['parser']}, python {report['python']}, calibration {report['calibration'] * 1000:.2f} ms",
+             f"{'page':<20}{'KiB':>8}" + "".join(f"{stage:>13}" for stage in stages) + f"{'peak KiB':>11}"]
+    for name, result in report["pages"].items():
+        lines.append(f"{name:<20}{result['size'] / 1024:>8.1f}"
+                     + "".join(f"{result['seconds'][stage] * 1000:>11.3f}ms" for stage in stages)
+                     + f"{result['peak_memory'] / 1024:>11.1f}")
+    return "\n".join(lines)
+
+def load_baseline(path: str = None) -> dict[str, Any] | None:
+    path = path or baseline_file()
+    try:
+        with open(path) as baseline:
+            return json.load(baseline)
+    except FileNotFoundError:
+        return None
+
+def save_baseline(report: dict[str, Any], path: str = None) -> None:
+    with open(path or baseline_file(report["python"]), "w") as baseline:
+        json.dump(report, baseline, indent=2, sort_keys=True)
+        baseline.write("\n")
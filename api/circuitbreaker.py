@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+BREAKER_WINDOW = int(os.environ.get("VGMDB_BREAKER_WINDOW", 20)) #last fetches the failure rate is taken over
+BREAKER_MIN_CALLS = int(os.environ.get("VGMDB_BREAKER_MIN_CALLS", 10)) #fetches in the window before the circuit can open
+BREAKER_FAILURE_RATE = float(os.environ.get("VGMDB_BREAKER_FAILURE_RATE", 0.5))
+BREAKER_OPEN_SECONDS = float(os.environ.get("VGMDB_BREAKER_OPEN_SECONDS", 30))
+BREAKER_HALF_OPEN_PROBES = 1
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    Per process circuit breaker for the vgmdb upstream.
+    closed: fetches go through, the outcome of the last window fetches is tracked. Once at least
+    min_calls are in and failure_rate of them failed the circuit opens.
+    open: fetches fail fast without touching the network for open_seconds.
+    half_open: up to probes fetches go through. A success closes the circuit, a failure opens it again.
+    """
+    def __init__(self, window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS, failure_rate: float = BREAKER_FAILURE_RATE,
+                 open_seconds: float = BREAKER_OPEN_SECONDS, probes: int = BREAKER_HALF_OPEN_PROBES) -> None:
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._outcomes: deque[bool] = deque(maxlen=self.window) # True for a failure
+            self._opened_at = 0.0
+            self._probes_started: list[float] = []
+            self.opened = 0
+            self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_started = []
+            logger.info("vgmdb circuit half open, probing")
+        return self._state
+
+    def allow(self) -> bool:
+        """
+        True if a fetch may go out now. A fetch that was allowed must report back through
+        record_success, record_failure or release.
+        """
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN:
+                # A probe that never reported back (its task died) frees its slot after open_seconds
+                self._probes_started = [started for started in self._probes_started if now - started < self.open_seconds]
+                if len(self._probes_started) < self.probes:
+                    self._probes_started.append(now)
+                    return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self) -> float:
+        # Seconds until the next probe may go out, for Retry-After on fast-failed requests
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(self.open_seconds - (time.monotonic() - self._opened_at), 1.0)
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state == HALF_OPEN:
+                logger.info("vgmdb circuit closed")
+                self._state = CLOSED
+                self._outcomes.clear()
+                self._probes_started = []
+            elif self._state == CLOSED:
+                self._outcomes.append(False)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                self._open(now)
+            elif self._state == CLOSED:
+                self._outcomes.append(True)
+                failures = sum(self._outcomes)
+                if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def release(self) -> None:
+        # An allowed fetch that never reached vgmdb, it says nothing about upstream health
+        with self._lock:
+            if self._probes_started:
+                self._probes_started.pop()
+
+    def _open(self, now: float) -> None:
+        logger.warning("vgmdb circuit open for %ss", self.open_seconds)
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._probes_started = []
+        self.opened += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self._current_state(time.monotonic()),
+                "recent_calls": len(self._outcomes),
+                "recent_failures": sum(self._outcomes),
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+vgmdb_breaker = CircuitBreaker()
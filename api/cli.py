@@ -1,7 +1,118 @@
+import asyncio
 import typer
 
-def main():
-    pass
+from typing import List, Optional
+
+from api.archive import ARCHIVE_LOCATION, DiskPageArchive, RedisPageArchive
+from api.benchmark import (
+    BENCHMARK_REPEAT, BENCHMARK_TOLERANCE, CORPUS_DIR,
+    baseline_file, compare, format_report, load_baseline, load_corpus, run_benchmarks, save_baseline, uncompared,
+)
+from api.crawler import crawl_catalogs, jsonl_to_parquet, parse_catalog_specs
+from api.redisconfig import close_async_redis, get_async_redis, get_redis
+from api.vgmdbcrawl import reparse_archive
+
+app = typer.Typer()
+
+@app.command()
+def reparse(
+    catalogs: Optional[List[str]] = typer.Argument(None, help="Catalog IDs to rebuild, defaults to everything archived"),
+    archive: str = typer.Option(ARCHIVE_LOCATION, help='Archive directory, or "redis"'),
+    cache_time_in_minutes: int = typer.Option(30),
+):
+    """
+    Rebuild the game: cache from archived pages instead of refetching them from vgmdb.
+    """
+    redis_obj = get_redis()
+    if redis_obj is None:
+        typer.echo("Redis is not reachable", err=True)
+        raise typer.Exit(code=1)
+    if not archive:
+        typer.echo("No archive given, set --archive or VGMDB_ARCHIVE", err=True)
+        raise typer.Exit(code=1)
+    
+    page_archive = RedisPageArchive(redis_obj) if archive == "redis" else DiskPageArchive(archive)
+    written = reparse_archive(page_archive, redis_obj, catalogs, cache_time_in_minutes)
+    typer.echo(f"Rebuilt {written} cache entries")
+
+@app.command()
+def crawl(
+    catalogs: List[str] = typer.Argument(..., help='Catalog IDs, ranges like 100-200 or comma separated lists'),
+    output: Optional[str] = typer.Option(None, help="JSONL file the parsed albums are appended to"),
+    parquet: Optional[str] = typer.Option(None, help="Also convert the JSONL output to Parquet when done, needs pyarrow"),
+    checkpoint: Optional[str] = typer.Option(None, help="Progress file, defaults to <output>.checkpoint"),
+    warm_cache: bool = typer.Option(False, help="Write every parsed album to the redis cache"),
+    rate: float = typer.Option(1.0, help="Requests per second to vgmdb"),
+    concurrency: int = typer.Option(4, help="Fetches in flight at once"),
+    workers: Optional[int] = typer.Option(None, help="Parser processes, defaults to the CPU count"),
+    cache_time_in_minutes: int = typer.Option(30),
+):
+    """
+    Fetch and parse many albums. Rerunning the same command resumes where it stopped.
+    """
+    if not output and not warm_cache:
+        typer.echo("Nothing to do, give --output and/or --warm-cache", err=True)
+        raise typer.Exit(code=1)
+    if parquet and not output:
+        typer.echo("--parquet is converted from --output, give both", err=True)
+        raise typer.Exit(code=1)
+    if warm_cache and get_redis() is None:
+        typer.echo("Redis is not reachable", err=True)
+        raise typer.Exit(code=1)
+    checkpoint = checkpoint or (f"{output}.checkpoint" if output else None)
+    
+    async def run():
+        try:
+            return await crawl_catalogs(
+                parse_catalog_specs(catalogs), output=output, checkpoint=checkpoint,
+                redis_obj=get_async_redis() if warm_cache else None, rate=rate, concurrency=concurrency,
+                workers=workers, cache_time_in_minutes=cache_time_in_minutes,
+            )
+        finally:
+            await close_async_redis()
+    
+    stats = asyncio.run(run())
+    typer.echo(f"Crawled {stats}")
+    if parquet:
+        try:
+            jsonl_to_parquet(output, parquet)
+        except ImportError:
+            typer.echo("Parquet output needs pyarrow installed", err=True)
+            raise typer.Exit(code=1)
+        typer.echo(f"Wrote {parquet}")
+
+@app.command()
+def benchmark(
+    corpus: str = typer.Option(CORPUS_DIR, help="Directory of saved real album pages, generated ones are added to them"),
+    baseline: str = typer.Option(baseline_file(), help="Baseline JSON the results are checked against, defaults to this python's"),
+    repeat: int = typer.Option(BENCHMARK_REPEAT, help="Runs of each stage, the best one counts"),
+    tolerance: float = typer.Option(BENCHMARK_TOLERANCE, help="How much slower than the baseline a stage may get, 0.5 is 50%"),
+    update_baseline: bool = typer.Option(False, help="Write these results as the new baseline instead of checking them"),
+):
+    """
+    Time every album page extractor and conversion over the page corpus. Fails on regressions against the baseline.
+    """
+    report = run_benchmarks(load_corpus(corpus), repeat=repeat)
+    typer.echo(format_report(report))
+    if update_baseline:
+        save_baseline(report, baseline)
+        typer.echo(f"Wrote {baseline}")
+        return
+    stored = load_baseline(baseline)
+    if stored is None:
+        typer.echo(f"No baseline at {baseline}, run with --update-baseline to create one", err=True)
+        raise typer.Exit(code=1)
+    for reason in uncompared(report, stored):
+        typer.echo(f"Not compared: {reason}", err=True)
+    # Another parser's baseline checks nothing at all, that is a failure and not a pass
+    if report["parser"] != stored["parser"]:
+        raise typer.Exit(code=1)
+    regressions = compare(report, stored, tolerance)
+    for regression in regressions:
+        typer.echo(f"Regression: {regression}", err=True)
+    if regressions:
+        raise typer.Exit(code=1)
+    typer.echo("No regressions")
 
 if __name__ == "__main__":
-    typer.run(main)
\ No newline at end of file
+    app()
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import httpx
+import orjson
+import redis.asyncio as aioredis
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from api.archive import archive_page
+from api.circuitbreaker import vgmdb_breaker
+from api.httpclient import create_http_client
+from api.ratelimit import RateLimitTimeout, vgmdb_limiter, is_upstream_error
+from api.redisconfig import get_async_redis
+from api.vgmdbcrawl import VGMDB_ALBUM_URL, VGMDataForVGMAPI, is_fetch_error
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CrawlStats:
+    workers: int
+    pages: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes_received: int = 0
+    parse_seconds: float = 0.0
+    queue_wait_seconds: float = 0.0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def parse_ms_per_page(self) -> float:
+        return self.parse_seconds * 1000 / self.pages if self.pages else 0.0
+
+    @property
+    def parse_busy_per_core(self) -> float:
+        # Fraction of the run each parser process spent parsing, near 1.0 means parsing is the bottleneck
+        return self.parse_seconds / (self.elapsed * self.workers) if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.pages} pages ({self.skipped} already done, {self.failed} failed) in {self.elapsed:.1f}s, "
+                f"{self.pages_per_second:.2f} pages/s, {self.queue_wait_seconds:.1f}s waiting on the rate limit, "
+                f"{self.parse_ms_per_page:.1f}ms parse/page, "
+                f"{self.parse_busy_per_core:.0%} parse busy per core over {self.workers} workers")
+
+class RateLimiter:
+    """
+    Spaces request starts at least 1/rate seconds apart across every task sharing it
+    """
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+def parse_catalog_specs(specs: Iterable[str]) -> list[str]:
+    """
+    "100-105", "65091" and "1,2,3" style specs to a flat, deduplicated list of catalog IDs
+    """
+    catalogs = []
+    for spec in specs:
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            start, dash, end = part.partition("-")
+            if dash and start.isdigit() and end.isdigit():
+                catalogs.extend(str(catalog) for catalog in range(int(start), int(end) + 1))
+            else:
+                catalogs.append(part)
+    return list(dict.fromkeys(catalogs))
+
+def parse_page(catalog: str, content: bytes, etag: str = None, last_modified: str = None, status_code: int = 200) -> tuple[dict, float]:
+    """
+    Runs in the process pool. Returns the cache entry for the page and the seconds spent parsing it.
+    status_code: the one vgmdb answered with, a 404 page becomes a negative entry whatever its markup says
+    """
+    start = time.perf_counter()
+    vgmdata = VGMDataForVGMAPI(catalog)
+    vgmdata.fetch_stats["status_code"] = status_code
+    vgmdata.fetch_vals_from_webpage(content)
+    vgmdata.etag = etag
+    vgmdata.last_modified = last_modified
+    # Round tripped to plain types, bs4 strings would drag their whole tree through pickle back to the parent
+    data = orjson.loads(orjson.dumps(vgmdata._as_cache_dict(), option=orjson.OPT_NON_STR_KEYS))
+    return data, time.perf_counter() - start
+
+def load_checkpoint(path: str) -> set[str]:
+    try:
+        with open(path) as checkpoint:
+            return {line.strip() for line in checkpoint if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+def jsonl_to_parquet(jsonl_path: str, parquet_path: str) -> None:
+    # Optional, needs pyarrow. Nested sections are kept as JSON strings so the schema doesn't depend on the album
+    import pyarrow
+    import pyarrow.parquet
+
+    rows = []
+    with open(jsonl_path, "rb") as jsonl:
+        for line in jsonl:
+            entry = orjson.loads(line)
+            rows.append({
+                key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                for key, value in entry.items()
+            })
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), parquet_path)
+
+async def crawl_catalogs(
+    catalogs: list[str],
+    output: str = None,
+    checkpoint: str = None,
+    redis_obj: aioredis.Redis = None,
+    client: httpx.AsyncClient = None,
+    rate: float = 1.0,
+    concurrency: int = 4,
+    workers: int = None,
+    cache_time_in_minutes: int = 30,
+    progress_every: int = 100,
+) -> CrawlStats:
+    """
+    Fetches every catalog at most rate requests per second, parses them in a process pool and
+    appends the results to output (JSONL) and/or writes them to the redis cache. Finished catalogs
+    are appended to checkpoint so running the same crawl again picks up where it stopped.
+    Failed fetches are not checkpointed and get retried on the next run.
+    """
+    workers = workers or os.cpu_count() or 1
+    stats = CrawlStats(workers=workers)
+    done = load_checkpoint(checkpoint) if checkpoint else set()
+    pending = [catalog for catalog in catalogs if catalog not in done]
+    stats.skipped = len(catalogs) - len(pending)
+    todo = iter(pending)
+    limiter = RateLimiter(rate)
+    loop = asyncio.get_running_loop()
+    own_client = client is None
+    client = client or create_http_client()
+
+    output_file = open(output, "ab") if output else None
+    checkpoint_file = open(checkpoint, "a") if checkpoint else None
+
+    async def handle(catalog: str, pool: ProcessPoolExecutor) -> None:
+        await limiter.wait()
+        # A crawl waits out an open circuit instead of failing every remaining catalog
+        while not vgmdb_breaker.allow():
+            await asyncio.sleep(vgmdb_breaker.retry_after())
+        # The crawl's own rate is on top of the cluster-wide budget the API workers share
+        shared_redis = get_async_redis()
+        try:
+            stats.queue_wait_seconds += await vgmdb_limiter.acquire_async(shared_redis)
+            response = await client.get(f'{VGMDB_ALBUM_URL}{catalog}')
+        except RateLimitTimeout:
+            vgmdb_breaker.release()
+            logger.error("No vgmdb request slot for page %s", catalog)
+            stats.failed += 1
+            return
+        except httpx.HTTPError:
+            vgmdb_breaker.record_failure()
+            logger.exception("Error on request of page %s", catalog)
+            stats.failed += 1
+            return
+        await vgmdb_limiter.record_response_async(shared_redis, response.status_code, response.headers.get('Retry-After'))
+        vgmdb_breaker.record(not is_upstream_error(response.status_code))
+        if is_fetch_error(response.status_code):
+            logger.error("vgmdb answered %s for %s", response.status_code, catalog)
+            stats.failed += 1
+            return
+
+        stats.bytes_received += len(response.content)
+        # A 404 still gets its negative cache entry, but is not archived, see VGMDBData._archivable
+        if response.is_success:
+            await asyncio.to_thread(archive_page, catalog, response.content)
+        data, parse_seconds = await loop.run_in_executor(
+            pool, parse_page, catalog, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+            response.status_code
+        )
+        stats.parse_seconds += parse_seconds
+
+        if output_file:
+            output_file.write(orjson.dumps({"Catalog": catalog, **data}) + b"\n")
+            output_file.flush()
+        if redis_obj is not None:
+            vgmdata = VGMDataForVGMAPI(catalog)
+            vgmdata._load_cache_dict(data)
+            await vgmdata.set_cached_vals_async(redis_obj, timelimit=cache_time_in_minutes)
+        # Checkpointed only once the results are written, a crash can repeat a page but never lose one
+        if checkpoint_file:
+            checkpoint_file.write(f"{catalog}\n")
+            checkpoint_file.flush()
+        stats.pages += 1
+        if progress_every and stats.pages % progress_every == 0:
+            logger.info("Crawl progress: %s", stats)
+
+    async def worker(pool: ProcessPoolExecutor) -> None:
+        for catalog in todo:
+            try:
+                await handle(catalog, pool)
+            except Exception:
+                logger.exception("Error in crawling %s", catalog)
+                stats.failed += 1
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            await asyncio.gather(*(worker(pool) for _ in range(max(concurrency, 1))))
+    finally:
+        for open_file in (output_file, checkpoint_file):
+            if open_file:
+                open_file.close()
+        if own_client:
+            await client.aclose()
+    return stats
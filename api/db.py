@@ -1,13 +1,48 @@
 import logging
-from typing import Any
+import os
+import random
+import threading
+import time
+import base64
+import binascii
+import json
+import zlib
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Iterator, Literal
 from pydantic import BaseModel
 import boto3
+import orjson
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Key, Attr
+
+from api.dbcache import QueryCache, year_key, game_key
 
 logger = logging.getLogger(__name__)
 
 DYNAMO_TABLE = "website-table"
+DYNAMO_REGION = "us-east-1"
+# Point at DynamoDB Local (e.g. http://localhost:8000) for development and tests
+DYNAMO_ENDPOINT = os.environ.get("DYNAMO_ENDPOINT") or None
+
+BULK_ADD_MAX_ENTRIES = 1000
+YEAR_PAGE_MAX = 1000
+BATCH_WRITE_SIZE = 25 #DynamoDB's limit per BatchWriteItem
+BATCH_WRITE_RETRIES = 5
+BATCH_WRITE_BACKOFF = 0.05 #seconds, doubled on every retry of the unprocessed items
+# First byte of a packed track list. Items written before packing have a plain list of maps in tracks
+TRACKS_FORMAT = 1
+TRACKS_COMPRESSION_LEVEL = 6
+
+# Shared by every request in the worker, so the pool has to cover the starlette threadpool (40 threads)
+DYNAMO_CONFIG = Config(
+    region_name=DYNAMO_REGION,
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=5,
+    retries={'max_attempts': 4, 'mode': 'standard'},
+)
 
 class Track(BaseModel):
     disc: str
@@ -20,6 +55,13 @@ class VGMInfo(BaseModel):
     description: str | None = None
     extras: list[dict | str] | None = None
     
+class BulkAddResult(BaseModel):
+    index: int
+    year_listened: int
+    game: str
+    status: Literal["written", "failed", "duplicate"]
+    error: str | None = None
+    
 class VGMEntry(VGMInfo):
     year_listened: int
     catalog_num: str 
@@ -30,7 +72,9 @@ class VGMEntry(VGMInfo):
     #DynamoDB Specific Functions
     
     def get_dynamo_formatted_dict(self) -> dict[str, str]:
-        data_dict = self.model_dump()
+        data_dict = self.model_dump(exclude={"tracks"})
+        if self.tracks is not None:
+            data_dict["tracks_packed"] = encode_tracks(self.tracks)
         item_dict = {
             'pk':f'{data_dict.pop("year_listened")}',
             'sk':f'{"game"}|{data_dict.pop("game")}',
@@ -67,6 +111,8 @@ class VGMEntry(VGMInfo):
         try:
             new_data['year_listened'] = new_data.pop('pk')
             new_data['game'] = new_data.pop('sk').lstrip(f'{VGMEntry.get_sk_prefix()}|')
+            if 'tracks_packed' in new_data:
+                new_data['tracks'] = decode_tracks(bytes(new_data.pop('tracks_packed')))
         except Exception:
             logger.exception("Error in convert_pksk_to_real_vals")
             return data
@@ -78,18 +124,134 @@ class VGMEntry(VGMInfo):
         return "game"
     ########## END DynamoDB Specific Functions ##########
     
-class DynamoDBVGM:
+class VGMStorage(ABC):
+    """
+    Storage behind the /api routes. A backend implements every abstract method: ensure_table, add,
+    _write_many, update, delete, query_year_page, _query_game and iter_all_pages. Bulk adds, walking
+    a whole year and the query cache are shared here.
+    """
+    def __init__(self, cache: QueryCache=None) -> None:
+        """
+        cache: optional, read-through cache for query_year and query_game. Writes through this object invalidate it.
+        """
+        self.cache = cache
+        # Called with ("upsert" | "update" | "delete", entries) after every write, see api.search
+        self.observers: list[Callable[[str, list[VGMEntry]], None]] = []
+        
+    @abstractmethod
+    def ensure_table(self) -> None:
+        ...
+    
+    @abstractmethod
+    def add(self, data: VGMEntry) -> VGMEntry:
+        ...
+    
+    def add_many(self, entries: list[VGMEntry]) -> list[BulkAddResult]:
+        """
+        Returns one result per entry in input order. An entry with the same key as a later one
+        in the list is reported as a duplicate and not written, the last one wins like add would.
+        """
+        results: list[BulkAddResult | None] = [None] * len(entries)
+        latest: dict[tuple[str, str], int] = {}
+        for index, entry in enumerate(entries):
+            key = (str(entry.year_listened), entry.game)
+            if key in latest:
+                earlier = latest[key]
+                results[earlier] = BulkAddResult(index=earlier, year_listened=entries[earlier].year_listened,
+                                                 game=entries[earlier].game, status="duplicate")
+            latest[key] = index
+        
+        for index, error in self._write_many(entries, sorted(latest.values())).items():
+            results[index] = BulkAddResult(index=index, year_listened=entries[index].year_listened, game=entries[index].game,
+                                           status="failed" if error else "written", error=error)
+        self._written("upsert", *(entries[result.index] for result in results if result.status == "written"))
+        return results
+    
+    @abstractmethod
+    def _write_many(self, entries: list[VGMEntry], indexes: list[int]) -> dict[int, str | None]:
+        """
+        Writes entries[index] for every index, keys are unique. Returns index -> error message, None for written.
+        """
+    
+    @abstractmethod
+    def update(self, data: VGMEntry) -> VGMEntry:
+        ...
+    
+    @abstractmethod
+    def delete(self, data: VGMEntry) -> dict[str, Any]:
+        ...
+    
+    @abstractmethod
+    def query_year_page(self, year: str, limit: int = None, cursor: str = None) -> tuple[list[VGMEntry], str | None]:
+        """
+        One page of a year ordered by game. cursor is the token returned with the previous page,
+        the returned token is None once the year is exhausted. Raises ValueError for a bad cursor.
+        limit: optional, at most this many entries. A backend may return fewer.
+        """
     
-    def __init__(self, engine: Any=boto3.resource('dynamodb', region_name="us-east-1"), table_name: str=None, debug: bool=False) -> None:
-        self.engine = engine
+    @abstractmethod
+    def _query_game(self, game: str) -> VGMEntry | dict:
+        ...
+    
+    @abstractmethod
+    def iter_all_pages(self) -> Iterator[list[VGMEntry]]:
+        """
+        Every entry with its tracks, a page at a time. For building indexes at startup, not for requests.
+        """
+    
+    def query_year(self, year:str) -> list[VGMEntry]:
+        # Every page. Use iter_year or query_year_page for big years
+        if self.cache is None:
+            return list(self.iter_year(year))
+        return self.cache.read_through(year_key(year), lambda: list(self.iter_year(year)), encode_entries, decode_entries)
+    
+    def query_game(self, game:str) -> VGMEntry | dict:
+        if self.cache is None:
+            return self._query_game(game)
+        return self.cache.read_through(game_key(game), lambda: self._query_game(game), encode_entries, decode_entries)
+    
+    def iter_year(self, year: str, page_size: int = None) -> Iterator[VGMEntry]:
+        for page in self.iter_year_pages(year, page_size):
+            yield from page
+    
+    def iter_year_pages(self, year: str, page_size: int = None) -> Iterator[list[VGMEntry]]:
+        """
+        Yields a year one page at a time, the next page is only fetched once the previous one is used up
+        """
+        cursor = None
+        while True:
+            entries, cursor = self.query_year_page(year, page_size, cursor)
+            yield entries
+            if not cursor:
+                return
+    
+    def _written(self, op: str, *entries: VGMEntry) -> None:
+        if not entries:
+            return
+        if self.cache is not None:
+            self.cache.invalidate(*{key for entry in entries for key in (year_key(entry.year_listened), game_key(entry.game))})
+        for observer in self.observers:
+            try:
+                observer(op, list(entries))
+            except Exception:
+                logger.exception("Storage observer failed on %s", op)
+    
+class DynamoDBVGM(VGMStorage):
+    
+    def __init__(self, engine: Any=None, table_name: str=None, debug: bool=False, check_table: bool=True, cache: QueryCache=None) -> None:
+        """
+        engine: optional, a boto3 dynamodb resource. One using DYNAMO_CONFIG is made if not passed.
+        check_table: Set this to False to skip the DescribeTable round trip, call ensure_table later.
+        cache: optional, see VGMStorage
+        """
+        super().__init__(cache)
+        self.engine = engine if engine is not None else get_dynamo_resource()
         self.table_name = table_name
         self._exists = None
+        self.table = self.engine.Table(self.table_name)
         
-        if self.table_exists:
-            self.table = self.engine.Table(self.table_name)
-        else:
-            logger.info("Created DynamoDB table %s", self.table_name)
-            self.table = self._create_table()
+        if check_table:
+            self.ensure_table()
 
         if debug:
             self.debug()
@@ -109,6 +271,12 @@ class DynamoDBVGM:
                     raise e
             test_table = None
         return self._exists
+    
+    def ensure_table(self) -> None:
+        if not self.table_exists:
+            logger.info("Created DynamoDB table %s", self.table_name)
+            self.table = self._create_table()
+            self._exists = True
         
     def _create_table(self):
         try:
@@ -167,8 +335,50 @@ class DynamoDBVGM:
             #TODO: Logging
             raise e
         else:
+            self._written("upsert", data)
             return data
         
+    def _write_many(self, entries: list[VGMEntry], indexes: list[int]) -> dict[int, str | None]:
+        # BatchWriteItem 25 at a time, unprocessed items are retried with jittered exponential backoff
+        outcome = {}
+        for start in range(0, len(indexes), BATCH_WRITE_SIZE):
+            chunk = indexes[start:start + BATCH_WRITE_SIZE]
+            outcome.update(self._write_chunk([entries[index] for index in chunk], chunk))
+        return outcome
+    
+    def _write_chunk(self, entries: list[VGMEntry], indexes: list[int]) -> dict[int, str | None]:
+        # index -> error message, None for written
+        pending = {
+            (item['pk'], item['sk']): (index, item)
+            for index, item in zip(indexes, (entry.get_dynamo_formatted_dict() for entry in entries))
+        }
+        outcome = {}
+        for attempt in range(BATCH_WRITE_RETRIES + 1):
+            if attempt:
+                time.sleep(random.uniform(0.5, 1.0) * BATCH_WRITE_BACKOFF * 2 ** (attempt - 1))
+            try:
+                response = self.engine.meta.client.batch_write_item(RequestItems={
+                    self.table_name: [{'PutRequest': {'Item': item}} for _, item in pending.values()]
+                })
+            except ClientError as e:
+                logger.exception("BatchWriteItem failed for %s items", len(pending))
+                error = e.response['Error']['Code']
+                return {**outcome, **{index: error for index, _ in pending.values()}}
+            
+            unprocessed = {
+                (request['PutRequest']['Item']['pk'], request['PutRequest']['Item']['sk'])
+                for request in response.get('UnprocessedItems', {}).get(self.table_name, [])
+            }
+            for key, (index, _) in pending.items():
+                if key not in unprocessed:
+                    outcome[index] = None
+            pending = {key: value for key, value in pending.items() if key in unprocessed}
+            if not pending:
+                return outcome
+            logger.info("%s items unprocessed by BatchWriteItem, retrying", len(pending))
+        
+        return {**outcome, **{index: "UnprocessedItems" for index, _ in pending.values()}}
+        
     def update(self, data: VGMEntry) -> VGMEntry:
         #TODO: Get the item and only update the passed kwargs
         try:
@@ -176,6 +386,7 @@ class DynamoDBVGM:
         except ClientError as e:
             raise e
         else:
+            self._written("update", data)
             return data
 
         
@@ -187,37 +398,55 @@ class DynamoDBVGM:
             #TODO: Logging and error coverage
             raise e
         else:
+            self._written("delete", data)
             if response.get('Attributes', None):
                 return data
             else:
                 return {}
     
-    def query_year(self, year:str) -> list[dict[str, Any]]:
+    def query_year_page(self, year: str, limit: int = None, cursor: str = None) -> tuple[list[VGMEntry], str | None]:
+        # The cursor is the query's LastEvaluatedKey
+        response = self._query_year(year, limit=limit, start_key=decode_cursor(cursor, year) if cursor else None)
+        return self._entries_from_items(response.get("Items", [])), encode_cursor(response.get("LastEvaluatedKey"))
+    
+    def _query_year(self, year: str, limit: int = None, start_key: dict = None) -> dict[str, Any]:
+        query = {
+            "Select": 'SPECIFIC_ATTRIBUTES',
+            "ProjectionExpression": "catalog_num, description, genre, img, pk, rating, sk",
+            "KeyConditionExpression": Key('pk').eq(year) & Key('sk').begins_with(VGMEntry.get_sk_prefix()),
+        }
+        if limit:
+            query["Limit"] = limit
+        if start_key:
+            query["ExclusiveStartKey"] = start_key
+        return self.table.query(**query)
+    
+    def iter_all_pages(self) -> Iterator[list[VGMEntry]]:
+        # A paginated Scan, only ever run once per worker when the search index is built
+        scan = {
+            "ProjectionExpression": "catalog_num, description, img, pk, rating, sk, tracks, tracks_packed",
+            "FilterExpression": Attr('sk').begins_with(VGMEntry.get_sk_prefix()),
+        }
+        while True:
+            response = self.table.scan(**scan)
+            yield self._entries_from_items(response.get("Items", []))
+            if not response.get("LastEvaluatedKey"):
+                return
+            scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    
+    @staticmethod
+    def _entries_from_items(items: list[dict[str, Any]]) -> list[VGMEntry]:
         try:
-            response = self.table.query(
-                Select='SPECIFIC_ATTRIBUTES',
-                ProjectionExpression="catalog_num, description, genre, img, pk, rating, sk",
-                KeyConditionExpression=Key('pk').eq(year) & Key('sk').begins_with(VGMEntry.get_sk_prefix()),
-            )
-        except:
-            raise
-        
-        else:
-            try:
-                if "Items" in response:
-                    data = [VGMEntry(**VGMEntry.convert_pksk_to_real_vals(item)) for item in response["Items"]]
-                else:
-                    data = []
-            except (IndexError, KeyError):
-                return []
-            else:
-                return data
+            return [VGMEntry(**VGMEntry.convert_pksk_to_real_vals(item)) for item in items]
+        except (IndexError, KeyError):
+            logger.exception("Malformed item in DynamoDB page")
+            return []
         
-    def query_game(self, game:str) -> dict[str, Any]:
+    def _query_game(self, game:str) -> dict[str, Any]:
         try:
             response = self.table.query(
                 Select='SPECIFIC_ATTRIBUTES', 
-                ProjectionExpression="catalog_num, description, genre, img, pk, rating, sk, tracks",
+                ProjectionExpression="catalog_num, description, genre, img, pk, rating, sk, tracks, tracks_packed",
                 IndexName='gsiIndex', 
                 KeyConditionExpression=Key('gsi_sk').eq(f'{VGMEntry.get_sk_prefix()}|{game}'),
             )
@@ -234,5 +463,95 @@ class DynamoDBVGM:
             else:
                 return data
         
-def get_vgmdb():
-    return DynamoDBVGM(table_name=DYNAMO_TABLE)
\ No newline at end of file
+def encode_tracks(tracks: list[Track]) -> bytes:
+    """
+    Packs a track list into a version byte and zlib compressed parallel arrays of disc, track_id,
+    title and duration. A long soundtrack's disc names and durations repeat a lot and compress well.
+    """
+    columns = [[], [], [], []]
+    for track in tracks:
+        columns[0].append(track.disc)
+        columns[1].append(track.track_id)
+        columns[2].append(track.title)
+        columns[3].append(track.duration)
+    return bytes([TRACKS_FORMAT]) + zlib.compress(orjson.dumps(columns), TRACKS_COMPRESSION_LEVEL)
+
+def decode_tracks(packed: bytes) -> list[Track]:
+    # Only called for reads that project tracks. They were validated when written so they aren't validated again here
+    if not packed or packed[0] != TRACKS_FORMAT:
+        raise ValueError(f"Unknown packed tracks format {packed[:1]!r}")
+    discs, track_ids, titles, durations = orjson.loads(zlib.decompress(packed[1:]))
+    return [
+        Track.model_construct(disc=disc, track_id=track_id, title=title, duration=duration)
+        for disc, track_id, title, duration in zip(discs, track_ids, titles, durations)
+    ]
+
+def encode_entries(value: list[VGMEntry] | VGMEntry | dict) -> bytes:
+    # query_year's list, query_game's entry or its {} for a missing game
+    if isinstance(value, list):
+        return json.dumps([entry.model_dump() for entry in value]).encode()
+    return value.model_dump_json().encode() if isinstance(value, VGMEntry) else b"{}"
+
+def decode_entries(raw: bytes) -> list[VGMEntry] | VGMEntry | dict:
+    value = json.loads(raw)
+    if isinstance(value, list):
+        return [VGMEntry(**entry) for entry in value]
+    return VGMEntry(**value) if value else {}
+
+def encode_cursor(last_evaluated_key: dict[str, Any] | None) -> str | None:
+    # Opaque to clients, it is the LastEvaluatedKey of the page they got
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, separators=(",", ":")).encode()).decode()
+
+class InvalidCursor(ValueError):
+    pass
+
+def decode_cursor(cursor: str, year: str) -> dict[str, Any]:
+    """
+    Raises InvalidCursor for a token that is not one of ours or belongs to another year
+    """
+    try:
+        start_key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise InvalidCursor("Invalid cursor") from None
+    if not isinstance(start_key, dict) or start_key.get('pk') != str(year) or not isinstance(start_key.get('sk'), str):
+        raise InvalidCursor("Invalid cursor")
+    return start_key
+
+_vgmdb: VGMStorage | None = None
+_vgmdb_lock = threading.Lock()
+
+# "dynamodb" or "sqlite", see api.sqlitedb for the SQLite file location
+VGM_STORAGE = os.environ.get("VGM_STORAGE", "dynamodb")
+
+def get_dynamo_resource() -> Any:
+    return boto3.resource('dynamodb', config=DYNAMO_CONFIG, endpoint_url=DYNAMO_ENDPOINT)
+
+def create_vgmdb(storage: str = None) -> VGMStorage:
+    storage = storage or VGM_STORAGE
+    if storage == "sqlite":
+        from api.sqlitedb import SQLiteVGM
+        return SQLiteVGM(check_table=False, cache=QueryCache())
+    if storage == "dynamodb":
+        return DynamoDBVGM(table_name=DYNAMO_TABLE, check_table=False, cache=QueryCache())
+    raise ValueError(f"Unknown VGM_STORAGE {storage}")
+
+def get_vgmdb() -> VGMStorage:
+    """
+    Returns the process-wide storage backend picked by VGM_STORAGE, creating it on first use.
+    Meant to be used as a FastAPI dependency. The table is not checked here, that happens once in init_vgmdb.
+    """
+    global _vgmdb
+    if _vgmdb is None:
+        with _vgmdb_lock:
+            if _vgmdb is None:
+                _vgmdb = create_vgmdb()
+    return _vgmdb
+
+def init_vgmdb() -> None:
+    # Startup hook. A failure here is logged and not raised so the vgmdb routes still come up
+    try:
+        get_vgmdb().ensure_table()
+    except Exception:
+        logger.exception("Storage table check failed on startup")
@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+
+import redis
+
+from typing import Any, Callable, TypeVar
+from redis.exceptions import RedisError, WatchError
+
+from api.redisconfig import get_redis
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Writes go through our own routes and invalidate, the TTL only bounds writes made around the API
+DB_CACHE_TTL = int(os.environ.get("DB_CACHE_TTL", 60 * 60)) #seconds
+DB_CACHE_PREFIX = "db"
+
+class QueryCache:
+    """
+    Read-through redis cache for database queries. Every cached key has a version counter next
+    to it, writers bump it when they invalidate and a reader only stores what it loaded if the
+    version did not move while it was loading. A read that raced a write is returned but not cached.
+    """
+    def __init__(self, redis_getter: Callable[[], redis.Redis] = get_redis, ttl: int = DB_CACHE_TTL, prefix: str = DB_CACHE_PREFIX) -> None:
+        self.redis_getter = redis_getter
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _keys(self, key: str) -> tuple[str, str]:
+        return f'{self.prefix}:{key}', f'{self.prefix}:version:{key}'
+
+    def read_through(self, key: str, load: Callable[[], T], encode: Callable[[T], bytes], decode: Callable[[bytes], T]) -> T:
+        redis_obj = self.redis_getter()
+        if redis_obj is None:
+            return load()
+        cache_key, version_key = self._keys(key)
+        try:
+            cached, version = redis_obj.mget(cache_key, version_key)
+        except RedisError:
+            logger.error("Redis error in reading the query cache for %s", key)
+            return load()
+        if cached is not None:
+            self._count(hit=True)
+            return decode(cached)
+
+        self._count(hit=False)
+        value = load()
+        try:
+            with redis_obj.pipeline() as pipe:
+                pipe.watch(version_key)
+                if pipe.get(version_key) == version:
+                    pipe.multi()
+                    pipe.set(cache_key, encode(value), ex=self.ttl)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+        except WatchError:
+            logger.info("Query cache for %s changed while loading, not caching", key)
+        except RedisError:
+            logger.error("Redis error in writing the query cache for %s", key)
+        return value
+
+    def invalidate(self, *keys: str) -> None:
+        redis_obj = self.redis_getter()
+        if redis_obj is None or not keys:
+            return
+        try:
+            with redis_obj.pipeline() as pipe:
+                for key in keys:
+                    cache_key, version_key = self._keys(key)
+                    pipe.incr(version_key)
+                    # Outlives any entry cached against the old version
+                    pipe.expire(version_key, self.ttl * 2)
+                    pipe.delete(cache_key)
+                pipe.execute()
+        except RedisError:
+            logger.error("Redis error in invalidating the query cache for %s", keys)
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses}
+
+def year_key(year: Any) -> str:
+    return f'year:{year}'
+
+def game_key(game: str) -> str:
+    return f'game:{game}'
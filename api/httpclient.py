@@ -0,0 +1,58 @@
+import httpx
+import asyncio
+import logging
+
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2]), otherwise stay on HTTP/1.1 keep-alive
+try:
+    import h2 # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+VGMDB_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+VGMDB_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30)
+USER_AGENT = "vgmapi (+https://github.com/iqunlim/vgmapi)"
+
+_http_client: httpx.AsyncClient | None = None
+_http_client_loop: asyncio.AbstractEventLoop | None = None
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=VGMDB_TIMEOUT,
+        limits=VGMDB_LIMITS,
+        headers={"User-Agent": USER_AGENT},
+        follow_redirects=True,
+    )
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared AsyncClient for the running event loop. The client's connection pool
+    is bound to the loop it was first used on, so a new one is made if the loop changed.
+    """
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client_loop is not loop:
+        _http_client = create_http_client()
+        _http_client_loop = loop
+    return _http_client
+
+async def close_http_client() -> None:
+    global _http_client, _http_client_loop
+    if _http_client is not None:
+        await _http_client.aclose()
+    _http_client = None
+    _http_client_loop = None
+
+@asynccontextmanager
+async def http_lifespan():
+    get_http_client()
+    logger.info("HTTP client started, http2=%s", HTTP2_AVAILABLE)
+    try:
+        yield
+    finally:
+        await close_http_client()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+
+import redis
+import redis.asyncio as aioredis
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any
+from redis.exceptions import RedisError
+
+from api.redisconfig import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+L1_MAX_ENTRIES = int(os.environ.get("VGMDB_L1_ENTRIES", 1024))
+L1_MAX_BYTES = int(os.environ.get("VGMDB_L1_BYTES", 32 * 1024 * 1024))
+L1_TTL = float(os.environ.get("VGMDB_L1_TTL", 60)) #seconds, upper bound on staleness if an invalidation is missed
+L1_INVALIDATE_CHANNEL = "vgmapi:l1:invalidate"
+L1_RECONNECT_INTERVAL = 5
+# Invalidations are published as "<worker id>|<key>" so a worker doesn't drop what it just cached itself
+WORKER_ID = uuid.uuid4().hex
+
+class L1Cache:
+    """
+    Bounded in-process LRU with per entry expiry. Entries are dropped oldest-used first
+    once either max_entries or max_bytes (the caller's size estimate) is exceeded.
+    """
+    def __init__(self, max_entries: int = L1_MAX_ENTRIES, max_bytes: int = L1_MAX_BYTES, ttl: float = L1_TTL) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, tuple[float, int, Any]] = OrderedDict() # key -> (expires at, size, value)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key: str, value: Any, size: int, ttl: float = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: str) -> None:
+        self.size -= self._entries.pop(key)[1]
+
+album_cache = L1Cache()
+
+def publish_invalidation(redis_obj: redis.Redis, key: str) -> None:
+    # Tells every other worker to drop key from its L1 cache
+    album_cache.invalidate(key)
+    try:
+        redis_obj.publish(L1_INVALIDATE_CHANNEL, f'{WORKER_ID}|{key}')
+    except RedisError:
+        logger.error("Redis error in publishing invalidation for %s", key)
+        
+async def publish_invalidation_async(redis_obj: aioredis.Redis, key: str) -> None:
+    album_cache.invalidate(key)
+    try:
+        await redis_obj.publish(L1_INVALIDATE_CHANNEL, f'{WORKER_ID}|{key}')
+    except RedisError:
+        logger.error("Redis error in publishing invalidation for %s", key)
+
+def queue_invalidation(pipe: redis.client.Pipeline | aioredis.client.Pipeline, key: str) -> None:
+    # Same as publish_invalidation, with the publish going out with the rest of a pipelined write
+    album_cache.invalidate(key)
+    pipe.publish(L1_INVALIDATE_CHANNEL, f'{WORKER_ID}|{key}')
+
+async def _invalidation_listener(cache: L1Cache) -> None:
+    while True:
+        redis_obj = get_async_redis()
+        if redis_obj is None:
+            await asyncio.sleep(L1_RECONNECT_INTERVAL)
+            continue
+        try:
+            async with redis_obj.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(L1_INVALIDATE_CHANNEL)
+                # Anything published while we were not subscribed is lost, start from empty
+                cache.clear()
+                async for message in pubsub.listen():
+                    if message and message.get('type') == 'message':
+                        data = message['data']
+                        worker_id, _, key = (data.decode() if isinstance(data, bytes) else data).partition('|')
+                        if worker_id != WORKER_ID:
+                            cache.invalidate(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("L1 invalidation listener lost its redis subscription")
+            await asyncio.sleep(L1_RECONNECT_INTERVAL)
+
+@asynccontextmanager
+async def l1_lifespan(cache: L1Cache = album_cache):
+    """
+    Keeps this worker's L1 cache coherent with the others for the lifetime of the app
+    """
+    listener = asyncio.create_task(_invalidation_listener(cache))
+    try:
+        yield
+    finally:
+        listener.cancel()
+        cache.clear()
@@ -1,22 +1,30 @@
 from fastapi import (
-    FastAPI, status, HTTPException, APIRouter, Path
+    FastAPI, status, HTTPException, APIRouter, Path, Depends, Query, Response
 )
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 import logging.config
 import json
 import os
 import socket
+import asyncio
 
 from uvicorn.workers import UvicornWorker
 
-from typing import Annotated, Union
+from typing import Annotated, Iterator, Union
 
 
 import typer
 
-from api.db import get_vgmdb, VGMInfo, VGMEntry
+from contextlib import asynccontextmanager
+
+from api.db import get_vgmdb, init_vgmdb, InvalidCursor, VGMStorage, VGMInfo, VGMEntry, BulkAddResult, BULK_ADD_MAX_ENTRIES, YEAR_PAGE_MAX
+from api.redisconfig import redis_lifespan, get_redis
+from api.httpclient import http_lifespan
+from api.l1cache import l1_lifespan
+from api.metrics import metrics_lifespan, collect_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from api.search import search_index, search_lifespan, SearchResult, SEARCH_MAX_RESULTS
 from api.vgmdbcrawl import vgmdbapi, get_game_info
 
 #TODO: Figure out why my default logging configuration just straight up does not work at all.
@@ -25,6 +33,8 @@ logger = logging.getLogger(__name__)
 
 routerv1 = APIRouter(prefix="/api")
 
+VGMDB = Annotated[VGMStorage, Depends(get_vgmdb)]
+
 #uncomment when production time comes
 '''from uvicorn.workers import UvicornWorker
 class MyUvicornWorker(UvicornWorker):
@@ -32,11 +42,31 @@ class MyUvicornWorker(UvicornWorker):
         "log_config": "/app/config/logging.json",
     }'''
 
+def stream_json_array(first: list[VGMEntry], pages: Iterator[list[VGMEntry]]) -> Iterator[bytes]:
+    # One chunk per DynamoDB page. A failure part way leaves the array unclosed so the client can tell
+    yield b"[" + b",".join(entry.model_dump_json().encode() for entry in first)
+    try:
+        for page in pages:
+            if page:
+                yield b"," + b",".join(entry.model_dump_json().encode() for entry in page)
+    except Exception:
+        logger.exception("Exception occured in streaming a year")
+        return
+    yield b"]"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Process-wide clients live here so requests don't have to build their own
+    await asyncio.to_thread(init_vgmdb)
+    async with redis_lifespan(), http_lifespan(), l1_lifespan(), metrics_lifespan(), search_lifespan(get_vgmdb()):
+        yield
+
 def create_app() -> FastAPI:
     
     app = FastAPI(
         docs_url="/api/docs", 
         redoc_url=None,
+        lifespan=lifespan,
     )
     
     with open(os.path.dirname(os.path.realpath(__file__)) + '/config/logging.json') as config_in:
@@ -52,10 +82,14 @@ def create_app() -> FastAPI:
     async def testing():
         return {"Hostname":socket.gethostname()}
     
+    @app.get('/metrics', include_in_schema=False)
+    def metrics():
+        # Prometheus scrape target, every worker answers for all of them
+        return Response(content=collect_metrics(get_redis()), media_type=METRICS_CONTENT_TYPE)
+    
     @routerv1.get('/game/{game_name}', response_model=Union[VGMEntry, dict])
-    def get_game_api(game_name: Annotated[str, Path()]):
+    def get_game_api(game_name: Annotated[str, Path()], db: VGMDB):
         try:
-            db = get_vgmdb()
             response = db.query_game(game_name)
         except Exception as e:
             logger.exception("Exception occured in get_year_api")
@@ -63,22 +97,54 @@ def create_app() -> FastAPI:
         return response
     
     @routerv1.get('/year/{year}', response_model=list[VGMEntry])
-    def get_year_api(year: str):
-        db = get_vgmdb()
+    def get_year_api(year: str, db: VGMDB, response: Response, limit: Annotated[int | None, Query(ge=1, le=YEAR_PAGE_MAX)] = None,
+                     cursor: str | None = None, stream: int = 0):
+        """
+        The whole year by default. With limit and/or cursor one page is returned and the cursor
+        for the next one is in the X-Next-Cursor header. stream=1 writes the year out as a JSON
+        array page by page instead of building it in memory first.
+        """
         try:
-            response = db.query_year(year)
+            if stream == 1:
+                pages = db.iter_year_pages(year, limit)
+                # The first page is read here so a missing year is still a 404 and not an empty stream
+                first = next((page for page in pages if page), None)
+                if first is None:
+                    raise HTTPException(status_code=404, detail="Item not found")
+                return StreamingResponse(stream_json_array(first, pages), media_type="application/json")
+            if limit is None and cursor is None:
+                entries = db.query_year(year)
+            else:
+                entries, next_cursor = db.query_year_page(year, limit, cursor)
+                if next_cursor:
+                    response.headers["X-Next-Cursor"] = next_cursor
+        except HTTPException:
+            raise
+        except InvalidCursor:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
         except Exception as e:
             logger.exception("Exception occured in get_year_api")
             raise HTTPException(status_code=500, detail="Database Error")
         else:
-            if response == []:
+            # A later page can come back empty, only a year with nothing at all is missing
+            if entries == [] and cursor is None:
                 raise HTTPException(status_code=404, detail="Item not found")
-            return response
+            return entries
+        
+    @routerv1.get('/search', response_model=list[SearchResult])
+    def search_api(q: Annotated[str, Query(min_length=1, max_length=200)], response: Response,
+                   limit: Annotated[int, Query(ge=1, le=SEARCH_MAX_RESULTS)] = 20):
+        """
+        Ranked search over game names, track titles and credits. Prefixes and single typos match too.
+        While the index is still being built on startup results can be incomplete, X-Search-Index says so.
+        """
+        if not search_index.ready:
+            response.headers["X-Search-Index"] = "building"
+        return search_index.search(q, limit)
         
     @routerv1.put('/update', response_model=VGMEntry)
-    def update_game_api(data: VGMEntry):
+    def update_game_api(data: VGMEntry, db: VGMDB):
         try:
-            db = get_vgmdb()
             response = db.update(data)
         except Exception as e:
             logger.exception("Exception occured in update_game_api")
@@ -87,19 +153,29 @@ def create_app() -> FastAPI:
             return response
         
     @routerv1.post('/rawadd', response_model=VGMEntry)
-    def add_vgm_entry(data: VGMEntry):
+    def add_vgm_entry(data: VGMEntry, db: VGMDB):
         try:
-            db = get_vgmdb()
             response = db.add(data)
         except Exception as e:
             logger.exception("Exception occured in get_year_api")
         else:
             return data
     
+    @routerv1.post('/bulkadd', response_model=list[BulkAddResult])
+    def bulk_add_vgm_entries(data: list[VGMEntry], db: VGMDB):
+        if len(data) > BULK_ADD_MAX_ENTRIES:
+            raise HTTPException(status_code=413, detail=f"At most {BULK_ADD_MAX_ENTRIES} entries per request")
+        try:
+            response = db.add_many(data)
+        except Exception as e:
+            logger.exception("Exception occured in bulk_add_vgm_entries")
+            raise HTTPException(status_code=500, detail="Database Error")
+        else:
+            return response
+    
     @routerv1.delete('/delete', response_model=VGMEntry)
-    def delete_game_api(data: VGMEntry):
+    def delete_game_api(data: VGMEntry, db: VGMDB):
         try:
-            db = get_vgmdb()
             response = db.delete(data)
         except Exception as e:
             logger.exception("Exception occured in delete_game_api")
@@ -108,7 +184,7 @@ def create_app() -> FastAPI:
             return response
         
     @routerv1.post('/add/{catalog}')
-    def add_game_to_db_from_vgmdb(catalog:str, data: VGMInfo):
+    def add_game_to_db_from_vgmdb(catalog:str, data: VGMInfo, db: VGMDB):
         try:
             response = get_game_info(catalog, convert=1)
             logger.info("Response: %s", str(response))
@@ -117,7 +193,6 @@ def create_app() -> FastAPI:
             response.extras = data.extras if data.extras else None
 
             
-            db = get_vgmdb()
             db.add(response)
             
         except:
@@ -0,0 +1,265 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+import redis
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Iterable
+from redis.exceptions import RedisError
+
+from api.l1cache import WORKER_ID
+from api.redisconfig import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Every worker process keeps its own metrics in memory and writes a snapshot to redis every
+# METRICS_FLUSH_INTERVAL. /metrics adds up the live snapshots of all workers, a worker that stops
+# flushing drops out after METRICS_TTL
+METRICS_PREFIX = "metrics"
+# Worker id -> its latest snapshot, and worker id -> when that snapshot stops counting. A scrape reads
+# only these two keys, never scans the keyspace the album cache shares
+METRICS_SNAPSHOTS_KEY = f'{METRICS_PREFIX}:workers'
+METRICS_EXPIRY_KEY = f'{METRICS_PREFIX}:workers:expiry'
+METRICS_FLUSH_INTERVAL = float(os.environ.get("VGMAPI_METRICS_FLUSH", 10)) #seconds
+METRICS_TTL = int(METRICS_FLUSH_INTERVAL * 3)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# From half a millisecond for an L1 hit up to an upstream fetch that hit its timeout
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            values = {json.dumps(labels): value for labels, value in self._values.items()}
+        return {"type": "counter", "help": self.help, "labelnames": self.labelnames, "values": values}
+
+class Histogram:
+    """
+    Cumulative buckets like a prometheus_client Histogram. An observation is a bisect and an add
+    under a lock, cheap enough for every request.
+    """
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = STAGE_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per bucket counts with +Inf last, sum]
+        self._values: dict[tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            values = {json.dumps(labels): [list(counts), total] for labels, (counts, total) in self._values.items()}
+        return {"type": "histogram", "help": self.help, "labelnames": self.labelnames, "buckets": self.buckets, "values": values}
+
+# Timers running in this thread or task. A timer inside another one for the same stage observes nothing,
+# the outer one already covers its time and counting it again would double it in the histogram
+_running_timers: ContextVar[frozenset] = ContextVar("running_timers", default=frozenset())
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start", "token")
+
+    def __init__(self, histogram: Histogram, labels: tuple[str, ...]) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        running = _running_timers.get()
+        key = (self.histogram.name, self.labels)
+        self.token = None if key in running else _running_timers.set(running | {key})
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.token is None:
+            return
+        _running_timers.reset(self.token)
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Counter | Histogram] = {}
+
+    def register(self, metric: Counter | Histogram) -> Counter | Histogram:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self) -> None:
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+REGISTRY = MetricsRegistry()
+
+stage_seconds = REGISTRY.register(Histogram(
+    "vgmapi_stage_seconds", "Time spent in each stage of looking up a vgmdb album", ["stage"]))
+cache_requests = REGISTRY.register(Counter(
+    "vgmapi_cache_requests_total", "vgmdb album lookups by how the cache answered them", ["result"]))
+upstream_responses = REGISTRY.register(Counter(
+    "vgmapi_upstream_responses_total", "vgmdb requests by status code, or why there was none", ["status"]))
+
+def time_stage(stage: str) -> _Timer:
+    # with time_stage("parse"): ...
+    return stage_seconds.time(stage)
+
+def timed(stage: str) -> Callable:
+    # Decorator form of time_stage, for whole functions
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage_seconds.time(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def merge_snapshots(snapshots: Iterable[dict[str, dict[str, Any]]]) -> dict[str, dict[str, Any]]:
+    merged: dict[str, dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.get(name)
+            if target is None:
+                merged[name] = {**metric, "values": dict(metric["values"])}
+                continue
+            if metric["type"] != target["type"] or list(metric.get("buckets", ())) != list(target.get("buckets", ())):
+                # A worker on another version of the metric, its numbers can't be added to these
+                continue
+            for labels, value in metric["values"].items():
+                current = target["values"].get(labels)
+                if current is None:
+                    target["values"][labels] = value
+                elif metric["type"] == "counter":
+                    target["values"][labels] = current + value
+                else:
+                    target["values"][labels] = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1]]
+    return merged
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_text(labelnames: Iterable[str], labels: Iterable[str], le: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(merged: dict[str, dict[str, Any]]) -> str:
+    """
+    Prometheus text exposition format
+    """
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key, value in sorted(metric["values"].items()):
+            labels = json.loads(key)
+            if metric["type"] == "counter":
+                lines.append(f"{name}{_label_text(metric['labelnames'], labels)} {_number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(metric["buckets"]) + [float("inf")], counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_label_text(metric['labelnames'], labels, _number(float(bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(metric['labelnames'], labels)} {_number(float(total))}")
+            lines.append(f"{name}_count{_label_text(metric['labelnames'], labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def flush_metrics(redis_obj: redis.Redis, registry: MetricsRegistry = REGISTRY, worker_id: str = WORKER_ID) -> None:
+    try:
+        with redis_obj.pipeline() as pipe:
+            pipe.hset(METRICS_SNAPSHOTS_KEY, worker_id, json.dumps(registry.snapshot()))
+            pipe.zadd(METRICS_EXPIRY_KEY, {worker_id: time.time() + METRICS_TTL})
+            # Both go away on their own once every worker has stopped
+            pipe.expire(METRICS_SNAPSHOTS_KEY, METRICS_TTL)
+            pipe.expire(METRICS_EXPIRY_KEY, METRICS_TTL)
+            pipe.execute()
+    except RedisError:
+        logger.error("Redis error in flushing metrics")
+
+def _live_workers(redis_obj: redis.Redis) -> list[bytes]:
+    # Workers that stopped flushing are pruned here by whoever scrapes next
+    now = time.time()
+    expired = redis_obj.zrangebyscore(METRICS_EXPIRY_KEY, "-inf", now)
+    if expired:
+        with redis_obj.pipeline() as pipe:
+            pipe.hdel(METRICS_SNAPSHOTS_KEY, *expired)
+            pipe.zremrangebyscore(METRICS_EXPIRY_KEY, "-inf", now)
+            pipe.execute()
+    return redis_obj.zrangebyscore(METRICS_EXPIRY_KEY, now, "+inf")
+
+def collect_metrics(redis_obj: redis.Redis = None, registry: MetricsRegistry = REGISTRY) -> str:
+    """
+    This worker's metrics added up with the latest snapshot of every other live worker
+    """
+    snapshots = [registry.snapshot()]
+    if redis_obj is not None:
+        try:
+            own_id = WORKER_ID.encode()
+            workers = [worker for worker in _live_workers(redis_obj) if worker != own_id]
+            if workers:
+                snapshots.extend(json.loads(raw) for raw in redis_obj.hmget(METRICS_SNAPSHOTS_KEY, workers) if raw is not None)
+        except RedisError:
+            logger.error("Redis error in collecting metrics of other workers, only this worker's are returned")
+    return render(merge_snapshots(snapshots))
+
+async def _flusher(registry: MetricsRegistry) -> None:
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        redis_obj = get_redis()
+        if redis_obj is not None:
+            await asyncio.to_thread(flush_metrics, redis_obj, registry)
+
+@asynccontextmanager
+async def metrics_lifespan(registry: MetricsRegistry = REGISTRY):
+    """
+    Publishes this worker's metrics for the others' /metrics for the lifetime of the app
+    """
+    flusher = asyncio.create_task(_flusher(registry))
+    try:
+        yield
+    finally:
+        flusher.cancel()
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import redis
+import redis.asyncio as aioredis
+
+from email.utils import parsedate_to_datetime
+from redis.exceptions import RedisError, WatchError
+
+logger = logging.getLogger(__name__)
+
+# Shared by every worker and task talking to the same redis, so these are totals for the whole deployment
+VGMDB_RATE = float(os.environ.get("VGMDB_RATE", 5)) #requests per second
+VGMDB_BURST = int(os.environ.get("VGMDB_BURST", 10))
+ACQUIRE_TIMEOUT = float(os.environ.get("VGMDB_ACQUIRE_TIMEOUT", 30)) #seconds a fetch waits for a token before giving up
+BACKOFF_BASE = 1.0 #seconds, doubled for every upstream error in a row
+BACKOFF_MAX = 300.0
+RATELIMIT_PREFIX = "vgmdb:ratelimit"
+
+def is_upstream_error(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Retry-After as seconds from now, it is either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class RateLimitTimeout(Exception):
+    """
+    Raised when no token came free within the acquire timeout
+    """
+
+class TokenBucket:
+    """
+    Token bucket kept in redis under prefix:bucket, with a shared "nobody fetches until"
+    time in prefix:backoff that upstream 429/5xx answers push out. Falls back to a
+    process-local bucket when redis is not available so fetches are never unlimited.
+    Updates are WATCH/MULTI transactions, fakeredis has no Lua.
+    """
+    def __init__(self, rate: float = VGMDB_RATE, burst: int = VGMDB_BURST, prefix: str = RATELIMIT_PREFIX,
+                 backoff_base: float = BACKOFF_BASE, backoff_max: float = BACKOFF_MAX) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket_key = f'{prefix}:bucket'
+        self.backoff_key = f'{prefix}:backoff'
+        self.failures_key = f'{prefix}:failures'
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._local = {"tokens": float(self.burst), "updated": time.time(), "backoff": 0.0, "failures": 0}
+            self._stats = {
+                "acquired": 0,
+                "waited": 0,
+                "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0,
+                "timeouts": 0,
+                "upstream_errors": 0,
+                "last_backoff_seconds": 0.0,
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _take(self, tokens: float | None, updated: float | None, backoff_until: float | None, now: float) -> tuple[float, float]:
+        """
+        Returns (seconds to wait, tokens left). A token is only taken when the wait is 0.
+        """
+        if backoff_until and backoff_until > now:
+            return backoff_until - now, tokens if tokens is not None else float(self.burst)
+        if tokens is None or updated is None:
+            tokens = float(self.burst)
+        else:
+            # Clamped, another host's clock may be slightly ahead of ours
+            tokens = min(float(self.burst), tokens + max(now - updated, 0.0) * self.rate)
+        if tokens >= 1:
+            return 0.0, tokens - 1
+        return (1 - tokens) / self.rate, tokens
+
+    def _try_local(self) -> float:
+        with self._lock:
+            now = time.time()
+            wait, tokens = self._take(self._local["tokens"], self._local["updated"], self._local["backoff"], now)
+            if wait == 0:
+                self._local["tokens"] = tokens
+                self._local["updated"] = now
+            return wait
+
+    def _try_redis(self, redis_obj: redis.Redis) -> float:
+        with redis_obj.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.bucket_key, self.backoff_key)
+                    tokens, updated = pipe.hmget(self.bucket_key, "tokens", "updated")
+                    backoff_until = pipe.get(self.backoff_key)
+                    now = time.time()
+                    wait, tokens = self._take(_float(tokens), _float(updated), _float(backoff_until), now)
+                    if wait > 0:
+                        pipe.unwatch()
+                        return wait
+                    pipe.multi()
+                    pipe.hset(self.bucket_key, mapping={"tokens": tokens, "updated": now})
+                    pipe.expire(self.bucket_key, self._bucket_ttl())
+                    pipe.execute()
+                    return 0.0
+                except WatchError:
+                    continue
+
+    async def _try_redis_async(self, redis_obj: aioredis.Redis) -> float:
+        async with redis_obj.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(self.bucket_key, self.backoff_key)
+                    tokens, updated = await pipe.hmget(self.bucket_key, "tokens", "updated")
+                    backoff_until = await pipe.get(self.backoff_key)
+                    now = time.time()
+                    wait, tokens = self._take(_float(tokens), _float(updated), _float(backoff_until), now)
+                    if wait > 0:
+                        await pipe.unwatch()
+                        return wait
+                    pipe.multi()
+                    pipe.hset(self.bucket_key, mapping={"tokens": tokens, "updated": now})
+                    pipe.expire(self.bucket_key, self._bucket_ttl())
+                    await pipe.execute()
+                    return 0.0
+                except WatchError:
+                    continue
+
+    def _bucket_ttl(self) -> int:
+        # An idle bucket refills completely in burst/rate seconds, after that the key is not needed
+        return max(int(self.burst / self.rate) + 1, 1) if self.rate > 0 else 3600
+
+    def _next_wait(self, wait: float, waited: float, timeout: float) -> float:
+        if waited + wait > timeout:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise RateLimitTimeout(f"No vgmdb request slot within {timeout}s")
+        # Jittered so the workers that were all waiting on the same moment don't all retry together
+        return wait * random.uniform(1.0, 1.25)
+
+    def _record_wait(self, waited: float) -> None:
+        with self._lock:
+            self._stats["acquired"] += 1
+            if waited > 0:
+                self._stats["waited"] += 1
+                self._stats["wait_seconds_total"] += waited
+                self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+
+    def acquire(self, redis_obj: redis.Redis = None, timeout: float = ACQUIRE_TIMEOUT) -> float:
+        """
+        Blocks until a request to vgmdb may go out and returns the seconds spent waiting.
+        Raises RateLimitTimeout if that would take longer than timeout.
+        """
+        waited = 0.0
+        while True:
+            try:
+                wait = self._try_redis(redis_obj) if redis_obj is not None else self._try_local()
+            except RedisError:
+                logger.error("Redis error in acquiring a vgmdb request slot, using the local limiter")
+                redis_obj = None
+                continue
+            if wait == 0:
+                self._record_wait(waited)
+                return waited
+            wait = self._next_wait(wait, waited, timeout)
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, redis_obj: aioredis.Redis = None, timeout: float = ACQUIRE_TIMEOUT) -> float:
+        waited = 0.0
+        while True:
+            try:
+                wait = await self._try_redis_async(redis_obj) if redis_obj is not None else self._try_local()
+            except RedisError:
+                logger.error("Redis error in acquiring a vgmdb request slot, using the local limiter")
+                redis_obj = None
+                continue
+            if wait == 0:
+                self._record_wait(waited)
+                return waited
+            wait = self._next_wait(wait, waited, timeout)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def _backoff_seconds(self, failures: int, retry_after: float | None) -> float:
+        # Full jitter on the exponential delay, Retry-After from vgmdb is a floor
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (failures - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        with self._lock:
+            self._stats["upstream_errors"] += 1
+            self._stats["last_backoff_seconds"] = delay
+        return delay
+
+    def record_response(self, redis_obj: redis.Redis, status_code: int, retry_after: str = None) -> None:
+        """
+        Feeds an upstream answer back into the limiter. 429/5xx push the shared backoff out,
+        anything else clears the run of failures.
+        """
+        try:
+            if redis_obj is None:
+                self._record_local(status_code, retry_after)
+            elif is_upstream_error(status_code):
+                failures = redis_obj.incr(self.failures_key)
+                redis_obj.expire(self.failures_key, int(self.backoff_max) * 2)
+                delay = self._backoff_seconds(failures, parse_retry_after(retry_after))
+                self._push_backoff(redis_obj, time.time() + delay)
+            else:
+                redis_obj.delete(self.failures_key)
+        except RedisError:
+            logger.error("Redis error in recording vgmdb response %s", status_code)
+            self._record_local(status_code, retry_after)
+
+    async def record_response_async(self, redis_obj: aioredis.Redis, status_code: int, retry_after: str = None) -> None:
+        try:
+            if redis_obj is None:
+                self._record_local(status_code, retry_after)
+            elif is_upstream_error(status_code):
+                failures = await redis_obj.incr(self.failures_key)
+                await redis_obj.expire(self.failures_key, int(self.backoff_max) * 2)
+                delay = self._backoff_seconds(failures, parse_retry_after(retry_after))
+                await self._push_backoff_async(redis_obj, time.time() + delay)
+            else:
+                await redis_obj.delete(self.failures_key)
+        except RedisError:
+            logger.error("Redis error in recording vgmdb response %s", status_code)
+            self._record_local(status_code, retry_after)
+
+    def _record_local(self, status_code: int, retry_after: str = None) -> None:
+        if not is_upstream_error(status_code):
+            with self._lock:
+                self._local["failures"] = 0
+            return
+        with self._lock:
+            self._local["failures"] += 1
+            failures = self._local["failures"]
+        delay = self._backoff_seconds(failures, parse_retry_after(retry_after))
+        with self._lock:
+            self._local["backoff"] = max(self._local["backoff"], time.time() + delay)
+
+    def _push_backoff(self, redis_obj: redis.Redis, until: float) -> None:
+        # Only ever moved later, a short backoff must not cut a longer one from another worker short
+        with redis_obj.pipeline() as pipe:
+            try:
+                pipe.watch(self.backoff_key)
+                current = _float(pipe.get(self.backoff_key))
+                if current is not None and current >= until:
+                    pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.set(self.backoff_key, until, px=max(int((until - time.time()) * 1000), 1))
+                pipe.execute()
+            except WatchError:
+                pass
+
+    async def _push_backoff_async(self, redis_obj: aioredis.Redis, until: float) -> None:
+        async with redis_obj.pipeline() as pipe:
+            try:
+                await pipe.watch(self.backoff_key)
+                current = _float(await pipe.get(self.backoff_key))
+                if current is not None and current >= until:
+                    await pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.set(self.backoff_key, until, px=max(int((until - time.time()) * 1000), 1))
+                await pipe.execute()
+            except WatchError:
+                pass
+
+def _float(value) -> float | None:
+    return None if value is None else float(value)
+
+vgmdb_limiter = TokenBucket()
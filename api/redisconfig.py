@@ -1,29 +1,168 @@
 import redis
+import redis.asyncio as aioredis
 import json
 import os
+import asyncio
+import threading
 #Configure redis here.
 import logging
 
+from contextlib import asynccontextmanager
+
 CONFIG_FILE = '/config/redis.json'
+MAX_CONNECTIONS = 32
+HEALTH_CHECK_INTERVAL = 30 #seconds
+# How long a request waits for a free pooled connection. Past that the pool raises redis ConnectionError,
+# a RedisError like any other, and the request carries on without the cache as it does when redis is down
+POOL_TIMEOUT = float(os.environ.get("VGMDB_REDIS_POOL_TIMEOUT", 1)) #seconds
 
 logger = logging.getLogger(__name__)
 
+# One pool/client per worker process. Set up by redis_lifespan or lazily by get_redis
+_redis_client: redis.Redis | None = None
+_redis_healthy: bool = False
+_redis_lock = threading.Lock()
+_async_redis_client: aioredis.Redis | None = None
+_async_redis_loop: asyncio.AbstractEventLoop | None = None
+
+def load_redis_settings(config_file: str=CONFIG_FILE) -> dict:
+    with open(os.path.dirname(os.path.realpath(__file__)) + config_file) as config:
+        return json.load(config)['redis_settings']
+
+def pool_settings(settings: dict) -> dict:
+    settings = dict(settings)
+    settings.setdefault('max_connections', MAX_CONNECTIONS)
+    settings.setdefault('health_check_interval', HEALTH_CHECK_INTERVAL)
+    settings.setdefault('timeout', POOL_TIMEOUT)
+    return settings
+
+def init_redis(config_file: str=CONFIG_FILE, connection_pool: redis.ConnectionPool=None) -> redis.Redis:
+    """
+    Builds the process-wide redis client on top of a bounded ConnectionPool and does
+    a single handshake to decide if the cache is usable. Safe to call more than once,
+    the existing client is returned if there is one.
+    connection_pool: optional, use this pool instead of the one from the config file.
+    """
+    global _redis_client, _redis_healthy
+    with _redis_lock:
+        if _redis_client is not None:
+            return _redis_client
+
+        if connection_pool is None:
+            connection_pool = redis.BlockingConnectionPool(**pool_settings(load_redis_settings(config_file)))
+
+        _redis_client = redis.Redis(connection_pool=connection_pool)
+        _redis_healthy = check_redis()
+        if _redis_healthy:
+            logger.info("Redis connection established to %s", connection_pool.connection_kwargs.get('host'))
+        else:
+            logger.error("Exception in connecting to redis database, running without cache")
+        return _redis_client
+
+def check_redis() -> bool:
+    """
+    Pings the shared client and records the result. Used by the background health checker,
+    never on the request path.
+    """
+    global _redis_healthy
+    if _redis_client is None:
+        return False
+    try:
+        _redis_client.ping()
+        _redis_healthy = True
+    except Exception:
+        _redis_healthy = False
+    return _redis_healthy
+
+def close_redis() -> None:
+    global _redis_client, _redis_healthy
+    with _redis_lock:
+        if _redis_client is not None:
+            _redis_client.connection_pool.disconnect()
+        _redis_client = None
+        _redis_healthy = False
+
 def get_redis(config_file: str=CONFIG_FILE) -> redis.Redis:
     """
-    returns a redis.Redis object if the server can be connected to from the config file settings,
+    returns the shared redis.Redis object if the last health check passed,
     if it cannot be connected to or if there is some other error it will return None.
+    No handshake is done here after the first call, see check_redis.
     If local ENV API_NOCACHE=1 then it will return None. Used in the dockerfiles
     """
     if os.environ.get("API_NOCACHE", "0") == "1":
         return None
-    
-    with open(os.path.dirname(os.path.realpath(__file__)) + config_file) as config:
-        settings = json.load(config)['redis_settings']
+
+    if _redis_client is None:
+        try:
+            init_redis(config_file)
+        except Exception:
+            logger.exception("Exception in creating the redis connection pool")
+            return None
+
+    return _redis_client if _redis_healthy else None
+
+def init_async_redis(config_file: str=CONFIG_FILE, connection_pool: aioredis.ConnectionPool=None) -> aioredis.Redis:
+    """
+    Builds the asyncio redis client for the running event loop. Must be called from inside the loop.
+    connection_pool: optional, use this pool instead of the one from the config file.
+    """
+    global _async_redis_client, _async_redis_loop
+    if connection_pool is None:
+        connection_pool = aioredis.BlockingConnectionPool(**pool_settings(load_redis_settings(config_file)))
+    _async_redis_client = aioredis.Redis(connection_pool=connection_pool)
+    _async_redis_loop = asyncio.get_running_loop()
+    return _async_redis_client
+
+def get_async_redis(config_file: str=CONFIG_FILE) -> aioredis.Redis:
+    """
+    async twin of get_redis. Shares its health flag so there is no handshake here either,
+    returns None when the cache is off or unhealthy.
+    """
+    if get_redis(config_file) is None:
+        return None
+    if _async_redis_client is None or _async_redis_loop is not asyncio.get_running_loop():
+        try:
+            init_async_redis(config_file)
+        except Exception:
+            logger.exception("Exception in creating the async redis connection pool")
+            return None
+    return _async_redis_client
+
+async def close_async_redis() -> None:
+    global _async_redis_client, _async_redis_loop
+    if _async_redis_client is not None:
+        await _async_redis_client.aclose()
+    _async_redis_client = None
+    _async_redis_loop = None
+
+async def _health_check_loop(interval: float) -> None:
+    was_healthy = _redis_healthy
+    while True:
+        await asyncio.sleep(interval)
+        healthy = await asyncio.to_thread(check_redis)
+        if healthy != was_healthy:
+            logger.warning("Redis health changed, cache is now %s", "on" if healthy else "off")
+        was_healthy = healthy
+
+@asynccontextmanager
+async def redis_lifespan(interval: float=HEALTH_CHECK_INTERVAL):
+    """
+    Ties the shared redis client to the FastAPI lifespan: connects on startup,
+    health checks in the background and releases the pool on shutdown.
+    """
+    if os.environ.get("API_NOCACHE", "0") == "1":
+        yield
+        return
+
     try:
-        return_obj = redis.Redis(**settings)
-        return_obj.client_info() #handshake check to make sure redis is live.
-        logger.info("Redis connection established to %s on port %s", settings.get('host'), settings.get('port'))
+        await asyncio.to_thread(init_redis)
     except Exception:
-        logger.error("Exception in connecting to redis database")
-        return_obj = None
-    return return_obj
\ No newline at end of file
+        logger.exception("Exception in creating the redis connection pool")
+
+    health_task = asyncio.create_task(_health_check_loop(interval))
+    try:
+        yield
+    finally:
+        health_task.cancel()
+        await close_async_redis()
+        close_redis()
@@ -0,0 +1,352 @@
+import asyncio
+import bisect
+import json
+import logging
+import re
+import threading
+import unicodedata
+
+import redis
+
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+
+from api.db import VGMEntry, VGMStorage
+from api.l1cache import WORKER_ID
+from api.redisconfig import get_redis, get_async_redis
+from api.vgmdbcrawl import album_observers, read_cached_albums
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CHANNEL = "vgmapi:search:update"
+SEARCH_RECONNECT_INTERVAL = 5
+SEARCH_MAX_RESULTS = 50
+CREDITS_SCAN_BATCH = 100
+
+# A token matching the game name counts for more than one in a track title or the credits
+FIELD_WEIGHTS = {"game": 3.0, "track": 2.0, "credit": 1.0}
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.6
+FUZZY_MATCH = 0.4
+PREFIX_MIN_LENGTH = 2 #query tokens shorter than this only match exactly
+FUZZY_MIN_LENGTH = 4 #and shorter than this don't match with typos
+PREFIX_EXPANSIONS = 50 #most vocabulary tokens a single prefix expands to
+
+_WORD = re.compile(r"\w+")
+
+DocKey = tuple[int, str] # (year_listened, game)
+
+def tokenize(text: str | None) -> list[str]:
+    # Lowercased, accents folded so "pokemon" finds "Pokémon"
+    if not text:
+        return []
+    folded = unicodedata.normalize("NFKD", text.casefold())
+    return _WORD.findall("".join(char for char in folded if not unicodedata.combining(char)))
+
+def _deletions(token: str) -> set[str]:
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+def _within_one_edit(a: str, b: str) -> bool:
+    # One insertion, deletion, substitution or swap of neighbours
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diffs = [i for i in range(len(a)) if a[i] != b[i]]
+        return len(diffs) == 1 or (len(diffs) == 2 and diffs[1] == diffs[0] + 1 and a[diffs[0]] == b[diffs[1]] and a[diffs[1]] == b[diffs[0]])
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+    i = 0
+    while i < len(shorter) and shorter[i] == longer[i]:
+        i += 1
+    return shorter[i:] == longer[i + 1:]
+
+class SearchResult(BaseModel):
+    year_listened: int
+    game: str
+    catalog_num: str
+    score: float
+    tracks: list[str] = [] # track titles that matched the query
+
+class SearchIndex:
+    """
+    In-memory inverted index over game names, track titles and credits of the library.
+    token -> {entry: weight} postings, a sorted vocabulary for prefix matches and a
+    single-deletion index for matches one typo away. Every query token has to match.
+    """
+    def __init__(self) -> None:
+        self._docs: dict[DocKey, dict] = {}
+        self._postings: dict[str, dict[DocKey, float]] = {}
+        self._vocabulary: list[str] = []
+        self._deletes: dict[str, set[str]] = {}
+        self._credits: dict[str, list[str]] = {} # catalog_num -> credited names
+        self._lock = threading.RLock()
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._docs.clear()
+            self._postings.clear()
+            self._vocabulary.clear()
+            self._deletes.clear()
+            self._credits.clear()
+            self.ready = False
+
+    def upsert(self, entry: VGMEntry, keep_tracks: bool = False) -> None:
+        """
+        keep_tracks: for update() writes, which never touch the stored tracks. The ones already indexed are kept
+        """
+        key = (int(entry.year_listened), entry.game)
+        with self._lock:
+            previous = self._docs.get(key)
+            if keep_tracks or entry.tracks is None:
+                tracks = previous["tracks"] if previous else []
+            else:
+                tracks = [track.title for track in entry.tracks]
+            if previous is not None:
+                self._unindex(key)
+            doc = {"catalog_num": entry.catalog_num, "tracks": tracks}
+            self._docs[key] = doc
+            self._index(key, doc)
+
+    def remove(self, year_listened: int, game: str) -> None:
+        key = (int(year_listened), game)
+        with self._lock:
+            if key in self._docs:
+                self._unindex(key)
+                del self._docs[key]
+
+    def set_credits(self, catalog_num: str, credits: list[str]) -> None:
+        with self._lock:
+            if credits:
+                self._credits[catalog_num] = credits
+            elif self._credits.pop(catalog_num, None) is None:
+                return
+            for key, doc in self._docs.items():
+                if doc["catalog_num"] == catalog_num:
+                    self._unindex(key)
+                    self._index(key, doc)
+
+    def _doc_tokens(self, key: DocKey, doc: dict) -> dict[str, float]:
+        weights: dict[str, float] = {}
+        fields = (
+            ("game", [key[1]]),
+            ("track", doc["tracks"]),
+            ("credit", self._credits.get(doc["catalog_num"], [])),
+        )
+        for field, texts in fields:
+            for text in texts:
+                for token in tokenize(text):
+                    weights[token] = max(weights.get(token, 0.0), FIELD_WEIGHTS[field])
+        return weights
+
+    def _index(self, key: DocKey, doc: dict) -> None:
+        doc["tokens"] = self._doc_tokens(key, doc)
+        for token, weight in doc["tokens"].items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+                for deletion in _deletions(token) | {token}:
+                    self._deletes.setdefault(deletion, set()).add(token)
+            postings[key] = weight
+
+    def _unindex(self, key: DocKey) -> None:
+        for token in self._docs[key].get("tokens", {}):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(key, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+                for deletion in _deletions(token) | {token}:
+                    tokens = self._deletes.get(deletion)
+                    if tokens is not None:
+                        tokens.discard(token)
+                        if not tokens:
+                            del self._deletes[deletion]
+
+    def _expand(self, token: str) -> dict[str, float]:
+        # Vocabulary tokens a query token matches, with how well they match
+        matches: dict[str, float] = {}
+        if token in self._postings:
+            matches[token] = EXACT_MATCH
+        if len(token) >= PREFIX_MIN_LENGTH:
+            start = bisect.bisect_left(self._vocabulary, token)
+            for candidate in self._vocabulary[start:start + PREFIX_EXPANSIONS]:
+                if not candidate.startswith(token):
+                    break
+                if candidate != token:
+                    # Completions closer to the typed length rank higher
+                    matches[candidate] = PREFIX_MATCH * (0.5 + 0.5 * len(token) / len(candidate))
+        if len(token) >= FUZZY_MIN_LENGTH:
+            for deletion in _deletions(token) | {token}:
+                for candidate in self._deletes.get(deletion, ()):
+                    if candidate not in matches and _within_one_edit(token, candidate):
+                        matches[candidate] = FUZZY_MATCH
+        return matches
+
+    def search(self, query: str, limit: int = 20) -> list[SearchResult]:
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+        with self._lock:
+            scores: dict[DocKey, float] | None = None
+            matched: set[str] = set()
+            for query_token in query_tokens:
+                token_scores: dict[DocKey, float] = {}
+                for token, match in self._expand(query_token).items():
+                    matched.add(token)
+                    for key, weight in self._postings[token].items():
+                        token_scores[key] = max(token_scores.get(key, 0.0), match * weight)
+                scores = token_scores if scores is None else {key: scores[key] + score for key, score in token_scores.items() if key in scores}
+                if not scores:
+                    return []
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0][1], item[0][0]))[:limit]
+            return [
+                SearchResult(
+                    year_listened=key[0], game=key[1], catalog_num=self._docs[key]["catalog_num"], score=round(score, 4),
+                    tracks=[title for title in self._docs[key]["tracks"] if matched.intersection(tokenize(title))],
+                )
+                for key, score in ranked
+            ]
+
+    def apply(self, op: str, entries: list[VGMEntry]) -> None:
+        for entry in entries:
+            if op == "delete":
+                self.remove(entry.year_listened, entry.game)
+            else:
+                self.upsert(entry, keep_tracks=op == "update")
+
+    def build(self, storage: VGMStorage, redis_obj: redis.Redis = None) -> None:
+        """
+        Fills the index from every stored entry and the credits of every album in the vgmdb cache.
+        Writes that happen while this runs are applied as they come, so nothing is lost.
+        """
+        try:
+            if redis_obj is not None:
+                load_cached_credits(self, redis_obj)
+            for page in storage.iter_all_pages():
+                for entry in page:
+                    self.upsert(entry)
+            logger.info("Search index built with %s entries", len(self))
+        except Exception:
+            logger.exception("Error in building the search index, it only has what was written since startup")
+        finally:
+            self.ready = True
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._docs), "tokens": len(self._postings), "credited_albums": len(self._credits)}
+
+def album_credits(album: dict | None) -> tuple[str, list[str]] | None:
+    # Albums fetched from vgmdb carry their credits in the game: cache, matched to entries by catalog number
+    if not album or album.get("NotFound"):
+        return None
+    catalog_num = (album.get("AlbumInfo") or {}).get("Catalog Number")
+    if not catalog_num:
+        return None
+    return catalog_num, [str(names) for names in (album.get("Credits") or {}).values()]
+
+def load_cached_credits(index: SearchIndex, redis_obj: redis.Redis) -> None:
+    catalogs = []
+
+    def load_batch(batch: list[str]) -> None:
+        for album in read_cached_albums(redis_obj, batch):
+            credited = album_credits(album)
+            if credited is not None and credited[1]:
+                index.set_credits(*credited)
+
+    try:
+        for key in redis_obj.scan_iter(match='game:*', count=CREDITS_SCAN_BATCH):
+            catalogs.append((key.decode() if isinstance(key, bytes) else key).partition(':')[2])
+            if len(catalogs) >= CREDITS_SCAN_BATCH:
+                load_batch(catalogs)
+                catalogs = []
+        if catalogs:
+            load_batch(catalogs)
+    except RedisError:
+        logger.error("Redis error in loading cached credits for the search index")
+
+search_index = SearchIndex()
+
+def _publish(update: dict) -> None:
+    redis_obj = get_redis()
+    if redis_obj is None:
+        return
+    try:
+        redis_obj.publish(SEARCH_CHANNEL, json.dumps({"worker": WORKER_ID, **update}))
+    except RedisError:
+        logger.error("Redis error in publishing a search index update")
+
+def publish_update(op: str, entries: list[VGMEntry]) -> None:
+    # Tells the other workers about a write so their indexes follow this one
+    _publish({"op": op, "entries": [entry.model_dump() for entry in entries]})
+
+def publish_credits(catalog_num: str, credits: list[str]) -> None:
+    _publish({"op": "credits", "catalog_num": catalog_num, "credits": credits})
+
+def search_observer(index: SearchIndex):
+    def observe(op: str, entries: list[VGMEntry]) -> None:
+        index.apply(op, entries)
+        publish_update(op, entries)
+    return observe
+
+def credits_observer(index: SearchIndex):
+    # Keeps credit search in step with the vgmdb cache as albums are fetched and refreshed
+    def observe(catalog: str, album: dict) -> None:
+        credited = album_credits(album)
+        if credited is not None:
+            index.set_credits(*credited)
+            publish_credits(*credited)
+    return observe
+
+async def _update_listener(index: SearchIndex) -> None:
+    while True:
+        redis_obj = get_async_redis()
+        if redis_obj is None:
+            await asyncio.sleep(SEARCH_RECONNECT_INTERVAL)
+            continue
+        try:
+            async with redis_obj.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(SEARCH_CHANNEL)
+                async for message in pubsub.listen():
+                    if message and message.get('type') == 'message':
+                        update = json.loads(message['data'])
+                        if update["worker"] == WORKER_ID:
+                            continue
+                        if update["op"] == "credits":
+                            index.set_credits(update["catalog_num"], update["credits"])
+                        else:
+                            index.apply(update["op"], [VGMEntry(**entry) for entry in update["entries"]])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Search index listener lost its redis subscription")
+            await asyncio.sleep(SEARCH_RECONNECT_INTERVAL)
+
+@asynccontextmanager
+async def search_lifespan(storage: VGMStorage, index: SearchIndex = search_index):
+    """
+    Builds the index in the background and keeps it following writes made through storage and
+    albums written to the vgmdb cache, here and, over redis, in every other worker
+    """
+    observer = search_observer(index)
+    storage.observers.append(observer)
+    album_observer = credits_observer(index)
+    album_observers.append(album_observer)
+    listener = asyncio.create_task(_update_listener(index))
+    builder = asyncio.create_task(asyncio.to_thread(index.build, storage, get_redis()))
+    try:
+        yield
+    finally:
+        listener.cancel()
+        builder.cancel()
+        storage.observers.remove(observer)
+        album_observers.remove(album_observer)
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import uuid
+
+import redis.asyncio as aioredis
+
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable
+from redis.exceptions import RedisError, WatchError
+
+logger = logging.getLogger(__name__)
+
+LOCK_TIMEOUT = 15 #seconds a lock is held at most if the holder dies
+LOCK_WAIT = 10 #seconds a worker waits for another worker's fetch
+LOCK_POLL_INTERVAL = 0.05
+
+# key -> task for work that is running right now in this process
+_inflight: dict[str, asyncio.Task] = {}
+
+async def single_flight(key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Runs factory() once per key at a time in this process, every caller with the same key
+    while it runs awaits the same result. The work runs in its own task so a caller
+    disconnecting does not cancel it for everyone else.
+    """
+    task = _inflight.get(key)
+    if task is None or task.get_loop() is not asyncio.get_running_loop():
+        task = asyncio.create_task(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _inflight.pop(key, None) if _inflight.get(key) is done else None)
+    else:
+        logger.info("Joined in-flight request for %s", key)
+    return await asyncio.shield(task)
+
+def in_flight(key: str) -> bool:
+    # True when single_flight(key, ...) called now would join a running call instead of starting one
+    task = _inflight.get(key)
+    return task is not None and task.get_loop() is asyncio.get_running_loop()
+
+@asynccontextmanager
+async def redis_lock(redis_obj: aioredis.Redis, key: str, timeout: float = LOCK_TIMEOUT, wait: float = LOCK_WAIT):
+    """
+    Short lock shared by every worker using the same redis. Waits up to wait seconds for it
+    and yields True if it was acquired, False if it timed out or redis failed. Callers should
+    re-check the cache after acquiring since the previous holder has usually filled it.
+    """
+    token = uuid.uuid4().hex
+    acquired = False
+    deadline = asyncio.get_running_loop().time() + wait
+    try:
+        while True:
+            acquired = bool(await redis_obj.set(key, token, nx=True, px=int(timeout * 1000)))
+            if acquired or asyncio.get_running_loop().time() >= deadline:
+                break
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+    except RedisError:
+        logger.error("Redis error in acquiring lock %s", key)
+
+    if not acquired:
+        logger.info("Did not get lock %s, continuing without it", key)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            await _release_lock(redis_obj, key, token)
+
+async def _release_lock(redis_obj: aioredis.Redis, key: str, token: str) -> None:
+    # Only delete the lock if it is still ours, it may have expired and been taken by another worker
+    try:
+        async with redis_obj.pipeline() as pipe:
+            await pipe.watch(key)
+            current = await pipe.get(key)
+            if current is not None and current.decode() == token:
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+    except WatchError:
+        pass
+    except RedisError:
+        logger.error("Redis error in releasing lock %s", key)
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from typing import Any, Iterator
+
+from api.db import VGMStorage, VGMEntry, encode_cursor, decode_cursor, encode_tracks, decode_tracks
+from api.dbcache import QueryCache
+
+logger = logging.getLogger(__name__)
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "vgmapi.sqlite3")
+SQLITE_BUSY_TIMEOUT = 5000 #ms a writer waits for another writer's lock
+SQLITE_PAGE_SIZE = 500
+
+# Columns mirror what the DynamoDB projections return: no extras anywhere, tracks only for a single game
+YEAR_COLUMNS = "year_listened, game, catalog_num, rating, description, img"
+GAME_COLUMNS = f"{YEAR_COLUMNS}, tracks"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    year_listened INTEGER NOT NULL,
+    game TEXT NOT NULL,
+    catalog_num TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    description TEXT,
+    img TEXT,
+    extras TEXT,
+    tracks BLOB, -- packed by encode_tracks, JSON text in databases from before packing
+    PRIMARY KEY (year_listened, game)
+);
+-- Year lookups use the primary key, it is ordered by game within a year like the DynamoDB sort key
+CREATE INDEX IF NOT EXISTS entries_game ON entries (game);
+"""
+
+class SQLiteVGM(VGMStorage):
+    """
+    VGMStorage in a local SQLite file, for single node deploys, development and offline benchmarks.
+    Runs in WAL mode so readers never wait on the writer. Each thread gets its own connection.
+    Cursors use the same format as DynamoDBVGM's.
+    """
+    def __init__(self, path: str = None, check_table: bool = True, cache: QueryCache = None) -> None:
+        """
+        path: optional, the database file. Defaults to SQLITE_PATH
+        """
+        super().__init__(cache)
+        self.path = path or SQLITE_PATH
+        self._local = threading.local()
+        if check_table:
+            self.ensure_table()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT / 1000, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+            self._local.connection = connection
+        return connection
+
+    def ensure_table(self) -> None:
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    @staticmethod
+    def _row(data: VGMEntry) -> tuple:
+        return (
+            data.year_listened, data.game, data.catalog_num, data.rating, data.description, data.img,
+            None if data.extras is None else json.dumps(data.extras),
+            None if data.tracks is None else encode_tracks(data.tracks),
+        )
+
+    @staticmethod
+    def _entry(row: sqlite3.Row) -> VGMEntry:
+        values = dict(row)
+        tracks = values.get("tracks")
+        if isinstance(tracks, bytes):
+            values["tracks"] = decode_tracks(tracks)
+        elif tracks is not None:
+            values["tracks"] = json.loads(tracks)
+        return VGMEntry(**values)
+
+    def add(self, data: VGMEntry) -> VGMEntry:
+        self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._row(data))
+        self._written("upsert", data)
+        return data
+
+    def _write_many(self, entries: list[VGMEntry], indexes: list[int]) -> dict[int, str | None]:
+        # One transaction, the whole batch is written or none of it
+        try:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                            [self._row(entries[index]) for index in indexes])
+        except sqlite3.Error as e:
+            logger.exception("SQLite bulk add failed for %s items", len(indexes))
+            return {index: type(e).__name__ for index in indexes}
+        return {index: None for index in indexes}
+
+    def update(self, data: VGMEntry) -> VGMEntry:
+        # Same fields as DynamoDBVGM.update, and like update_item it creates the entry if it is missing
+        self.connection.execute(
+            """INSERT INTO entries (year_listened, game, catalog_num, rating, description, img) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (year_listened, game) DO UPDATE SET
+            catalog_num=excluded.catalog_num, rating=excluded.rating, description=excluded.description, img=excluded.img""",
+            (data.year_listened, data.game, data.catalog_num, data.rating, data.description, data.img),
+        )
+        self._written("update", data)
+        return data
+
+    def delete(self, data: VGMEntry) -> dict[str, Any]:
+        cursor = self.connection.execute("DELETE FROM entries WHERE year_listened = ? AND game = ?", (data.year_listened, data.game))
+        self._written("delete", data)
+        return data if cursor.rowcount else {}
+
+    def query_year_page(self, year: str, limit: int = None, cursor: str = None) -> tuple[list[VGMEntry], str | None]:
+        after = decode_cursor(cursor, year)['sk'].partition('|')[2] if cursor else None
+        query = f"SELECT {YEAR_COLUMNS} FROM entries WHERE year_listened = ?"
+        params: list[Any] = [year]
+        if after is not None:
+            query += " AND game > ?"
+            params.append(after)
+        query += " ORDER BY game"
+        if limit:
+            # One extra row tells whether there is a next page
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        rows = self.connection.execute(query, params).fetchall()
+        has_more = bool(limit) and len(rows) > limit
+        entries = [self._entry(row) for row in (rows[:limit] if limit else rows)]
+        next_cursor = None
+        if has_more:
+            next_cursor = encode_cursor({"pk": str(year), "sk": f'{VGMEntry.get_sk_prefix()}|{entries[-1].game}'})
+        return entries, next_cursor
+
+    def _query_game(self, game: str) -> VGMEntry | dict:
+        row = self.connection.execute(f"SELECT {GAME_COLUMNS} FROM entries WHERE game = ? LIMIT 1", (game,)).fetchone()
+        return self._entry(row) if row is not None else {}
+    
+    def iter_all_pages(self) -> Iterator[list[VGMEntry]]:
+        rows = self.connection.execute(f"SELECT {GAME_COLUMNS} FROM entries ORDER BY year_listened, game")
+        while page := rows.fetchmany(SQLITE_PAGE_SIZE):
+            yield [self._entry(row) for row in page]
@@ -1,25 +1,113 @@
-from fastapi import APIRouter, HTTPException, status
-from bs4 import BeautifulSoup
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, status, Response, BackgroundTasks
+from fastapi.responses import StreamingResponse
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import HTMLTreeBuilder
+from pydantic import BaseModel, Field, ValidationError
 from redis.exceptions import RedisError
 from urllib.error import HTTPError
+from html.parser import HTMLParser
 
 import redis
+import redis.asyncio as aioredis
 import requests
+import httpx
 import logging
 import re
 import datetime
 import os
+import asyncio
+import codecs
+import math
+import tracemalloc
+import time
+import orjson
 
 from datetime import timedelta
-from typing import Union
+from typing import Any, AsyncIterator, Callable, Union
 from functools import cached_property
 
 from api.db import Track, VGMEntry
-from api.redisconfig import get_redis
+from api.redisconfig import get_redis, get_async_redis
+from api.httpclient import get_http_client
+from api.singleflight import single_flight, in_flight, redis_lock
+from api.l1cache import album_cache, queue_invalidation
+from api.archive import PageArchive, archive_page
+from api.ratelimit import RateLimitTimeout, vgmdb_limiter, is_upstream_error
+from api.circuitbreaker import vgmdb_breaker
+from api.metrics import time_stage, timed, stage_seconds, cache_requests, upstream_responses
 
 
 VGMDB_ALBUM_URL = "https://vgmdb.net/album/"
+VGMDB_TIMEOUT = (3, 10) #connect, read in seconds for the blocking fetch
+
+# The extractors only ever look at these parts of an album page, the rest (nav, sidebars, comments) is skipped while parsing
+VGMDB_SECTION_IDS = frozenset({'album_infobit_large', 'tracklist', 'cover_gallery', 'collapse_credits'})
+VGMDB_PRODUCT_HREF = re.compile(r'/product/[0-9]*')
+
+def _is_album_section(name: str, attrs: dict) -> bool:
+    if name == 'h1' or attrs.get('id') in VGMDB_SECTION_IDS:
+        return True
+    return name == 'a' and VGMDB_PRODUCT_HREF.search(attrs.get('href') or '') is not None
+
+ALBUM_STRAINER = SoupStrainer(_is_album_section)
+
+def _default_html_parser() -> str:
+    try:
+        import lxml # noqa: F401
+    except ImportError:
+        return 'html.parser'
+    return 'lxml'
+
+# Any beautifulsoup tree builder, lxml is used when installed
+HTML_PARSER = os.environ.get("VGMDB_PARSER", _default_html_parser())
+# html.parser closes kept sections on stray end tags (vgmdb has a few) only when their skipped ancestors are in the tree,
+# so restricting it to ALBUM_STRAINER changes the output. lxml ignores stray end tags and parses the same either way.
+STRAINABLE_PARSERS = frozenset({'lxml'})
+
+# Streaming fetch, stops the download once every section in VGMDB_SECTION_IDS, the first h1 and the
+# first product link have been closed. Pages without a product link are read to the end
+STREAM_FETCH = os.environ.get("VGMDB_STREAM", "0") == "1"
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# game: entries are fresh for cache_time_in_minutes, then served stale while a background refresh runs
+# for another STALE_TIME_IN_MINUTES before redis drops them
+STALE_TIME_IN_MINUTES = int(os.environ.get("VGMDB_STALE_MINUTES", 60 * 24))
+BATCH_MAX_CATALOGS = 100
+BATCH_MAX_CONCURRENCY = 8
+
+# Catalogs vgmdb has no album for get a short lived entry so repeat lookups don't go upstream
+NEGATIVE_CACHE_MINUTES = int(os.environ.get("VGMDB_NEGATIVE_CACHE_MINUTES", 10))
+
+# Next to every game: entry the finished response body is kept, validated and serialized once
+# when it is written. Cache hits send those bytes as they are
+RESPONSE_BODY_PREFIX = "body"
+# game: entries are RedisJSON documents by default. msgpack keeps each in a hash of the packed album,
+# its FreshUntil and its response body: smaller, cheaper to decode and no RedisJSON module needed
+CACHE_FORMAT = os.environ.get("VGMDB_CACHE_FORMAT", "json")
+
+def is_fetch_error(status_code: int) -> bool:
+    # Only a 404 says vgmdb has no such album and gets a negative entry. Every other 4xx (a WAF's 403, a 410)
+    # and the upstream errors say nothing about the album, those responses are never cached
+    return status_code >= 400 and status_code != 404
+
+# Called with (catalog, cached album) after every album written to the game: cache, see api.search
+album_observers: list[Callable[[str, dict], None]] = []
+
+def _album_written(catalog: str, data: dict) -> None:
+    for observer in album_observers:
+        try:
+            observer(catalog, data)
+        except Exception:
+            logger.exception("Album cache observer failed on %s", catalog)
+
+def conditional_headers(validators: dict = None) -> dict[str, str]:
+    headers = {}
+    if validators:
+        if validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators.get('LastModified'):
+            headers['If-Modified-Since'] = validators['LastModified']
+    return headers
 
 vgmdbapi = APIRouter(prefix="/api/vgmdb")
 logger = logging.getLogger(__name__)
@@ -34,46 +122,269 @@ class VGMDBException(Exception):
     def __str__(self) -> str:
         return self.return_str
     
-class VGMDBData:
+class SectionTracker(HTMLParser):
+    """
+    Incremental tokenizer that only keeps track of which parts of ALBUM_STRAINER have been closed:
+    the sections by id, plus the first h1 and the first product link which title and game read.
+    Fed the page chunk by chunk so a streaming download can stop once the extractors have everything they read.
+    End tags close everything opened after their matching start tag, the same way beautifulsoup builds the tree.
+    """
+    def __init__(self, section_ids: frozenset = VGMDB_SECTION_IDS) -> None:
+        super().__init__(convert_charrefs=False)
+        self.remaining = set(section_ids) | {'h1', 'product'}
+        self._stack = [] # (tag name, section id or None)
+        
+    def handle_starttag(self, tag, attrs):
+        if tag in HTMLTreeBuilder.empty_element_tags:
+            return
+        attrs = dict(attrs)
+        if tag == 'h1':
+            section_id = 'h1'
+        elif tag == 'a' and VGMDB_PRODUCT_HREF.search(attrs.get('href') or '') is not None:
+            section_id = 'product'
+        else:
+            section_id = attrs.get('id')
+        if section_id not in self.remaining or any(open_id == section_id for _, open_id in self._stack):
+            section_id = None
+        self._stack.append((tag, section_id))
+        
+    def handle_startendtag(self, tag, attrs):
+        pass
+            
+    def handle_endtag(self, tag):
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                for _, section_id in self._stack[i:]:
+                    if section_id is not None:
+                        self.remaining.discard(section_id)
+                del self._stack[i:]
+                break
+    
+    @property
+    def done(self) -> bool:
+        return not self.remaining
     
-    def __init__(self, catalog_id: str) -> None:
+class PageBuffer:
+    """
+    Collects a streamed page. feed returns True once the rest of the page is not needed.
+    """
+    def __init__(self) -> None:
+        self.chunks = []
+        self.size = 0
+        self.tracker = SectionTracker()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
         
+    def feed(self, chunk: bytes) -> bool:
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.tracker.feed(self._decoder.decode(chunk))
+        return self.tracker.done
+    
+    @property
+    def content(self) -> bytes:
+        return b"".join(self.chunks)
+
+class VGMDBData:
+    
+    def __init__(self, catalog_id: str, parser: str = None, strain: bool = None) -> None:
+        """
+        parser: optional, beautifulsoup tree builder to use. Defaults to HTML_PARSER
+        strain: optional, only build the album sections of the page instead of the whole thing.
+        Defaults to on for the parsers in STRAINABLE_PARSERS.
+        """
         self.catalog = catalog_id
         self.soup = None
+        self.cache_stale = False
+        self.fresh_until = None
+        self.fetch_error = False
+        self.circuit_open = False
+        self.not_modified = False
+        self.etag = None
+        self.last_modified = None
+        self.fetch_stats = {}
+        self.parser = parser if parser else HTML_PARSER
+        if strain is None:
+            strain = self.parser in STRAINABLE_PARSERS
+        self.parse_only = ALBUM_STRAINER if strain else None
             
     def __str__(self):
         return f"VGMDBData of page: {self.catalog}"
     
     #TODO: __repr__
     
-    def fetch_vals_from_webpage(self, content = None) -> None:
+    def fetch_vals_from_webpage(self, content = None, stream: bool = None, validators: dict = None) -> None:
         """
         Creates the beautifulsoup object from the designated VGMDB album ID
         content: optional, Set this to directly get content from anything \
         that beautifulsoup can parse. Typically unused outside of debugging.
         and will throw errors if you utilize it incorrectly.
+        stream: optional, stop downloading once all album sections are in. Defaults to STREAM_FETCH
+        validators: optional, ETag and LastModified of a cached copy to revalidate. If vgmdb answers
+        304 nothing is parsed and not_modified is set.
         """
         if content:
             try:
-                self.soup = BeautifulSoup(content, 'html.parser')
-            except TypeError:
+                self.soup = BeautifulSoup(content, self.parser, parse_only=self.parse_only)
+            except (TypeError, AttributeError):
                 raise TypeError("Custom content failed to parse")
         
+        else:
+            self._start_fetch_stats()
+            redis_obj = get_redis()
+            if not vgmdb_breaker.allow():
+                logger.warning("vgmdb circuit open, not fetching %s", self.catalog)
+                upstream_responses.inc("circuit_open")
+                temp = self._error_page(circuit_open=True)
+            else:
+                try:
+                    headers = conditional_headers(validators)
+                    self.fetch_stats["queue_wait"] = vgmdb_limiter.acquire(redis_obj)
+                    stage_seconds.observe(self.fetch_stats["queue_wait"], "queue_wait")
+                    with time_stage("upstream_fetch"):
+                        if stream if stream is not None else STREAM_FETCH:
+                            with requests.get(f'{VGMDB_ALBUM_URL}{self.catalog}', headers=headers, timeout=VGMDB_TIMEOUT, stream=True) as response:
+                                temp = self._read_stream(response, response.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+                        else:
+                            response = requests.get(f'{VGMDB_ALBUM_URL}{self.catalog}', headers=headers, timeout=VGMDB_TIMEOUT)
+                            temp = response.content
+                            self._set_fetch_stats(response, len(temp), False)
+                    vgmdb_limiter.record_response(redis_obj, response.status_code, response.headers.get('Retry-After'))
+                    vgmdb_breaker.record(not is_upstream_error(response.status_code))
+                except RateLimitTimeout:
+                    vgmdb_breaker.release()
+                    upstream_responses.inc("rate_limited")
+                    logger.error("No vgmdb request slot for page %s", self.catalog)
+                    temp = self._error_page()
+                except Exception:
+                    vgmdb_breaker.record_failure()
+                    upstream_responses.inc("error")
+                    logger.exception("Error on request of page %s", self.catalog)
+                    temp = self._error_page()
+            
+            if self.not_modified:
+                return
+            if self._archivable:
+                archive_page(self.catalog, temp)
+            self._make_soup(temp)
+            
+    async def fetch_vals_from_webpage_async(self, client: httpx.AsyncClient = None, stream: bool = None, validators: dict = None) -> None:
+        """
+        async version of fetch_vals_from_webpage. Downloads through the shared httpx client
+        and parses in a worker thread so the event loop is free while beautifulsoup runs.
+        client: optional, defaults to api.httpclient.get_http_client()
+        stream: optional, stop downloading once all album sections are in. Defaults to STREAM_FETCH
+        validators: optional, see fetch_vals_from_webpage
+        """
+        if client is None:
+            client = get_http_client()
+        self._start_fetch_stats()
+        redis_obj = get_async_redis()
+        if not vgmdb_breaker.allow():
+            logger.warning("vgmdb circuit open, not fetching %s", self.catalog)
+            upstream_responses.inc("circuit_open")
+            temp = self._error_page(circuit_open=True)
         else:
             try:
-                temp = requests.get(f'{VGMDB_ALBUM_URL}{self.catalog}').content
+                headers = conditional_headers(validators)
+                self.fetch_stats["queue_wait"] = await vgmdb_limiter.acquire_async(redis_obj)
+                stage_seconds.observe(self.fetch_stats["queue_wait"], "queue_wait")
+                with time_stage("upstream_fetch"):
+                    if stream if stream is not None else STREAM_FETCH:
+                        async with client.stream('GET', f'{VGMDB_ALBUM_URL}{self.catalog}', headers=headers) as response:
+                            page = PageBuffer()
+                            async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                                if page.feed(chunk):
+                                    break
+                            temp = page.content
+                            self._set_fetch_stats(response, page.size, page.tracker.done)
+                    else:
+                        response = await client.get(f'{VGMDB_ALBUM_URL}{self.catalog}', headers=headers)
+                        temp = response.content
+                        self._set_fetch_stats(response, len(temp), False)
+                await vgmdb_limiter.record_response_async(redis_obj, response.status_code, response.headers.get('Retry-After'))
+                vgmdb_breaker.record(not is_upstream_error(response.status_code))
+            except RateLimitTimeout:
+                vgmdb_breaker.release()
+                upstream_responses.inc("rate_limited")
+                logger.error("No vgmdb request slot for page %s", self.catalog)
+                temp = self._error_page()
             except Exception:
-                temp = f"<h1>ERROR on page {VGMDB_ALBUM_URL}{self.catalog}</h1>"
+                vgmdb_breaker.record_failure()
+                upstream_responses.inc("error")
                 logger.exception("Error on request of page %s", self.catalog)
+                temp = self._error_page()
             
-            try:
-                self.soup = BeautifulSoup(temp, 'html.parser')
-            except TypeError:
-                logger.exception("Error in VGMPageData.as_soup")
-                self.soup = BeautifulSoup(f"<h1>ERROR on page {VGMDB_ALBUM_URL}{self.catalog}</h1>", 'html.parser')
+        if self.not_modified:
+            return
+        if self._archivable:
+            await asyncio.to_thread(archive_page, self.catalog, temp)
+        await asyncio.to_thread(self._make_soup, temp)
+            
+    def _read_stream(self, response: requests.Response, chunks) -> bytes:
+        page = PageBuffer()
+        for chunk in chunks:
+            if page.feed(chunk):
+                break
+        content = page.content
+        self._set_fetch_stats(response, page.size, page.tracker.done)
+        return content
+    
+    @property
+    def _archivable(self) -> bool:
+        # A streamed page that stopped early is missing everything after the album sections,
+        # reparsing it after an extractor change could not bring that back. Only whole pages are archived.
+        # So are only 2xx pages, the archive has no status code and a reparsed 404 page would be cached as an album
+        return (not self.fetch_error and 200 <= self.fetch_stats.get("status_code", 0) < 300
+                and not self.fetch_stats.get("stopped_early", False))
+    
+    def _error_page(self, circuit_open: bool = False) -> str:
+        # Parsed in place of the album so callers get a soup, fetch_error keeps it out of every cache
+        self.fetch_error = True
+        self.circuit_open = circuit_open
+        return f"<h1>ERROR on page {VGMDB_ALBUM_URL}{self.catalog}</h1>"
+    
+    def _start_fetch_stats(self) -> None:
+        self.fetch_stats = {}
+        self.fetch_error = False
+        self.circuit_open = False
+        self.not_modified = False
+        # Peak memory is only measured when tracemalloc is on (PYTHONTRACEMALLOC=1), it is process wide
+        # so it is approximate when other requests run at the same time
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+    
+    def _set_fetch_stats(self, response: requests.Response | httpx.Response, bytes_received: int, stopped_early: bool) -> None:
+        status_code = response.status_code
+        upstream_responses.inc(str(status_code))
+        # Throttled, refused or broken upstream responses still get parsed but are flagged so they are never cached
+        self.fetch_error = is_fetch_error(status_code)
+        self.not_modified = status_code == 304
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.fetch_stats.update({
+            "status_code": status_code,
+            "bytes_received": bytes_received,
+            "stopped_early": stopped_early,
+        })
+            
+    def _make_soup(self, page) -> None:
+        try:
+            with time_stage("parse"):
+                self.soup = BeautifulSoup(page, self.parser, parse_only=self.parse_only)
+        except (TypeError, AttributeError):
+            logger.exception("Error in VGMPageData.as_soup")
+            self.soup = BeautifulSoup(f"<h1>ERROR on page {VGMDB_ALBUM_URL}{self.catalog}</h1>", 'html.parser')
+            self.fetch_error = True
+        
+        if self.fetch_stats:
+            self.fetch_stats["peak_memory"] = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+            logger.info("Fetched page %s: %s", self.catalog, self.fetch_stats)
             
     @cached_property
+    @timed("extract_title")
     def title(self):
+        if self.fetch_stats.get("status_code") == 404:
+            return "Not Found"
         try:
             value = next(self.soup.find('h1').stripped_strings)
             if value == "System Message":
@@ -82,9 +393,14 @@ class VGMDBData:
         except AttributeError:
             logger.exception("Exception in creation of title in VGMDBData")
             return None
+        
+    @property
+    def not_found(self) -> bool:
+        return self.title == "Not Found"
             
     
     @cached_property
+    @timed("extract_game")
     def game(self):
         game_name = self.soup.find('a', attrs={'href': re.compile(r'/product/[0-9]*')})
         if game_name:
@@ -98,6 +414,7 @@ class VGMDBData:
                 return None
     
     @cached_property
+    @timed("extract_albuminfo")
     def albuminfo(self):
         album_info = {}
         try:
@@ -112,6 +429,7 @@ class VGMDBData:
         return album_info
     
     @cached_property
+    @timed("extract_tracks")
     def tracks(self):
         titles_checked = []
         tracktable = {}
@@ -161,6 +479,7 @@ class VGMDBData:
         return tracktable
     
     @cached_property
+    @timed("extract_covers")
     def covers(self):
         covers = self.soup.find('div', id="cover_gallery")
         if covers:    
@@ -173,6 +492,7 @@ class VGMDBData:
             return []
     
     @cached_property
+    @timed("extract_credits")
     def credits(self):
         credits_table = {}
         try:
@@ -208,39 +528,157 @@ class VGMDBData:
     def get_cached_vals(self, redis_obj: redis.Redis) -> bool:
         # Returns true if cached loaded else return false
         try:
-            cached_values = redis_obj.json().get(f'game:{self.catalog}')
+            cached_values, = read_cached_albums(redis_obj, [self.catalog])
         except RedisError:
             logger.error("Redis error in setting the cache for %s", self.catalog)
         else:
             if cached_values:
-                self.soup = BeautifulSoup('<h1>Cached VGMDB Data</h1>', 'html.parser') #Some default.
-                self.title = cached_values.get('Title', None)
-                self.game = cached_values.get('Game', None)
-                self.albuminfo = cached_values.get('AlbumInfo', None)
-                self.tracks = cached_values.get('Tracks', None)
-                self.covers = cached_values.get('Covers', None)
-                self.credits = cached_values.get('Credits', None)
-                #self.notes = None #Not implemented yet
-                
-                logger.info("Returned cached values for game: %s", self.catalog)
-                
+                self._load_cache_dict(cached_values)
                 return True
         return False
+    
+    async def get_cached_vals_async(self, redis_obj: aioredis.Redis) -> bool:
+        try:
+            cached_values, = await read_cached_albums_async(redis_obj, [self.catalog])
+        except RedisError:
+            logger.error("Redis error in setting the cache for %s", self.catalog)
+        else:
+            if cached_values:
+                self._load_cache_dict(cached_values)
+                return True
+        return False
+    
+    def _load_cache_dict(self, cached_values: dict) -> None:
+        self.soup = BeautifulSoup('<h1>Cached VGMDB Data</h1>', 'html.parser') #Some default.
+        self.title = cached_values.get('Title', None)
+        self.game = cached_values.get('Game', None)
+        self.albuminfo = cached_values.get('AlbumInfo', None)
+        self.tracks = cached_values.get('Tracks', None)
+        self.covers = cached_values.get('Covers', None)
+        self.credits = cached_values.get('Credits', None)
+        #self.notes = None #Not implemented yet
+        # Entries written before FreshUntil existed only have the hard expiry
+        self.fresh_until = cached_values.get('FreshUntil', float('inf'))
+        self.cache_stale = self.fresh_until < time.time()
+        self.etag = cached_values.get('ETag', None)
+        self.last_modified = cached_values.get('LastModified', None)
+        
+        logger.info("Returned cached values for game: %s", self.catalog)
+        
+    def _as_cache_dict(self, timelimit: int = 30) -> dict:
+        return {
+            "FreshUntil":time.time() + timelimit * 60,
+            "NotFound":self.not_found,
+            "ETag":self.etag,
+            "LastModified":self.last_modified,
+            "Title":self.title,
+            "Game":self.game,
+            "AlbumInfo":self.albuminfo,
+            "Tracks":self.tracks,
+            "Covers":self.covers,
+            "Credits": self.credits,
+            #"Notes":self.notes, not implemented
+        }
+            
+    @property
+    def validators(self) -> dict[str, str]:
+        return {"ETag": self.etag, "LastModified": self.last_modified}
+    
+    def extend_cached_vals(self, redis_obj: redis.Redis, timelimit: int = 30, stale_timelimit: int = None, validators: dict = None) -> bool:
+        """
+        Makes the cached entry fresh again without rewriting it, for when vgmdb answers 304 Not Modified
+        validators: optional, ETag and LastModified the 304 came with. The ones that are set replace the cached ones
+        """
+        timelimit, stale_timelimit = self._cache_timelimits(timelimit, stale_timelimit)
+        fresh_until = time.time() + timelimit * 60
+        validators = {key: value for key, value in (validators or {}).items() if value}
+        try:
+            with time_stage("cache_set"), redis_obj.pipeline() as pipe:
+                queue_album_extend(pipe, self.catalog, fresh_until, timedelta(minutes=timelimit + stale_timelimit), validators)
+                pipe.execute()
+        except RedisError:
+            logger.error("Redis error in extending the cache for %s", self.catalog)
+            return False
+        self._extended(fresh_until, validators)
+        return True
+    
+    async def extend_cached_vals_async(self, redis_obj: aioredis.Redis, timelimit: int = 30, stale_timelimit: int = None, validators: dict = None) -> bool:
+        timelimit, stale_timelimit = self._cache_timelimits(timelimit, stale_timelimit)
+        fresh_until = time.time() + timelimit * 60
+        validators = {key: value for key, value in (validators or {}).items() if value}
+        try:
+            with time_stage("cache_set"):
+                async with redis_obj.pipeline() as pipe:
+                    queue_album_extend(pipe, self.catalog, fresh_until, timedelta(minutes=timelimit + stale_timelimit), validators)
+                    await pipe.execute()
+        except RedisError:
+            logger.error("Redis error in extending the cache for %s", self.catalog)
+            return False
+        self._extended(fresh_until, validators)
+        return True
+    
+    def _extended(self, fresh_until: float, validators: dict) -> None:
+        self.fresh_until = fresh_until
+        self.cache_stale = False
+        self.etag = validators.get('ETag', self.etag)
+        self.last_modified = validators.get('LastModified', self.last_modified)
+        
+    def _cache_timelimits(self, timelimit: int, stale_timelimit: int = None) -> tuple[int, int]:
+        # Negative entries get their own short TTL and are never served stale
+        if self.not_found:
+            return NEGATIVE_CACHE_MINUTES, 0
+        return timelimit, STALE_TIME_IN_MINUTES if stale_timelimit is None else stale_timelimit
+            
+    def _cache_entry(self, timelimit: int) -> tuple[dict, bytes | None]:
+        # The body is built here and not in queue_album_write so cache_set only times the redis round trip
+        data = self._as_cache_dict(timelimit)
+        return data, _response_body(data)
             
     #TODO: Set cache based off of attributes and not some passed-in data dictionary
-    def set_cached_vals(self, redis_obj: redis.Redis, timelimit: int = 30) -> bool:
+    def set_cached_vals(self, redis_obj: redis.Redis, timelimit: int = 30, stale_timelimit: int = None) -> bool:
+        """
+        timelimit: minutes the entry is fresh for
+        stale_timelimit: optional, minutes it is kept and served stale after that. Defaults to STALE_TIME_IN_MINUTES
+        """
+        data = None
+        if self.fetch_error:
+            logger.warning("Not caching %s, the upstream request failed", self.catalog)
+            return False
+        timelimit, stale_timelimit = self._cache_timelimits(timelimit, stale_timelimit)
         try:
-            data = {
-                "Title":self.title,
-                "Game":self.game,
-                "AlbumInfo":self.albuminfo,
-                "Tracks":self.tracks,
-                "Covers":self.covers,
-                "Credits": self.credits,
-                #"Notes":self.notes, not implemented
-            }
-            redis_obj.json().set(f'game:{self.catalog}','$',data)
-            redis_obj.expire(f'game:{self.catalog}',timedelta(minutes=timelimit))
+            data, body = self._cache_entry(timelimit)
+            with time_stage("cache_set"), redis_obj.pipeline() as pipe:
+                queue_album_write(pipe, self.catalog, data, body, timedelta(minutes=timelimit + stale_timelimit))
+                pipe.execute()
+            self.fresh_until = data["FreshUntil"]
+            _album_written(self.catalog, data)
+        except RedisError:
+            logger.error("Redis error in setting the cache:")
+            logger.error("data object: %s", str(data))
+            return False
+        except Exception:
+            logger.exception("Miscellaneous error in set_cached_values")
+            return False
+        else:
+            logger.info("Set cache for %s", self.catalog)
+            return True
+        
+    async def set_cached_vals_async(self, redis_obj: aioredis.Redis, timelimit: int = 30, stale_timelimit: int = None) -> bool:
+        data = None
+        if self.fetch_error:
+            logger.warning("Not caching %s, the upstream request failed", self.catalog)
+            return False
+        timelimit, stale_timelimit = self._cache_timelimits(timelimit, stale_timelimit)
+        try:
+            # Building the dict runs every extractor, keep that off the event loop
+            data, body = await asyncio.to_thread(self._cache_entry, timelimit)
+            with time_stage("cache_set"):
+                async with redis_obj.pipeline() as pipe:
+                    queue_album_write(pipe, self.catalog, data, body, timedelta(minutes=timelimit + stale_timelimit))
+                    await pipe.execute()
+            self.fresh_until = data["FreshUntil"]
+            if album_observers:
+                await asyncio.to_thread(_album_written, self.catalog, data)
         except RedisError:
             logger.error("Redis error in setting the cache:")
             logger.error("data object: %s", str(data))
@@ -260,11 +698,179 @@ class VGMDBPydantic(BaseModel):
     Covers: list | None = None
     Credits: dict | None = None
     
+def album_body(album: VGMDBPydantic) -> bytes:
+    # Parsed dict keys are beautifulsoup NavigableStrings, which orjson only takes with OPT_NON_STR_KEYS
+    return orjson.dumps(album.model_dump(), option=orjson.OPT_NON_STR_KEYS)
+
+def body_key(catalog: str) -> str:
+    return f'{RESPONSE_BODY_PREFIX}:game:{catalog}'
+
+@timed("model_build")
+def _response_body(data: dict) -> bytes | None:
+    # The only validation a cached album's response goes through
+    try:
+        return album_body(VGMDBPydantic(**{field: data.get(field) for field in VGMDBPydantic.model_fields}))
+    except ValidationError:
+        # Title and Game are required. An album parsed from a page without an h1 has neither, it gets no body
+        # and its requests go through the model, which fails the same way. Not found entries do validate,
+        # their Title and Game are "Not Found"
+        return None
+
+def _msgpack():
+    # Optional, only needed with VGMDB_CACHE_FORMAT=msgpack
+    import msgpack
+    return msgpack
+
+def check_cache_format(cache_format: str = None) -> None:
+    """
+    Raises RuntimeError if the cache format can't be used in this install. Checked at import so a worker
+    missing msgpack fails at startup instead of answering 500 on every cached read.
+    """
+    cache_format = CACHE_FORMAT if cache_format is None else cache_format
+    if cache_format not in ("json", "msgpack"):
+        raise RuntimeError(f"Unknown VGMDB_CACHE_FORMAT {cache_format!r}, use json or msgpack")
+    if cache_format == "msgpack":
+        try:
+            _msgpack()
+        except ImportError:
+            raise RuntimeError("VGMDB_CACHE_FORMAT=msgpack needs the msgpack package, pip install msgpack") from None
+
+check_cache_format()
+
+def queue_album_write(pipe: redis.client.Pipeline | aioredis.client.Pipeline, catalog: str, data: dict, body: bytes | None,
+                      expiry: timedelta) -> None:
+    """
+    Queues a whole cached album on pipe: the value, its response body, the expiry and the L1
+    invalidation. On a MULTI pipeline they land together in one round trip or not at all.
+    body: _response_body(data), None stores the album without one
+    """
+    # Clears what an older write or the other format left behind
+    pipe.delete(f'game:{catalog}', body_key(catalog))
+    if CACHE_FORMAT == "msgpack":
+        fields = {"data": _msgpack().packb(data), "fresh_until": data["FreshUntil"]}
+        if body is not None:
+            fields["body"] = body
+        pipe.hset(f'game:{catalog}', mapping=fields)
+    else:
+        pipe.json().set(f'game:{catalog}', '$', data)
+        if body is not None:
+            pipe.set(body_key(catalog), body, ex=expiry)
+    pipe.expire(f'game:{catalog}', expiry)
+    queue_invalidation(pipe, f'game:{catalog}')
+
+# msgpack hash fields a revalidation can change without repacking the album, they win over the packed values
+MSGPACK_VALIDATOR_FIELDS = {"ETag": "etag", "LastModified": "last_modified"}
+
+def queue_album_extend(pipe: redis.client.Pipeline | aioredis.client.Pipeline, catalog: str, fresh_until: float, expiry: timedelta,
+                       validators: dict = None) -> None:
+    """
+    Queues making a cached album fresh until fresh_until, and storing the ETag / LastModified in validators
+    """
+    validators = validators or {}
+    if CACHE_FORMAT == "msgpack":
+        pipe.hset(f'game:{catalog}', mapping={"fresh_until": fresh_until,
+                                              **{MSGPACK_VALIDATOR_FIELDS[key]: value for key, value in validators.items()}})
+    else:
+        pipe.json().set(f'game:{catalog}', '$.FreshUntil', fresh_until)
+        for key, value in validators.items():
+            pipe.json().set(f'game:{catalog}', f'$.{key}', value)
+        pipe.expire(body_key(catalog), expiry)
+    pipe.expire(f'game:{catalog}', expiry)
+
+def _queue_album_read(pipe: redis.client.Pipeline | aioredis.client.Pipeline, catalog: str) -> None:
+    if CACHE_FORMAT == "msgpack":
+        pipe.hmget(f'game:{catalog}', "data", "fresh_until", *MSGPACK_VALIDATOR_FIELDS.values())
+    else:
+        pipe.json().get(f'game:{catalog}')
+
+def _decode_album(cached: Any) -> dict | None:
+    if CACHE_FORMAT == "msgpack":
+        packed, fresh_until, *validators = cached
+        if packed is None or fresh_until is None:
+            return None
+        data = _msgpack().unpackb(packed)
+        data["FreshUntil"] = float(fresh_until)
+        for key, value in zip(MSGPACK_VALIDATOR_FIELDS, validators):
+            if value is not None:
+                data[key] = value.decode()
+        return data
+    return cached or None
+
+def read_cached_albums(redis_obj: redis.Redis, catalogs: list[str]) -> list[dict | None]:
+    """
+    Reads the cached albums of many catalogs in one round trip, in order, None where there is none.
+    Raises RedisError.
+    """
+    with time_stage("cache_get"), redis_obj.pipeline(transaction=False) as pipe:
+        for catalog in catalogs:
+            _queue_album_read(pipe, catalog)
+        return [_decode_album(cached) for cached in pipe.execute()]
+
+async def read_cached_albums_async(redis_obj: aioredis.Redis, catalogs: list[str]) -> list[dict | None]:
+    with time_stage("cache_get"):
+        async with redis_obj.pipeline(transaction=False) as pipe:
+            for catalog in catalogs:
+                _queue_album_read(pipe, catalog)
+            return [_decode_album(cached) for cached in await pipe.execute()]
+
+def _queue_body_read(pipe: redis.client.Pipeline | aioredis.client.Pipeline, catalog: str) -> None:
+    if CACHE_FORMAT == "msgpack":
+        pipe.hmget(f'game:{catalog}', "body", "fresh_until")
+    else:
+        pipe.json().get(f'game:{catalog}', '$.FreshUntil')
+        pipe.get(body_key(catalog))
+
+def _decode_bodies(results: list) -> list[tuple[bytes | None, float] | None]:
+    decoded = []
+    if CACHE_FORMAT == "msgpack":
+        for body, fresh_until in results:
+            decoded.append(None if fresh_until is None else (body, float(fresh_until)))
+        return decoded
+    for fresh_until, body in zip(results[::2], results[1::2]):
+        # Entries written before FreshUntil existed only have the hard expiry
+        decoded.append(None if fresh_until is None else (body, fresh_until[0] if fresh_until else float('inf')))
+    return decoded
+
+async def read_cached_bodies_async(redis_obj: aioredis.Redis, catalogs: list[str]) -> list[tuple[bytes | None, float] | None]:
+    """
+    The cached response body of many catalogs and when each stops being fresh, in one round trip and in order.
+    None where nothing is cached, the body is None for an entry that has none (see _response_body).
+    Freshness stays with the game: entry so extending or expiring it covers the body too. Raises RedisError.
+    """
+    with time_stage("cache_get"):
+        async with redis_obj.pipeline(transaction=False) as pipe:
+            for catalog in catalogs:
+                _queue_body_read(pipe, catalog)
+            return _decode_bodies(await pipe.execute())
+
+async def get_response_body_async(redis_obj: aioredis.Redis, catalog: str) -> tuple[bytes, float] | None:
+    """
+    Returns the cached response body and when it stops being fresh, None if there is no body.
+    """
+    try:
+        cached, = await read_cached_bodies_async(redis_obj, [catalog])
+    except RedisError:
+        logger.error("Redis error in getting the cached response for %s", catalog)
+        return None
+    if cached is None or cached[0] is None:
+        return None
+    return cached
+
+def album_response(body: bytes, cache: str) -> Response:
+    cache_requests.inc(cache)
+    return Response(content=body, media_type="application/json", headers={"X-Cache": cache})
+
+class VGMDBBatchRequest(BaseModel):
+    catalogs: list[str] = Field(min_length=1, max_length=BATCH_MAX_CATALOGS)
+    concurrency: int = Field(default=4, ge=1, le=BATCH_MAX_CONCURRENCY)
+    cache_time_in_minutes: int = 30
+    
 # Specifically conversion from vgmdb data to things that I need in this api.                
 class VGMDataForVGMAPI(VGMDBData):
-    def __init__(self, catalog_id: str) -> None:
-        super().__init__(catalog_id)
+    def __init__(self, catalog_id: str, parser: str = None, strain: bool = None) -> None:
+        super().__init__(catalog_id, parser=parser, strain=strain)
         
+    @timed("model_build")
     def as_pydantic(self) -> VGMDBPydantic:
         return VGMDBPydantic(
             Title=self.title,
@@ -275,6 +881,7 @@ class VGMDataForVGMAPI(VGMDBData):
             Credits=self.credits
         )
         
+    @timed("model_build")
     def as_db_entry(self, rating:int, description:str = None, year_listened: int = None, **kwargs) -> VGMEntry:
         
         #Convert list of list of dictionaries to [Track(), Track(),]
@@ -302,25 +909,303 @@ class VGMDataForVGMAPI(VGMDBData):
         
 def get_vgmdbdata(catalog_id: str):
     return VGMDataForVGMAPI(catalog_id)
+
+def reparse_archive(archive: PageArchive, redis_obj: redis.Redis, catalogs: list[str] = None, cache_time_in_minutes: int = 30) -> int:
+    """
+    Rebuilds the game: cache entries from the newest archived page of each catalog, without going to vgmdb.
+    catalogs: optional, defaults to every catalog in the archive
+    Returns the number of entries written.
+    """
+    written = 0
+    for catalog in (catalogs if catalogs else archive.catalogs()):
+        content = archive.latest(catalog)
+        if content is None:
+            logger.info("No archived page for %s", catalog)
+            continue
+        vgmdata = get_vgmdbdata(catalog)
+        vgmdata.fetch_vals_from_webpage(content)
+        if vgmdata.set_cached_vals(redis_obj, timelimit=cache_time_in_minutes):
+            written += 1
+    return written
+
+async def fetch_album_async(catalog: str, redis_obj: aioredis.Redis = None, cache_time_in_minutes: int = 30,
+                            stale_time_in_minutes: int = None) -> tuple[VGMDataForVGMAPI, str]:
+    """
+    Fetches and parses one album, caching it when redis_obj is passed. With a cache the fetch
+    is done under a redis lock so only one worker across all hosts fetches a catalog at a time,
+    the others wait for the lock and then read what it cached.
+    Returns the album and where it came from, as counted in vgmapi_cache_requests_total:
+    "miss" fetched from vgmdb, "fresh" cached by another worker while this one waited for the lock,
+    "revalidated" cached and confirmed by a 304, "stale" cached and kept because vgmdb could not be reached
+    (also "fresh" if it was not stale yet) and "bypass" fetched without a cache.
+    """
+    vgmdata = get_vgmdbdata(catalog)
+    if redis_obj is None:
+        await vgmdata.fetch_vals_from_webpage_async()
+        return vgmdata, "bypass"
+    
+    # Without the lock (the wait timed out or redis failed) a fresh entry is still served, only a missing
+    # or stale one is fetched
+    async with redis_lock(redis_obj, f'lock:game:{catalog}'):
+        is_cached = await vgmdata.get_cached_vals_async(redis_obj)
+        if is_cached and not vgmdata.cache_stale:
+            return vgmdata, "fresh"
+        # A stale entry is revalidated with its ETag / Last-Modified, a 304 just extends it
+        fetched = get_vgmdbdata(catalog)
+        await fetched.fetch_vals_from_webpage_async(validators=vgmdata.validators if is_cached else None)
+        if fetched.not_modified and is_cached:
+            logger.info("%s not modified on vgmdb, extending cache", catalog)
+            await vgmdata.extend_cached_vals_async(redis_obj, timelimit=cache_time_in_minutes, stale_timelimit=stale_time_in_minutes,
+                                                   validators=fetched.validators)
+            return vgmdata, "revalidated"
+        if fetched.fetch_error and is_cached:
+            logger.info("vgmdb unavailable, keeping cached %s", catalog)
+            return vgmdata, "stale" if vgmdata.cache_stale else "fresh"
+        await fetched.set_cached_vals_async(redis_obj, timelimit=cache_time_in_minutes, stale_timelimit=stale_time_in_minutes)
+    return fetched, "miss"
+
+async def fetch_album_shared(catalog: str, redis_obj: aioredis.Redis = None, cache_time_in_minutes: int = 30,
+                             stale_time_in_minutes: int = None) -> tuple[VGMDataForVGMAPI, str]:
+    """
+    fetch_album_async through single_flight. A caller that joined a fetch already in flight in this
+    process gets its album with the source "coalesced"
+    """
+    key = f'game:{catalog}' if redis_obj is not None else f'nocache:{catalog}'
+    joined = in_flight(key)
+    vgmdata, source = await single_flight(key, lambda: fetch_album_async(catalog, redis_obj, cache_time_in_minutes, stale_time_in_minutes))
+    return vgmdata, "coalesced" if joined else source
+
+async def refresh_album_async(catalog: str, redis_obj: aioredis.Redis, cache_time_in_minutes: int = 30, stale_time_in_minutes: int = None) -> None:
+    # Background refresh of a stale entry, shares the in-flight fetch with any concurrent misses
+    try:
+        await fetch_album_shared(catalog, redis_obj, cache_time_in_minutes, stale_time_in_minutes)
+    except Exception:
+        logger.exception("Error in refreshing stale cache for %s", catalog)
         
 
-@vgmdbapi.get('/{catalog}',response_model=Union[VGMDBPydantic, VGMEntry])
 def get_game_info(catalog: str, convert: int = 0, cache_time_in_minutes=30, nocache: int = 0):
-    
+    """
+    Blocking version of get_game_info_async for callers outside the event loop
+    """
     vgmdata = get_vgmdbdata(catalog)
     redis_obj = get_redis()
     
     if nocache == 0 and redis_obj is not None and os.environ.get("API_NOCACHE", None) != "1":
         is_cached = vgmdata.get_cached_vals(redis_obj)
-        if not is_cached:
-            logger.info("No cache found for %s", catalog)
-            vgmdata.fetch_vals_from_webpage()
-            vgmdata.set_cached_vals(redis_obj, timelimit=cache_time_in_minutes)
+        if not is_cached or vgmdata.cache_stale:
+            logger.info("No fresh cache found for %s", catalog)
+            fetched = get_vgmdbdata(catalog)
+            fetched.fetch_vals_from_webpage(validators=vgmdata.validators if is_cached else None)
+            if fetched.not_modified and is_cached:
+                vgmdata.extend_cached_vals(redis_obj, timelimit=cache_time_in_minutes, validators=fetched.validators)
+            elif fetched.fetch_error and is_cached:
+                logger.info("vgmdb unavailable, keeping cached %s", catalog)
+            else:
+                vgmdata = fetched
+                vgmdata.set_cached_vals(redis_obj, timelimit=cache_time_in_minutes)
     else:
         logger.info("No cache set for %s", catalog)
         vgmdata.fetch_vals_from_webpage()
-        
+    
+    if vgmdata.fetch_error:
+        raise upstream_error(vgmdata)
     if convert == 1:
         return vgmdata.as_db_entry(rating=0, description="Temp", year_listened=2024)
     else:
-        return vgmdata.as_pydantic()
\ No newline at end of file
+        return vgmdata.as_pydantic()
+
+def upstream_error(vgmdata: VGMDataForVGMAPI) -> HTTPException:
+    # Nothing cached to fall back on. 503 with Retry-After while the circuit is open, 502 for a failed fetch
+    if vgmdata.circuit_open:
+        return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="vgmdb is unavailable",
+                             headers={"Retry-After": str(math.ceil(vgmdb_breaker.retry_after()))})
+    return HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Error fetching from vgmdb")
+
+@vgmdbapi.get('/cache/stats')
+def get_cache_stats():
+    return {"L1": album_cache.stats()}
+
+@vgmdbapi.get('/ratelimit/stats')
+def get_ratelimit_stats():
+    return {**vgmdb_limiter.stats(), "circuit": vgmdb_breaker.stats()}
+
+@vgmdbapi.get('/{catalog}',response_model=Union[VGMDBPydantic, VGMEntry])
+async def get_game_info_async(catalog: str, response: Response, background_tasks: BackgroundTasks, convert: int = 0, 
+                              cache_time_in_minutes: int = 30, stale_time_in_minutes: int = None, nocache: int = 0):
+    
+    vgmdata = get_vgmdbdata(catalog)
+    redis_obj = get_async_redis()
+    response.headers["X-Cache"] = "miss"
+    use_cache = nocache == 0 and redis_obj is not None and os.environ.get("API_NOCACHE", None) != "1"
+    
+    # Hot albums are answered from this worker's memory without touching redis
+    body = album_cache.get(f'game:{catalog}') if use_cache else None
+    if body is not None:
+        if convert != 1:
+            return album_response(body, "fresh")
+        response.headers["X-Cache"] = "fresh"
+        cache_requests.inc("fresh")
+        vgmdata._load_cache_dict(orjson.loads(body))
+        return await asyncio.to_thread(vgmdata.as_db_entry, rating=0, description="Temp", year_listened=2024)
+    
+    # Then the response body as it was cached, no parsing, models or validation on the way out
+    if use_cache and convert != 1:
+        cached = await get_response_body_async(redis_obj, catalog)
+        if cached is not None:
+            body, fresh_until = cached
+            if fresh_until < time.time():
+                logger.info("Serving stale cache for %s", catalog)
+                background_tasks.add_task(refresh_album_async, catalog, redis_obj, cache_time_in_minutes, stale_time_in_minutes)
+                return album_response(body, "stale")
+            album_cache.set(f'game:{catalog}', body, size=len(body), ttl=fresh_until - time.time())
+            return album_response(body, "fresh")
+    
+    # Concurrent misses for the same catalog share one fetch, see api.singleflight
+    if use_cache:
+        is_cached = await vgmdata.get_cached_vals_async(redis_obj)
+        if not is_cached:
+            logger.info("No cache found for %s", catalog)
+            vgmdata, source = await fetch_album_shared(catalog, redis_obj, cache_time_in_minutes, stale_time_in_minutes)
+            response.headers["X-Cache"] = source
+        elif vgmdata.cache_stale:
+            logger.info("Serving stale cache for %s", catalog)
+            response.headers["X-Cache"] = "stale"
+            background_tasks.add_task(refresh_album_async, catalog, redis_obj, cache_time_in_minutes, stale_time_in_minutes)
+        else:
+            response.headers["X-Cache"] = "fresh"
+    else:
+        logger.info("No cache set for %s", catalog)
+        vgmdata, _ = await fetch_album_shared(catalog)
+    
+    if vgmdata.fetch_error:
+        cache_requests.inc("error")
+        raise upstream_error(vgmdata)
+    if convert == 1:
+        cache_requests.inc(response.headers["X-Cache"])
+        return await asyncio.to_thread(vgmdata.as_db_entry, rating=0, description="Temp", year_listened=2024)
+    elif use_cache:
+        return album_response(await asyncio.to_thread(remember_album, vgmdata), response.headers["X-Cache"])
+    else:
+        cache_requests.inc("bypass")
+        return await asyncio.to_thread(vgmdata.as_pydantic)
+    
+def remember_album(vgmdata: VGMDataForVGMAPI) -> bytes:
+    """
+    Builds the response body and keeps it in the L1 cache until the redis entry goes stale
+    """
+    body = album_body(vgmdata.as_pydantic())
+    if vgmdata.fresh_until is not None and not vgmdata.cache_stale:
+        album_cache.set(f'game:{vgmdata.catalog}', body, size=len(body), ttl=vgmdata.fresh_until - time.time())
+    return body
+
+def _batch_line(catalog: str, cache: str = None, album: bytes = None, error: str = None) -> bytes:
+    if error is not None:
+        cache_requests.inc("error")
+        return orjson.dumps({"catalog": catalog, "error": error}) + b"\n"
+    cache_requests.inc(cache)
+    # The album body is spliced in as it is, it was serialized once already
+    return orjson.dumps({"catalog": catalog, "cache": cache})[:-1] + b',"album":' + album + b"}\n"
+
+async def _batch_fetch(catalog: str, redis_obj: aioredis.Redis, semaphore: asyncio.Semaphore, cache_time_in_minutes: int) -> bytes:
+    try:
+        async with semaphore:
+            vgmdata, source = await fetch_album_shared(catalog, redis_obj, cache_time_in_minutes)
+        if vgmdata.fetch_error:
+            return _batch_line(catalog, error="vgmdb unavailable" if vgmdata.circuit_open else "Upstream error")
+        if redis_obj is not None:
+            album = await asyncio.to_thread(remember_album, vgmdata)
+        else:
+            album = await asyncio.to_thread(lambda: album_body(vgmdata.as_pydantic()))
+        return _batch_line(catalog, source, album)
+    except Exception:
+        logger.exception("Error in batch lookup of %s", catalog)
+        return _batch_line(catalog, error="Internal error")
+
+async def stream_albums(catalogs: list[str], redis_obj: aioredis.Redis, background_tasks: BackgroundTasks,
+                        concurrency: int = 4, cache_time_in_minutes: int = 30) -> AsyncIterator[bytes]:
+    """
+    Yields one NDJSON line per catalog as soon as it is resolved. L1 and redis hits come first,
+    redis hits with one pipelined read of their stored bodies, then misses as their fetches finish,
+    at most concurrency at a time.
+    A failing album yields an error line instead of ending the stream.
+    """
+    misses = []
+    lookups = []
+    for catalog in catalogs:
+        album = album_cache.get(f'game:{catalog}') if redis_obj is not None else None
+        if album is not None:
+            yield _batch_line(catalog, "fresh", album)
+        else:
+            lookups.append(catalog)
+            
+    cached_bodies = [None] * len(lookups)
+    if redis_obj is not None and lookups:
+        try:
+            cached_bodies = await read_cached_bodies_async(redis_obj, lookups)
+        except RedisError:
+            logger.error("Redis error in batch lookup")
+            
+    without_body = []
+    for catalog, cached in zip(lookups, cached_bodies):
+        if cached is None:
+            misses.append(catalog)
+        elif cached[0] is None:
+            without_body.append(catalog)
+        else:
+            album, fresh_until = cached
+            if fresh_until < time.time():
+                background_tasks.add_task(refresh_album_async, catalog, redis_obj, cache_time_in_minutes)
+                yield _batch_line(catalog, "stale", album)
+            else:
+                album_cache.set(f'game:{catalog}', album, size=len(album), ttl=fresh_until - time.time())
+                yield _batch_line(catalog, "fresh", album)
+                
+    # Cached albums without a stored body are built from the cached values, off the event loop
+    cached_values = [None] * len(without_body)
+    if without_body:
+        try:
+            cached_values = await read_cached_albums_async(redis_obj, without_body)
+        except RedisError:
+            logger.error("Redis error in batch lookup")
+    for catalog, cached in zip(without_body, cached_values):
+        if not cached:
+            misses.append(catalog)
+            continue
+        vgmdata = get_vgmdbdata(catalog)
+        vgmdata._load_cache_dict(cached)
+        try:
+            album = await asyncio.to_thread(remember_album, vgmdata)
+        except Exception:
+            logger.exception("Error in batch lookup of %s", catalog)
+            yield _batch_line(catalog, error="Internal error")
+            continue
+        if vgmdata.cache_stale:
+            background_tasks.add_task(refresh_album_async, catalog, redis_obj, cache_time_in_minutes)
+        yield _batch_line(catalog, "stale" if vgmdata.cache_stale else "fresh", album)
+            
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = [asyncio.create_task(_batch_fetch(catalog, redis_obj, semaphore, cache_time_in_minutes)) for catalog in misses]
+    try:
+        for next_done in asyncio.as_completed(pending):
+            yield await next_done
+    finally:
+        # The client went away, fetches already shared through single_flight carry on for the others
+        for task in pending:
+            task.cancel()
+            
+@vgmdbapi.post('/batch')
+async def get_game_info_batch(data: VGMDBBatchRequest, nocache: int = 0):
+    """
+    Looks up many catalogs at once and streams the results back as NDJSON, one line per catalog
+    in the order they finish: {"catalog", "cache", "album"} or {"catalog", "error"}
+    """
+    redis_obj = get_async_redis()
+    if nocache != 0 or os.environ.get("API_NOCACHE", None) == "1":
+        redis_obj = None
+    background_tasks = BackgroundTasks()
+    catalogs = list(dict.fromkeys(data.catalogs))
+    return StreamingResponse(
+        stream_albums(catalogs, redis_obj, background_tasks, data.concurrency, data.cache_time_in_minutes),
+        media_type="application/x-ndjson",
+        background=background_tasks,
+    )
@@ -1,13 +1,31 @@
 from fastapi.testclient import TestClient
 from api.main import create_app
+from api import httpclient, vgmdbcrawl
+from api.l1cache import album_cache
+from api.ratelimit import vgmdb_limiter
+from api.circuitbreaker import vgmdb_breaker
+from api.db import VGMEntry, Track
 from os.path import exists
 from urllib.request import urlopen
 
 import pytest
 import requests
+import httpx
+import fakeredis
+import fakeredis.aioredis
+
+EXAMPLE_PAGE = './tests/examples/example-vgmdb-page.html'
+# Product link in a sidebar after every album section, then a long comments section
+SIDEBAR_PRODUCT_PAGE = './tests/examples/example-sidebar-product-page.html'
 
 #requests.Response object mocking
 class MockVGMDBRequest():
+    
+    status_code = 200
+    headers = {}
+    
+    def __init__(self, page: str = EXAMPLE_PAGE) -> None:
+        self.page = page
 
     @property
     def content(self):
@@ -21,10 +39,21 @@ class MockVGMDBRequest():
             return html
         else:'''
         content = ""
-        with open('./tests/examples/example-vgmdb-page.html') as file:
+        with open(self.page) as file:
             for line in file:
                 content += line
         return content
+    
+    def iter_content(self, chunk_size=1):
+        content = self.content.encode()
+        for i in range(0, len(content), chunk_size):
+            yield content[i:i + chunk_size]
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
            
 @pytest.fixture(autouse=True)
 def no_requests_get(monkeypatch):
@@ -33,7 +62,76 @@ def no_requests_get(monkeypatch):
         return MockVGMDBRequest()
     
     monkeypatch.setattr(requests, "get", mock_get)
+    
+@pytest.fixture(autouse=True)
+def no_httpx_get(monkeypatch):
+    
+    def mock_handler(request: httpx.Request) -> httpx.Response:
+        content = MockVGMDBRequest().content.encode()
+        # Served in chunks so streaming reads can stop part way through
+        return httpx.Response(200, stream=httpx.ByteStream(content), headers={"Content-Length": str(len(content))})
+    
+    def mock_create_http_client():
+        return httpx.AsyncClient(transport=httpx.MockTransport(mock_handler))
+    
+    monkeypatch.setattr(httpclient, "create_http_client", mock_create_http_client)
+    monkeypatch.setattr(httpclient, "_http_client", None)
+
+@pytest.fixture(autouse=True)
+def empty_album_cache(monkeypatch):
+    monkeypatch.setattr(album_cache, "hits", 0)
+    monkeypatch.setattr(album_cache, "misses", 0)
+    album_cache.clear()
+    yield
+    album_cache.clear()
+
+@pytest.fixture(autouse=True)
+def unthrottled_limiter(monkeypatch):
+    # Tests fetch the mock page far faster than vgmdb would allow and some answer 503 on purpose
+    monkeypatch.setattr(vgmdb_limiter, "rate", 1000.0)
+    monkeypatch.setattr(vgmdb_limiter, "burst", 1000)
+    monkeypatch.setattr(vgmdb_limiter, "backoff_base", 0.0)
+    vgmdb_limiter.reset()
+    yield
+    vgmdb_limiter.reset()
+
+@pytest.fixture(autouse=True)
+def closed_circuit():
+    vgmdb_breaker.reset()
+    yield
+    vgmdb_breaker.reset()
 
 @pytest.fixture
 def fastapi_client():
-    return TestClient(create_app())
\ No newline at end of file
+    return TestClient(create_app())
+
+@pytest.fixture
+def fake_server() -> fakeredis.FakeServer:
+    # One per test, every fake client of the test shares it
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def fake_redis(fake_server) -> fakeredis.FakeRedis:
+    return fakeredis.FakeRedis(server=fake_server)
+
+@pytest.fixture
+def fake_async_redis(fake_server) -> fakeredis.aioredis.FakeRedis:
+    # Only usable inside a single asyncio.run
+    return fakeredis.aioredis.FakeRedis(server=fake_server)
+
+@pytest.fixture
+def route_redis(monkeypatch, fake_server, fake_redis) -> fakeredis.FakeRedis:
+    """
+    Caches the album routes in fake_server and returns a client to check on it. Every call gets a new
+    async client since the test client runs each request on its own event loop
+    """
+    monkeypatch.setattr(vgmdbcrawl, "get_async_redis", lambda: fakeredis.aioredis.FakeRedis(server=fake_server))
+    return fake_redis
+
+# Entry factories for the storage, search and bulk add tests
+def make_entry(game: str, tracks: list[str] = ("Opening",), year: int = 2024, rating: int = 5, catalog_num: str = None) -> VGMEntry:
+    return VGMEntry(rating=rating, year_listened=year, catalog_num=catalog_num or f"CAT-{game}", game=game,
+                    tracks=[Track(disc="1", track_id=n, title=title, duration="1:00") for n, title in enumerate(tracks, 1)])
+
+def make_entries(count: int, **kwargs) -> list[VGMEntry]:
+    return [make_entry(f"Game {n}", **kwargs) for n in range(count)]
@@ -0,0 +1,79 @@
+import pytest
+import requests
+
+from api import archive, vgmdbcrawl
+from api.archive import DiskPageArchive, PageArchive, RedisPageArchive
+from api.vgmdbcrawl import VGMDataForVGMAPI, reparse_archive
+from conftest import MockVGMDBRequest, SIDEBAR_PRODUCT_PAGE
+
+@pytest.fixture
+def example_page() -> bytes:
+    with open('./tests/examples/example-vgmdb-page.html', 'rb') as file:
+        return file.read()
+    
+@pytest.fixture(params=["disk", "redis"])
+def page_archive(request, tmp_path, fake_redis):
+    if request.param == "disk":
+        return DiskPageArchive(str(tmp_path))
+    return RedisPageArchive(fake_redis)
+
+def test_archive_put_latest(page_archive, example_page):
+    assert page_archive.latest("65091") is None
+    digest = page_archive.put("65091", example_page, fetched_at=1)
+    assert page_archive.latest("65091") == example_page
+    assert page_archive.put("65091", example_page, fetched_at=2) == digest
+    page_archive.put("65091", b"<h1>Changed</h1>", fetched_at=3)
+    assert page_archive.latest("65091") == b"<h1>Changed</h1>"
+    assert page_archive.get(digest) == example_page
+    assert list(page_archive.catalogs()) == ["65091"]
+    
+def test_incomplete_archive_fails_on_creation():
+    class NoIndexArchive(PageArchive):
+        def get(self, digest): return None
+        def _has_blob(self, digest): return False
+        def _write_blob(self, digest, blob): pass
+        
+    with pytest.raises(TypeError):
+        NoIndexArchive()
+    
+def test_archive_dedupes_blobs(tmp_path, example_page):
+    page_archive = DiskPageArchive(str(tmp_path))
+    page_archive.put("65091", example_page)
+    page_archive.put("65091", example_page)
+    assert len(page_archive.history("65091")) == 2
+    assert len(list((tmp_path / "blobs").rglob("*.z"))) == 1
+    assert sum(path.stat().st_size for path in (tmp_path / "blobs").rglob("*.z")) < len(example_page)
+    
+def test_fetch_archives_page(monkeypatch, tmp_path, example_page):
+    monkeypatch.setattr(archive, "ARCHIVE_LOCATION", str(tmp_path))
+    VGMDataForVGMAPI(65091).fetch_vals_from_webpage()
+    archived = DiskPageArchive(str(tmp_path)).latest("65091")
+    assert archived is not None and b'id="tracklist"' in archived
+    
+def test_truncated_fetch_not_archived(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_LOCATION", str(tmp_path))
+    monkeypatch.setattr(vgmdbcrawl, "STREAM_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: MockVGMDBRequest(SIDEBAR_PRODUCT_PAGE))
+    streamed = VGMDataForVGMAPI(65091)
+    streamed.fetch_vals_from_webpage(stream=True)
+    assert streamed.fetch_stats["stopped_early"] == True
+    assert DiskPageArchive(str(tmp_path)).latest("65091") is None
+    
+    VGMDataForVGMAPI(65091).fetch_vals_from_webpage(stream=False)
+    assert b'id="comments"' in DiskPageArchive(str(tmp_path)).latest("65091")
+    
+def test_not_found_page_not_archived(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_LOCATION", str(tmp_path))
+    response = type("Response", (), {"status_code": 404, "headers": {}, "content": b"<h1>404 Not Found</h1>"})()
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: response)
+    vgmdata = VGMDataForVGMAPI(65091)
+    vgmdata.fetch_vals_from_webpage(stream=False)
+    assert vgmdata.not_found == True
+    assert DiskPageArchive(str(tmp_path)).latest("65091") is None
+    
+def test_reparse_archive(page_archive, fake_redis, example_page):
+    page_archive.put("65091", example_page)
+    assert reparse_archive(page_archive, fake_redis) == 1
+    cached = VGMDataForVGMAPI(65091)
+    assert cached.get_cached_vals(fake_redis) == True
+    assert cached.title == "NieR:Automata Original Soundtrack"
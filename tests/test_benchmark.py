@@ -0,0 +1,60 @@
+import copy
+
+from bs4 import BeautifulSoup
+
+from api.benchmark import (
+    CONVERSIONS, EXTRACTORS, HUGE_PAGE, baseline_file, benchmark_page, compare, load_baseline, load_corpus, run_benchmarks,
+    uncompared,
+)
+from api.vgmdbcrawl import VGMDataForVGMAPI
+
+def parsed(page: bytes) -> VGMDataForVGMAPI:
+    vgmdata = VGMDataForVGMAPI("benchmark")
+    vgmdata.fetch_vals_from_webpage(content=page)
+    return vgmdata
+
+def test_corpus_pages():
+    corpus = load_corpus()
+    assert {"example", "minimal", "multi-disc", "multi-language", "huge"} <= corpus.keys()
+    huge = parsed(corpus["huge"]).as_pydantic()
+    assert len(huge.Tracks) == HUGE_PAGE["discs"]
+    assert sum(len(tracks) for tracks in huge.Tracks.values()) == HUGE_PAGE["discs"] * HUGE_PAGE["tracks_per_disc"]
+    assert len(huge.Covers) == HUGE_PAGE["covers"]
+    multi_language = BeautifulSoup(corpus["multi-language"], "html.parser")
+    assert len(multi_language.find_all("span", class_="tl")) > 1
+    assert parsed(corpus["minimal"]).as_pydantic().Tracks
+
+def test_benchmark_page():
+    result = benchmark_page(load_corpus()["minimal"], repeat=1)
+    assert set(result["seconds"]) == {"parse", *EXTRACTORS, *CONVERSIONS}
+    assert all(seconds > 0 for seconds in result["seconds"].values())
+    assert result["peak_memory"] > 0
+
+def test_compare_flags_regressions():
+    report = run_benchmarks({"minimal": load_corpus()["minimal"]}, repeat=1)
+    assert compare(report, report) == []
+
+    slower = copy.deepcopy(report)
+    slower["pages"]["minimal"]["relative"]["tracks"] = report["pages"]["minimal"]["relative"]["tracks"] * 3 + 1
+    slower["pages"]["minimal"]["peak_memory"] = report["pages"]["minimal"]["peak_memory"] * 10
+    regressions = compare(slower, report)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("minimal tracks")
+    # Baselines from another parser say nothing about this one
+    assert compare(slower, {**report, "parser": "other"}) == []
+    assert "nothing is compared" in uncompared(slower, {**report, "parser": "other"})[0]
+    # Nor do memory numbers from another python minor version, times still are compared
+    regressions = compare(slower, {**report, "python": "3.0.0"})
+    assert len(regressions) == 1
+    assert regressions[0].startswith("minimal tracks")
+    assert "peak memory is not compared" in uncompared(slower, {**report, "python": "3.0.0"})[0]
+    # Patch releases share a baseline
+    patch = ".".join(report["python"].split(".")[:2] + ["999"])
+    assert len(compare(slower, {**report, "python": patch})) == 2
+    assert uncompared(slower, {**report, "python": patch}) == []
+
+def test_baseline_covers_corpus():
+    assert baseline_file("3.10.12").endswith("baseline-3.10.json")
+    baseline = load_baseline()
+    assert baseline is not None
+    assert set(load_corpus()) == set(baseline["pages"])
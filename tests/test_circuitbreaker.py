@@ -0,0 +1,44 @@
+import time
+
+from api.circuitbreaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+def test_opens_on_failure_rate():
+    breaker = CircuitBreaker(window=10, min_calls=4, failure_rate=0.5, open_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    # Not enough calls yet to judge
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.allow() == False
+    assert breaker.retry_after() > 0
+    assert breaker.stats()["rejected"] == 1
+
+def test_successes_keep_it_closed():
+    breaker = CircuitBreaker(window=10, min_calls=4, failure_rate=0.5)
+    for _ in range(10):
+        breaker.record_success()
+    for _ in range(4):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+
+def test_half_open_probe():
+    breaker = CircuitBreaker(window=4, min_calls=1, failure_rate=0.5, open_seconds=0.05, probes=1)
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow() == True
+    # Only one probe at a time
+    assert breaker.allow() == False
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    
+    time.sleep(0.06)
+    assert breaker.allow() == True
+    breaker.release()
+    assert breaker.allow() == True
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["opened"] == 2
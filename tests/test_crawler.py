@@ -0,0 +1,51 @@
+import pytest
+import json
+import asyncio
+
+import httpx
+
+from api import archive, httpclient
+from api.archive import DiskPageArchive
+from api.crawler import crawl_catalogs, parse_catalog_specs, load_checkpoint
+
+def test_parse_catalog_specs():
+    assert parse_catalog_specs(["100-102", "7,8", "101", "GAME-01"]) == ["100", "101", "102", "7", "8", "GAME-01"]
+
+def test_crawl_resumes_from_checkpoint(tmp_path, fake_async_redis):
+    output = str(tmp_path / "albums.jsonl")
+    checkpoint = str(tmp_path / "albums.jsonl.checkpoint")
+
+    async def run_crawl(catalogs):
+        return await crawl_catalogs(
+            catalogs, output=output, checkpoint=checkpoint, redis_obj=fake_async_redis,
+            client=httpclient.create_http_client(), rate=0, concurrency=2, workers=1,
+        )
+
+    async def run_twice():
+        stats = await run_crawl(["1", "2"])
+        assert stats.pages == 2 and stats.failed == 0
+        assert stats.parse_seconds > 0
+        assert load_checkpoint(checkpoint) == {"1", "2"}
+
+        stats = await run_crawl(["1", "2", "3"])
+        assert stats.pages == 1 and stats.skipped == 2
+        cached = await fake_async_redis.json().get('game:3')
+        assert cached["Title"] == "NieR:Automata Original Soundtrack"
+
+    asyncio.run(run_twice())
+    with open(output) as jsonl:
+        albums = [json.loads(line) for line in jsonl]
+    assert sorted(album["Catalog"] for album in albums) == ["1", "2", "3"]
+    assert all(album["Title"] == "NieR:Automata Original Soundtrack" for album in albums)
+
+def test_crawl_caches_but_does_not_archive_404(tmp_path, fake_async_redis, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_LOCATION", str(tmp_path))
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(404, content=b"<h1>404 Not Found</h1>")))
+
+    async def run_crawl():
+        stats = await crawl_catalogs(["1"], redis_obj=fake_async_redis, client=client, rate=0, concurrency=1, workers=1)
+        assert stats.pages == 1
+        return await fake_async_redis.json().get('game:1', '$.NotFound')
+
+    assert asyncio.run(run_crawl()) == [True]
+    assert DiskPageArchive(str(tmp_path)).latest("1") is None
@@ -0,0 +1,225 @@
+import json
+import pytest
+
+from types import SimpleNamespace
+
+from boto3.dynamodb.types import Binary
+from botocore.exceptions import ClientError
+from fastapi.testclient import TestClient
+
+import fakeredis
+
+from api import db
+from api.db import DynamoDBVGM, InvalidCursor, VGMEntry, VGMStorage, Track, get_vgmdb
+from api.dbcache import QueryCache
+from api.main import create_app
+from conftest import make_entries
+
+class FakeDynamoClient:
+    """
+    Stands in for the resource client's BatchWriteItem, leaves the last item of the first
+    unprocessed_rounds calls unprocessed like a throttled table would
+    """
+    def __init__(self, unprocessed_rounds: int = 0, error: str = None) -> None:
+        self.items = {}
+        self.calls = []
+        self.unprocessed_rounds = unprocessed_rounds
+        self.error = error
+        
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        keys = [(request['PutRequest']['Item']['pk'], request['PutRequest']['Item']['sk']) for request in requests]
+        assert len(requests) <= 25
+        assert len(set(keys)) == len(keys), "duplicate keys in one batch"
+        self.calls.append(len(requests))
+        if self.error:
+            raise ClientError({"Error": {"Code": self.error, "Message": ""}}, "BatchWriteItem")
+        unprocessed = []
+        if self.unprocessed_rounds:
+            self.unprocessed_rounds -= 1
+            unprocessed, requests = requests[-1:], requests[:-1]
+        for request in requests:
+            item = request['PutRequest']['Item']
+            self.items[(item['pk'], item['sk'])] = item
+        return {"UnprocessedItems": {table_name: unprocessed} if unprocessed else {}}
+
+class FakeDynamoTable:
+    """
+    Query over the items the fake client wrote. Pages hold at most page_items items,
+    standing in for DynamoDB's 1 MB page limit.
+    """
+    def __init__(self, client: FakeDynamoClient, page_items: int = 4) -> None:
+        self.client = client
+        self.page_items = page_items
+        self.queries = []
+        
+    def query(self, KeyConditionExpression, Limit=None, ExclusiveStartKey=None, **kwargs):
+        self.queries.append({"Limit": Limit, "ExclusiveStartKey": ExclusiveStartKey})
+        pk = KeyConditionExpression.get_expression()['values'][0].get_expression()['values'][1]
+        keys = sorted(key for key in self.client.items if key[0] == pk)
+        if ExclusiveStartKey:
+            keys = [key for key in keys if key > (ExclusiveStartKey['pk'], ExclusiveStartKey['sk'])]
+        size = min(Limit or self.page_items, self.page_items)
+        page = keys[:size]
+        response = {"Items": [dict(self.client.items[key]) for key in page]}
+        if len(keys) > size:
+            response["LastEvaluatedKey"] = {"pk": page[-1][0], "sk": page[-1][1]}
+        return response
+
+    def put_item(self, Item):
+        self.client.items[(Item['pk'], Item['sk'])] = Item
+
+def fake_vgmdb(client: FakeDynamoClient, table: FakeDynamoTable = None, cache: QueryCache = None) -> DynamoDBVGM:
+    table = table or FakeDynamoTable(client)
+    engine = SimpleNamespace(meta=SimpleNamespace(client=client), Table=lambda name: table)
+    return DynamoDBVGM(engine=engine, table_name="test-table", check_table=False, cache=cache)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(db, "BATCH_WRITE_BACKOFF", 0)
+
+def test_add_many_chunks_and_retries():
+    client = FakeDynamoClient(unprocessed_rounds=2)
+    results = fake_vgmdb(client).add_many(make_entries(60))
+    assert [result.status for result in results] == ["written"] * 60
+    assert [result.index for result in results] == list(range(60))
+    assert len(client.items) == 60
+    # The first chunk's last item stays unprocessed twice and is retried on its own
+    assert client.calls == [25, 1, 1, 25, 10]
+    
+def test_add_many_duplicates_and_failures():
+    client = FakeDynamoClient()
+    entries = make_entries(3)
+    entries.append(entries[0].model_copy(update={"rating": 9}))
+    results = fake_vgmdb(client).add_many(entries)
+    assert [result.status for result in results] == ["duplicate", "written", "written", "written"]
+    assert client.items[("2024", "game|Game 0")]["rating"] == 9
+    
+    results = fake_vgmdb(FakeDynamoClient(error="ProvisionedThroughputExceededException")).add_many(make_entries(2))
+    assert {result.status for result in results} == {"failed"}
+    assert results[0].error == "ProvisionedThroughputExceededException"
+    
+def test_add_many_gives_up_on_unprocessed(monkeypatch):
+    monkeypatch.setattr(db, "BATCH_WRITE_RETRIES", 1)
+    results = fake_vgmdb(FakeDynamoClient(unprocessed_rounds=5)).add_many(make_entries(2))
+    assert [result.status for result in results] == ["written", "failed"]
+    assert results[1].error == "UnprocessedItems"
+
+def test_bulkadd_route():
+    client = FakeDynamoClient()
+    app = create_app()
+    app.dependency_overrides[get_vgmdb] = lambda: fake_vgmdb(client)
+    response = TestClient(app).post('/api/bulkadd', json=[entry.model_dump() for entry in make_entries(30)])
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()] == ["written"] * 30
+    assert len(client.items) == 30
+
+@pytest.fixture
+def year_client() -> FakeDynamoClient:
+    client = FakeDynamoClient()
+    fake_vgmdb(client).add_many(make_entries(10))
+    return client
+
+def test_query_year_follows_pages(year_client):
+    table = FakeDynamoTable(year_client)
+    assert len(fake_vgmdb(year_client, table).query_year("2024")) == 10
+    assert len(table.queries) == 3
+    
+def test_query_year_page_cursor(year_client):
+    vgmdb = fake_vgmdb(year_client)
+    games = []
+    entries, cursor = vgmdb.query_year_page("2024", limit=3)
+    games += [entry.game for entry in entries]
+    while cursor:
+        entries, cursor = vgmdb.query_year_page("2024", limit=3, cursor=cursor)
+        games += [entry.game for entry in entries]
+    assert sorted(games) == sorted(f"Game {n}" for n in range(10))
+    
+    _, cursor = vgmdb.query_year_page("2024", limit=3)
+    with pytest.raises(InvalidCursor):
+        vgmdb.query_year_page("2023", cursor=cursor)
+    with pytest.raises(InvalidCursor):
+        vgmdb.query_year_page("2024", cursor="not a cursor")
+
+def test_year_route_bad_item_is_not_a_cursor_error(year_client):
+    year_client.items[("2024", "game|Game 0")]["rating"] = "not a number"
+    app = create_app()
+    app.dependency_overrides[get_vgmdb] = lambda: fake_vgmdb(year_client)
+    response = TestClient(app).get('/api/year/2024', params={"limit": 4})
+    assert response.status_code == 500
+    assert response.json()["detail"] == "Database Error"
+
+def test_year_route_pages_and_stream(year_client):
+    table = FakeDynamoTable(year_client)
+    app = create_app()
+    app.dependency_overrides[get_vgmdb] = lambda: fake_vgmdb(year_client, table)
+    client = TestClient(app)
+    
+    response = client.get('/api/year/2024', params={"limit": 4})
+    assert len(response.json()) == 4
+    response = client.get('/api/year/2024', params={"limit": 4, "cursor": response.headers["X-Next-Cursor"]})
+    assert len(response.json()) == 4
+    assert client.get('/api/year/2024', params={"cursor": "bad"}).status_code == 400
+    
+    table.queries.clear()
+    response = client.get('/api/year/2024', params={"stream": 1})
+    assert response.status_code == 200
+    assert sorted(entry["game"] for entry in response.json()) == sorted(f"Game {n}" for n in range(10))
+    assert len(table.queries) == 3
+    assert client.get('/api/year/1999', params={"stream": 1}).status_code == 404
+
+def test_query_year_cached_and_invalidated(year_client):
+    table = FakeDynamoTable(year_client)
+    fake_redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    vgmdb = fake_vgmdb(year_client, table, cache=QueryCache(lambda: fake_redis))
+    
+    assert len(vgmdb.query_year("2024")) == 10
+    queries = len(table.queries)
+    cached = vgmdb.query_year("2024")
+    assert len(table.queries) == queries
+    assert isinstance(cached[0], VGMEntry)
+    
+    vgmdb.add(VGMEntry(rating=1, year_listened=2024, catalog_num="NEW-1", game="New Game"))
+    assert fake_redis.exists("db:year:2024") == 0
+    assert len(vgmdb.query_year("2024")) == 11
+    vgmdb.add_many(make_entries(1) + [VGMEntry(rating=1, year_listened=2024, catalog_num="NEW-2", game="Newer Game")])
+    assert len(vgmdb.query_year("2024")) == 12
+
+def make_soundtrack(discs: int = 4, per_disc: int = 50) -> VGMEntry:
+    tracks = [Track(disc=f"Disc {disc} [SQEX-1058{disc}]", track_id=n, title=f"Battle Theme {disc}-{n}", duration="3:21")
+              for disc in range(1, discs + 1) for n in range(per_disc)]
+    return VGMEntry(rating=5, year_listened=2024, catalog_num="SQEX-10589", game="Long Soundtrack", tracks=tracks)
+
+def test_packed_tracks_roundtrip():
+    entry = make_soundtrack()
+    packed = db.encode_tracks(entry.tracks)
+    assert packed[0] == db.TRACKS_FORMAT
+    assert db.decode_tracks(packed) == entry.tracks
+    assert len(packed) * 4 < len(json.dumps([track.model_dump() for track in entry.tracks]))
+    with pytest.raises(ValueError):
+        db.decode_tracks(b"\x7f" + packed[1:])
+
+def test_packed_tracks_in_items():
+    entry = make_soundtrack(discs=1, per_disc=3)
+    item = entry.get_dynamo_formatted_dict()
+    assert "tracks" not in item
+    assert isinstance(item["tracks_packed"], bytes)
+    # Reads get a boto3 Binary back, and items written before packing still have the list of maps
+    item["tracks_packed"] = Binary(item["tracks_packed"])
+    legacy = {**entry.get_dynamo_pksk(), "rating": 5, "catalog_num": "OLD-1", "tracks": [track.model_dump() for track in entry.tracks]}
+    packed_entry, legacy_entry = DynamoDBVGM._entries_from_items([item, legacy])
+    assert packed_entry.tracks == entry.tracks == legacy_entry.tracks
+
+def test_incomplete_storage_fails_on_creation():
+    class NoIndexStorage(VGMStorage):
+        # Everything but iter_all_pages, which the search index is built from
+        def ensure_table(self): pass
+        def add(self, data): return data
+        def _write_many(self, entries, indexes): return {}
+        def update(self, data): return data
+        def delete(self, data): return {}
+        def query_year_page(self, year, limit=None, cursor=None): return [], None
+        def _query_game(self, game): return {}
+        
+    with pytest.raises(TypeError):
+        NoIndexStorage()
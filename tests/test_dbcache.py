@@ -0,0 +1,40 @@
+import pytest
+
+from api.dbcache import QueryCache
+
+def test_read_through(fake_redis):
+    cache = QueryCache(lambda: fake_redis, ttl=60)
+    loads = []
+    
+    def load():
+        loads.append(1)
+        return "value"
+    
+    assert cache.read_through("year:2024", load, str.encode, bytes.decode) == "value"
+    assert cache.read_through("year:2024", load, str.encode, bytes.decode) == "value"
+    assert len(loads) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1}
+    assert 0 < fake_redis.ttl("db:year:2024") <= 60
+    
+    cache.invalidate("year:2024")
+    assert fake_redis.exists("db:year:2024") == 0
+    cache.read_through("year:2024", load, str.encode, bytes.decode)
+    assert len(loads) == 2
+
+def test_write_during_load_is_not_cached(fake_redis):
+    cache = QueryCache(lambda: fake_redis)
+    
+    def racing_load():
+        # A writer invalidates after this reader read the old value from the database
+        cache.invalidate("game:Test")
+        return "old"
+    
+    assert cache.read_through("game:Test", racing_load, str.encode, bytes.decode) == "old"
+    assert fake_redis.exists("db:game:Test") == 0
+    assert cache.read_through("game:Test", lambda: "new", str.encode, bytes.decode) == "new"
+    assert fake_redis.get("db:game:Test") == b"new"
+
+def test_no_redis_loads_directly():
+    cache = QueryCache(lambda: None)
+    assert cache.read_through("year:2024", lambda: "value", str.encode, bytes.decode) == "value"
+    cache.invalidate("year:2024")
@@ -0,0 +1,60 @@
+import pytest
+import asyncio
+import time
+import fakeredis
+import fakeredis.aioredis
+
+from api import l1cache
+from api.l1cache import L1Cache
+
+def test_l1_get_set():
+    cache = L1Cache(max_entries=10, max_bytes=1000, ttl=60)
+    assert cache.get("game:1") is None
+    cache.set("game:1", {"Title": "Test"}, size=10)
+    assert cache.get("game:1") == {"Title": "Test"}
+    cache.invalidate("game:1")
+    assert cache.get("game:1") is None
+    assert cache.stats() == {"entries": 0, "bytes": 0, "hits": 1, "misses": 2, "evictions": 0}
+    
+def test_l1_eviction():
+    cache = L1Cache(max_entries=2, max_bytes=100, ttl=60)
+    cache.set("game:1", 1, size=10)
+    cache.set("game:2", 2, size=10)
+    cache.get("game:1")
+    cache.set("game:3", 3, size=10)
+    # game:2 was the least recently used
+    assert cache.get("game:2") is None
+    assert cache.get("game:1") == 1
+    cache.set("game:4", 4, size=95)
+    assert len(cache) == 1
+    assert cache.stats()["evictions"] == 3
+    cache.set("game:5", 5, size=101)
+    assert cache.get("game:5") is None
+    
+def test_l1_expiry(monkeypatch):
+    cache = L1Cache(ttl=60)
+    cache.set("game:1", 1, size=1, ttl=600)
+    cache.set("game:2", 2, size=1, ttl=0)
+    assert cache.get("game:2") is None
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert cache.get("game:1") is None
+    
+def test_l1_invalidation_listener(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(l1cache, "get_async_redis", lambda: fakeredis.aioredis.FakeRedis(server=server))
+    cache = L1Cache()
+    publisher = fakeredis.aioredis.FakeRedis(server=server)
+    
+    async def run():
+        async with l1cache.l1_lifespan(cache):
+            await asyncio.sleep(0.05)
+            cache.set("game:1", 1, size=1)
+            cache.set("game:2", 2, size=1)
+            await publisher.publish(l1cache.L1_INVALIDATE_CHANNEL, "another-worker|game:1")
+            await publisher.publish(l1cache.L1_INVALIDATE_CHANNEL, f"{l1cache.WORKER_ID}|game:2")
+            await asyncio.sleep(0.05)
+            assert cache.get("game:1") is None
+            assert cache.get("game:2") == 2
+            
+    asyncio.run(run())
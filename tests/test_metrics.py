@@ -0,0 +1,79 @@
+import pytest
+
+from fastapi.testclient import TestClient
+
+from api.metrics import (
+    METRICS_EXPIRY_KEY, METRICS_SNAPSHOTS_KEY, MetricsRegistry, Counter, Histogram, REGISTRY, collect_metrics, flush_metrics, render,
+)
+
+@pytest.fixture
+def registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.register(Histogram("test_seconds", "Test stages", ["stage"], buckets=(0.1, 1.0)))
+    registry.register(Counter("test_total", "Test results", ["result"]))
+    return registry
+
+def test_render(registry):
+    registry.metrics["test_seconds"].observe(0.05, "parse")
+    registry.metrics["test_seconds"].observe(0.5, "parse")
+    registry.metrics["test_seconds"].observe(5, "parse")
+    registry.metrics["test_total"].inc('say "hi"')
+    text = render(registry.snapshot())
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{stage="parse",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="parse",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="parse",le="+Inf"} 3' in text
+    assert 'test_seconds_sum{stage="parse"} 5.55' in text
+    assert 'test_seconds_count{stage="parse"} 3' in text
+    assert 'test_total{result="say \\"hi\\""} 1' in text
+
+def test_nested_stage_observed_once(registry):
+    histogram = registry.metrics["test_seconds"]
+    with histogram.time("model_build"):
+        with histogram.time("model_build"), histogram.time("cache_set"):
+            pass
+    with histogram.time("model_build"):
+        pass
+    text = render(registry.snapshot())
+    assert 'test_seconds_count{stage="model_build"} 2' in text
+    assert 'test_seconds_count{stage="cache_set"} 1' in text
+
+def test_workers_add_up(registry, fake_redis):
+    other = MetricsRegistry()
+    other.register(Histogram("test_seconds", "Test stages", ["stage"], buckets=(0.1, 1.0))).observe(0.5, "parse")
+    other.register(Counter("test_total", "Test results", ["result"])).inc("hit", amount=2)
+    flush_metrics(fake_redis, other, worker_id="other-worker")
+
+    registry.metrics["test_total"].inc("hit")
+    flush_metrics(fake_redis, registry)
+    text = collect_metrics(fake_redis, registry)
+    # This worker's own flushed snapshot is not counted twice
+    assert 'test_total{result="hit"} 3' in text
+    assert 'test_seconds_count{stage="parse"} 1' in text
+    assert collect_metrics(None, registry).count('test_total{result="hit"} 1') == 1
+
+def test_stopped_workers_drop_out(registry, fake_redis):
+    other = MetricsRegistry()
+    other.register(Counter("test_total", "Test results", ["result"])).inc("hit", amount=2)
+    flush_metrics(fake_redis, other, worker_id="stopped-worker")
+    fake_redis.zadd(METRICS_EXPIRY_KEY, {"stopped-worker": 1})
+
+    assert 'test_total{result="hit"}' not in collect_metrics(fake_redis, registry)
+    assert fake_redis.hexists(METRICS_SNAPSHOTS_KEY, "stopped-worker") == 0
+    assert fake_redis.zscore(METRICS_EXPIRY_KEY, "stopped-worker") is None
+
+def test_metrics_endpoint(fastapi_client: TestClient, route_redis):
+    REGISTRY.reset()
+    fastapi_client.get("/api/vgmdb/65091")
+    fastapi_client.get("/api/vgmdb/65091")
+
+    response = fastapi_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    for stage in ("cache_get", "upstream_fetch", "parse", "extract_tracks", "model_build", "cache_set"):
+        assert f'vgmapi_stage_seconds_count{{stage="{stage}"}}' in text
+    assert 'stage="redis_connect"' not in text
+    assert 'vgmapi_cache_requests_total{result="miss"} 1' in text
+    assert 'vgmapi_cache_requests_total{result="fresh"} 1' in text
+    assert 'vgmapi_upstream_responses_total{status="200"} 1' in text
@@ -0,0 +1,60 @@
+import pytest
+import asyncio
+import time
+
+from api.ratelimit import TokenBucket, RateLimitTimeout, parse_retry_after
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("not a date") is None
+    assert 0 < parse_retry_after(time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 60))) <= 60
+
+def test_bucket_shared_between_workers(fake_redis):
+    # Two limiters on one redis stand in for two workers, they drain the same bucket
+    first = TokenBucket(rate=20, burst=2)
+    second = TokenBucket(rate=20, burst=2)
+    assert first.acquire(fake_redis) == 0
+    assert second.acquire(fake_redis) == 0
+    waited = first.acquire(fake_redis)
+    assert waited > 0
+    assert first.stats()["waited"] == 1
+    assert first.stats()["wait_seconds_max"] == waited
+
+def test_acquire_timeout(fake_redis):
+    bucket = TokenBucket(rate=0.1, burst=1)
+    bucket.acquire(fake_redis)
+    with pytest.raises(RateLimitTimeout):
+        bucket.acquire(fake_redis, timeout=0.5)
+    assert bucket.stats()["timeouts"] == 1
+
+def test_backoff_from_retry_after(fake_redis):
+    bucket = TokenBucket(rate=100, burst=10)
+    bucket.record_response(fake_redis, 429, "1")
+    assert float(fake_redis.get(bucket.backoff_key)) >= time.time() + 0.5
+    with pytest.raises(RateLimitTimeout):
+        bucket.acquire(fake_redis, timeout=0.2)
+    # A shorter backoff from another worker does not cut the longer one short
+    bucket.record_response(fake_redis, 503)
+    assert float(fake_redis.get(bucket.backoff_key)) >= time.time() + 0.5
+    bucket.record_response(fake_redis, 200)
+    assert fake_redis.get(bucket.failures_key) is None
+    assert bucket.stats()["upstream_errors"] == 2
+
+def test_backoff_grows_exponentially(monkeypatch):
+    monkeypatch.setattr("random.uniform", lambda low, high: high)
+    bucket = TokenBucket(backoff_base=1, backoff_max=8)
+    assert [bucket._backoff_seconds(failures, None) for failures in range(1, 6)] == [1, 2, 4, 8, 8]
+
+def test_local_fallback_and_async(fake_async_redis):
+    bucket = TokenBucket(rate=20, burst=1)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+
+    async def run_async():
+        assert await bucket.acquire_async(fake_async_redis) == 0
+        assert await bucket.acquire_async(fake_async_redis) > 0
+        await bucket.record_response_async(fake_async_redis, 503, "1")
+        assert await fake_async_redis.get(bucket.backoff_key) is not None
+
+    asyncio.run(run_async())
@@ -0,0 +1,52 @@
+import time
+
+import pytest
+import redis
+import fakeredis
+
+from api import redisconfig
+
+@pytest.fixture
+def fake_pool():
+    redisconfig.close_redis()
+    yield fakeredis.FakeRedis().connection_pool
+    redisconfig.close_redis()
+
+def test_get_redis_nocache(monkeypatch):
+    monkeypatch.setenv("API_NOCACHE", "1")
+    assert redisconfig.get_redis() is None
+
+def test_get_redis_shared_client(monkeypatch, fake_pool):
+    monkeypatch.setenv("API_NOCACHE", "0")
+    client = redisconfig.init_redis(connection_pool=fake_pool)
+    assert redisconfig.get_redis() is client
+    assert redisconfig.get_redis() is redisconfig.get_redis()
+
+def test_get_redis_unhealthy_no_handshake(monkeypatch, fake_pool):
+    monkeypatch.setenv("API_NOCACHE", "0")
+    client = redisconfig.init_redis(connection_pool=fake_pool)
+
+    def fail_ping(*args, **kwargs):
+        raise ConnectionError("Redis is down")
+
+    monkeypatch.setattr(client, "ping", fail_ping)
+    assert redisconfig.check_redis() == False
+    # The hot path must not retry the connection, it just skips the cache
+    assert redisconfig.get_redis() is None
+    monkeypatch.undo()
+    monkeypatch.setenv("API_NOCACHE", "0")
+    assert redisconfig.check_redis() == True
+    assert redisconfig.get_redis() is client
+
+def test_exhausted_pool_fails_fast(monkeypatch):
+    from api.vgmdbcrawl import VGMDataForVGMAPI
+    monkeypatch.setattr(redisconfig, "POOL_TIMEOUT", 0.1)
+    settings = redisconfig.pool_settings({"max_connections": 1})
+    assert settings["timeout"] == 0.1
+    pool = redis.BlockingConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer(), **settings)
+    held = pool.get_connection("GET")
+    start = time.monotonic()
+    # No connection to be had, the lookup skips the cache instead of waiting on the pool
+    assert VGMDataForVGMAPI("65091").get_cached_vals(redis.Redis(connection_pool=pool)) == False
+    assert time.monotonic() - start < 1
+    pool.release(held)
@@ -0,0 +1,95 @@
+import pytest
+
+from fastapi.testclient import TestClient
+
+from api.db import VGMEntry
+from api.main import create_app
+from api import vgmdbcrawl
+from api.search import SearchIndex, credits_observer, search_index, search_observer, load_cached_credits, tokenize
+from api.sqlitedb import SQLiteVGM
+from conftest import make_entry
+
+@pytest.fixture
+def index() -> SearchIndex:
+    index = SearchIndex()
+    index.upsert(make_entry("Final Fantasy VI", ["Terra's Theme", "Dancing Mad"]))
+    index.upsert(make_entry("Chrono Trigger", ["Corridors of Time", "To Far Away Times"], year=2023))
+    index.upsert(make_entry("Pokémon Red", ["Route 1"]))
+    return index
+
+def test_tokenize_folds_case_and_accents():
+    assert tokenize("Pokémon: RED/Blue") == ["pokemon", "red", "blue"]
+    assert tokenize(None) == []
+
+def test_exact_prefix_and_fuzzy(index):
+    assert [result.game for result in index.search("chrono trigger")] == ["Chrono Trigger"]
+    assert [result.game for result in index.search("fin fant")] == ["Final Fantasy VI"]
+    # One typo away
+    assert [result.game for result in index.search("chrona")] == ["Chrono Trigger"]
+    assert [result.game for result in index.search("pokemon")] == ["Pokémon Red"]
+    assert index.search("chrono mad") == []
+    assert index.search("   ") == []
+
+def test_ranking_and_matched_tracks(index):
+    index.upsert(make_entry("Time Stories"))
+    results = index.search("time")
+    # A game name match outranks a track title match
+    assert [result.game for result in results] == ["Time Stories", "Chrono Trigger"]
+    assert results[1].tracks == ["Corridors of Time", "To Far Away Times"]
+    assert results[0].score > results[1].score
+    assert len(index.search("time", limit=1)) == 1
+
+def test_remove_and_update_keep_tracks(index):
+    index.apply("update", [VGMEntry(rating=1, year_listened=2024, catalog_num="CAT-X", game="Final Fantasy VI")])
+    result, = index.search("dancing")
+    assert result.catalog_num == "CAT-X"
+    index.remove(2024, "Final Fantasy VI")
+    assert index.search("dancing") == []
+    assert index.search("final") == []
+    assert "dancing" not in index._vocabulary
+
+def test_cached_credits(fake_redis):
+    fake_redis.json().set("game:CAT-1", "$", {"AlbumInfo": {"Catalog Number": "CAT-1"}, "Credits": {"Composer": "Nobuo Uematsu"}})
+    fake_redis.json().set("game:CAT-2", "$", {"NotFound": True})
+    index = SearchIndex()
+    index.upsert(make_entry("Final Fantasy VI", catalog_num="CAT-1"))
+    load_cached_credits(index, fake_redis)
+    assert [result.game for result in index.search("uematsu")] == ["Final Fantasy VI"]
+
+def test_credits_follow_album_cache_writes(fake_redis, monkeypatch):
+    index = SearchIndex()
+    index.upsert(make_entry("NieR:Automata", catalog_num="SQEX-10589~91"))
+    monkeypatch.setattr(vgmdbcrawl, "album_observers", [credits_observer(index)])
+    assert index.search("okabe") == []
+    album = vgmdbcrawl.VGMDataForVGMAPI(65091)
+    album.fetch_vals_from_webpage()
+    assert album.set_cached_vals(fake_redis) == True
+    assert [result.game for result in index.search("okabe")] == ["NieR:Automata"]
+
+def test_build_and_follow_writes(tmp_path):
+    storage = SQLiteVGM(str(tmp_path / "vgmapi.sqlite3"))
+    storage.add_many([make_entry("Chrono Trigger", ["Corridors of Time"]), make_entry("Chrono Cross")])
+    index = SearchIndex()
+    index.build(storage)
+    assert index.ready
+    assert {result.game for result in index.search("chrono")} == {"Chrono Trigger", "Chrono Cross"}
+
+    storage.observers.append(search_observer(index))
+    storage.add(make_entry("Secret of Mana", ["Fear of the Heavens"]))
+    storage.delete(make_entry("Chrono Cross"))
+    assert [result.game for result in index.search("chrono")] == ["Chrono Trigger"]
+    assert [result.game for result in index.search("heavens")] == ["Secret of Mana"]
+    storage.close()
+
+def test_search_route():
+    search_index.upsert(make_entry("Final Fantasy VI", ["Dancing Mad"]))
+    try:
+        client = TestClient(create_app())
+        response = client.get('/api/search', params={"q": "dancng"})
+        assert response.status_code == 200
+        assert response.json()[0]["game"] == "Final Fantasy VI"
+        assert response.json()[0]["tracks"] == ["Dancing Mad"]
+        assert response.headers["X-Search-Index"] == "building"
+        assert client.get('/api/search', params={"q": ""}).status_code == 422
+    finally:
+        search_index.clear()
@@ -0,0 +1,96 @@
+import pytest
+import asyncio
+import functools
+import fakeredis
+import fakeredis.aioredis
+
+from api.singleflight import single_flight, redis_lock
+from api import vgmdbcrawl
+
+def test_single_flight_coalesces():
+    calls = []
+    
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+    
+    async def run():
+        results = await asyncio.gather(*[single_flight("game:1", work) for _ in range(10)])
+        assert results == [1] * 10
+        assert await single_flight("game:1", work) == 2
+        
+    asyncio.run(run())
+    assert len(calls) == 2
+    
+def test_single_flight_exception():
+    
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError("Upstream failed")
+    
+    async def run():
+        results = await asyncio.gather(*[single_flight("game:2", work) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+    
+    asyncio.run(run())
+    
+def test_redis_lock():
+    redis_obj = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+    
+    async def run():
+        async with redis_lock(redis_obj, "lock:game:1") as acquired:
+            assert acquired == True
+            async with redis_lock(redis_obj, "lock:game:1", wait=0.1) as second:
+                assert second == False
+        assert await redis_obj.get("lock:game:1") is None
+        async with redis_lock(redis_obj, "lock:game:1", wait=0) as acquired:
+            assert acquired == True
+            
+    asyncio.run(run())
+    
+def test_fetch_album_async_coalesces(monkeypatch):
+    redis_obj = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+    fetches = []
+    original_fetch = vgmdbcrawl.VGMDBData.fetch_vals_from_webpage_async
+    
+    async def counting_fetch(self, *args, **kwargs):
+        fetches.append(self.catalog)
+        await original_fetch(self, *args, **kwargs)
+    
+    monkeypatch.setattr(vgmdbcrawl.VGMDBData, "fetch_vals_from_webpage_async", counting_fetch)
+    
+    async def run():
+        albums = await asyncio.gather(*[vgmdbcrawl.fetch_album_shared(65091, redis_obj) for _ in range(5)])
+        assert all(album.title == "NieR:Automata Original Soundtrack" for album, _ in albums)
+        assert [source for _, source in albums] == ["miss"] + ["coalesced"] * 4
+        # A second worker that missed the cache before the first one finished reads the cache under the lock
+        album, source = await vgmdbcrawl.fetch_album_async(65091, redis_obj)
+        assert album.title == "NieR:Automata Original Soundtrack"
+        assert source == "fresh"
+        
+    asyncio.run(run())
+    assert fetches == [65091]
+    
+def test_fetch_album_async_serves_fresh_without_lock(monkeypatch):
+    redis_obj = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+    fetches = []
+    original_fetch = vgmdbcrawl.VGMDBData.fetch_vals_from_webpage_async
+    
+    async def counting_fetch(self, *args, **kwargs):
+        fetches.append(self.catalog)
+        await original_fetch(self, *args, **kwargs)
+    
+    monkeypatch.setattr(vgmdbcrawl.VGMDBData, "fetch_vals_from_webpage_async", counting_fetch)
+    monkeypatch.setattr(vgmdbcrawl, "redis_lock", functools.partial(redis_lock, wait=0))
+    
+    async def run():
+        assert (await vgmdbcrawl.fetch_album_async(65091, redis_obj))[1] == "miss"
+        # Another worker holds the lock for longer than this one waits
+        await redis_obj.set("lock:game:65091", "other-worker")
+        album, source = await vgmdbcrawl.fetch_album_async(65091, redis_obj)
+        assert source == "fresh"
+        assert album.title == "NieR:Automata Original Soundtrack"
+        
+    asyncio.run(run())
+    assert fetches == [65091]
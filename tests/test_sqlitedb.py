@@ -0,0 +1,84 @@
+import pytest
+import threading
+
+from fastapi.testclient import TestClient
+
+from api import db
+from api.db import get_vgmdb, create_vgmdb
+from api.main import create_app
+from api.sqlitedb import SQLiteVGM
+from conftest import make_entry
+
+@pytest.fixture
+def sqlite_vgmdb(tmp_path) -> SQLiteVGM:
+    vgmdb = SQLiteVGM(str(tmp_path / "vgmapi.sqlite3"))
+    yield vgmdb
+    vgmdb.close()
+
+def test_wal_mode(sqlite_vgmdb):
+    assert sqlite_vgmdb.connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+def test_add_query_update_delete(sqlite_vgmdb):
+    sqlite_vgmdb.add(make_entry("B Game"))
+    sqlite_vgmdb.add(make_entry("A Game"))
+    sqlite_vgmdb.add(make_entry("Other Year", year=2023))
+    
+    assert [entry.game for entry in sqlite_vgmdb.query_year("2024")] == ["A Game", "B Game"]
+    game = sqlite_vgmdb.query_game("A Game")
+    assert game.tracks[0].title == "Opening"
+    assert sqlite_vgmdb.query_game("Missing") == {}
+    
+    sqlite_vgmdb.update(make_entry("A Game", rating=10))
+    assert sqlite_vgmdb.query_game("A Game").rating == 10
+    assert sqlite_vgmdb.delete(make_entry("A Game")) == make_entry("A Game")
+    assert sqlite_vgmdb.delete(make_entry("A Game")) == {}
+    assert [entry.game for entry in sqlite_vgmdb.query_year("2024")] == ["B Game"]
+
+def test_pages_and_bulk_add(sqlite_vgmdb):
+    entries = [make_entry(f"Game {n:02}") for n in range(7)]
+    results = sqlite_vgmdb.add_many(entries + [make_entry("Game 00", rating=9)])
+    assert [result.status for result in results] == ["duplicate"] + ["written"] * 7
+    
+    games = []
+    page, cursor = sqlite_vgmdb.query_year_page("2024", limit=3)
+    games += [entry.game for entry in page]
+    while cursor:
+        page, cursor = sqlite_vgmdb.query_year_page("2024", limit=3, cursor=cursor)
+        games += [entry.game for entry in page]
+    assert games == [f"Game {n:02}" for n in range(7)]
+    assert sqlite_vgmdb.query_game("Game 00").rating == 9
+    with pytest.raises(ValueError):
+        sqlite_vgmdb.query_year_page("2023", cursor=cursor or sqlite_vgmdb.query_year_page("2024", limit=1)[1])
+
+def test_connection_per_thread(sqlite_vgmdb):
+    sqlite_vgmdb.add(make_entry("Threaded"))
+    found = []
+    thread = threading.Thread(target=lambda: found.append(sqlite_vgmdb.query_game("Threaded")))
+    thread.start()
+    thread.join()
+    assert found[0].game == "Threaded"
+
+def test_selected_by_get_vgmdb(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "VGM_STORAGE", "sqlite")
+    monkeypatch.setattr("api.sqlitedb.SQLITE_PATH", str(tmp_path / "selected.sqlite3"))
+    selected = create_vgmdb()
+    assert isinstance(selected, SQLiteVGM)
+    assert selected.path == str(tmp_path / "selected.sqlite3")
+    with pytest.raises(ValueError):
+        create_vgmdb("postgres")
+
+def test_routes_on_sqlite(sqlite_vgmdb):
+    app = create_app()
+    app.dependency_overrides[get_vgmdb] = lambda: sqlite_vgmdb
+    client = TestClient(app)
+    response = client.post('/api/bulkadd', json=[make_entry(f"Game {n}").model_dump() for n in range(3)])
+    assert response.status_code == 200
+    assert len(client.get('/api/year/2024').json()) == 3
+    assert client.get('/api/game/Game 1').json()["game"] == "Game 1"
+    assert len(client.get('/api/year/2024', params={"stream": 1}).json()) == 3
+
+def test_reads_unpacked_tracks(sqlite_vgmdb):
+    # Rows written before tracks were packed hold them as JSON text
+    sqlite_vgmdb.connection.execute("INSERT INTO entries VALUES (2024, 'Old Game', 'OLD-1', 5, NULL, NULL, NULL, ?)",
+                                    ('[{"disc": "1", "track_id": 1, "title": "Opening", "duration": "1:00"}]',))
+    assert sqlite_vgmdb.query_game("Old Game").tracks[0].title == "Opening"
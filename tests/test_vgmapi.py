@@ -82,4 +82,9 @@ def test_get_vgm(mock_db_entry_response):
     assert response.status_code == 200
     assert response.json() == fake_db_entry
 
-    
\ No newline at end of file
+    
+def test_get_vgmdb_shared():
+    db = get_vgmdb()
+    assert db is get_vgmdb()
+    # No DescribeTable round trip until init_vgmdb runs on startup
+    assert db._exists is None
@@ -1,11 +1,18 @@
 import pytest
 import json
+import asyncio
+import sys
 
+from api import vgmdbcrawl, httpclient
 from api.vgmdbcrawl import VGMDataForVGMAPI, VGMEntry
+from api.l1cache import album_cache
 
 import fakeredis
+import requests
+import httpx
 from bs4 import BeautifulSoup
 from fastapi.testclient import TestClient
+from conftest import MockVGMDBRequest, SIDEBAR_PRODUCT_PAGE
 
 ##### 65091  
     
@@ -27,10 +34,6 @@ def example_db_to_json():
 def vgmapi_obj() -> VGMDataForVGMAPI:
     return VGMDataForVGMAPI(65091)
 
-@pytest.fixture()
-def fake_redis() -> fakeredis.FakeRedis:
-    return fakeredis.FakeRedis()
-
 def test_fetch_vals_from_webpage(vgmapi_obj):
     
     vgmapi_obj.fetch_vals_from_webpage()
@@ -153,3 +156,319 @@ def test_get_game_info(fastapi_client: TestClient, example_vgmdb_to_json):
     
     response = fastapi_client.get("/api/vgmdb/65091", params={"convert":1})
     assert response.status_code == 200
+
+def test_fetch_vals_from_webpage_async(vgmapi_obj):
+    asyncio.run(vgmapi_obj.fetch_vals_from_webpage_async())
+    assert isinstance(vgmapi_obj.soup, BeautifulSoup)
+    assert vgmapi_obj.title == "NieR:Automata Original Soundtrack"
+
+def test_cache_async(vgmapi_obj, fake_async_redis):
+    
+    async def run_cache():
+        assert await vgmapi_obj.get_cached_vals_async(fake_async_redis) == False
+        await vgmapi_obj.fetch_vals_from_webpage_async()
+        assert await vgmapi_obj.set_cached_vals_async(fake_async_redis) == True
+        assert isinstance(await fake_async_redis.json().get('game:65091'), dict)
+        assert await fake_async_redis.ttl('game:65091') > 0
+        cached = VGMDataForVGMAPI(65091)
+        assert await cached.get_cached_vals_async(fake_async_redis) == True
+        assert cached.title == "NieR:Automata Original Soundtrack"
+        
+    asyncio.run(run_cache())
+
+@pytest.mark.parametrize("parser,strain", [("html.parser", None), ("lxml", None), ("lxml", False)])
+def test_parser_backends_match(parser, strain):
+    if parser == "lxml":
+        pytest.importorskip("lxml")
+    with open('./tests/examples/example-vgmdb-page.html') as file:
+        page = file.read()
+        
+    full = VGMDataForVGMAPI(65091, parser="html.parser", strain=False)
+    full.fetch_vals_from_webpage(page)
+    backend = VGMDataForVGMAPI(65091, parser=parser, strain=strain)
+    backend.fetch_vals_from_webpage(page)
+    
+    assert backend.as_pydantic() == full.as_pydantic()
+    assert backend.soup.find('div', id='tracklist') is not None
+    if parser == "lxml" and strain is None:
+        assert backend.soup.find('span', id='albumtools') is None
+
+def test_fetch_vals_streaming(monkeypatch):
+    monkeypatch.setattr(vgmdbcrawl, "STREAM_CHUNK_SIZE", 1024)
+    full = VGMDataForVGMAPI(65091)
+    full.fetch_vals_from_webpage()
+    streamed = VGMDataForVGMAPI(65091)
+    streamed.fetch_vals_from_webpage(stream=True)
+    
+    # The example page has no product link, one could still come so it is read to the end
+    assert streamed.fetch_stats["stopped_early"] == False
+    assert streamed.as_pydantic() == full.as_pydantic()
+    
+    streamed_async = VGMDataForVGMAPI(65091)
+    asyncio.run(streamed_async.fetch_vals_from_webpage_async(stream=True))
+    assert streamed_async.as_pydantic() == full.as_pydantic()
+
+def test_fetch_vals_streaming_product_after_sections(monkeypatch):
+    # vgmdb lists the product in the sidebar, after every album section and before the comments
+    with open(SIDEBAR_PRODUCT_PAGE, 'rb') as file:
+        page = file.read()
+    monkeypatch.setattr(vgmdbcrawl, "STREAM_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: MockVGMDBRequest(SIDEBAR_PRODUCT_PAGE))
+    full = VGMDataForVGMAPI(65091)
+    full.fetch_vals_from_webpage()
+    streamed = VGMDataForVGMAPI(65091)
+    streamed.fetch_vals_from_webpage(stream=True)
+    
+    assert full.game == "Sidebar Game"
+    assert streamed.fetch_stats["stopped_early"] == True
+    assert streamed.fetch_stats["bytes_received"] < len(page) // 2
+    assert streamed.as_pydantic() == full.as_pydantic()
+    
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=httpx.ByteStream(page))))
+    streamed_async = VGMDataForVGMAPI(65091)
+    asyncio.run(streamed_async.fetch_vals_from_webpage_async(client=client, stream=True))
+    assert streamed_async.fetch_stats["stopped_early"] == True
+    assert streamed_async.as_pydantic() == full.as_pydantic()
+
+def test_get_game_info_stale_while_revalidate(fastapi_client: TestClient, route_redis):
+    fake_redis = route_redis
+    
+    response = fastapi_client.get("/api/vgmdb/65091")
+    assert response.headers["X-Cache"] == "miss"
+    assert fake_redis.ttl('game:65091') > 30 * 60
+    response = fastapi_client.get("/api/vgmdb/65091")
+    assert response.headers["X-Cache"] == "fresh"
+    assert album_cache.stats()["hits"] == 1
+    
+    fake_redis.json().set('game:65091', '$.FreshUntil', 0)
+    album_cache.clear()
+    response = fastapi_client.get("/api/vgmdb/65091")
+    assert response.headers["X-Cache"] == "stale"
+    assert response.json()['Title'] == "NieR:Automata Original Soundtrack"
+    # The background refresh has run by the time the test client returns
+    assert fake_redis.json().get('game:65091', '$.FreshUntil')[0] > 0
+    response = fastapi_client.get("/api/vgmdb/65091")
+    assert response.headers["X-Cache"] == "fresh"
+
+def test_negative_cache(vgmapi_obj, fake_redis, monkeypatch):
+    monkeypatch.setattr(vgmdbcrawl, "NEGATIVE_CACHE_MINUTES", 5)
+    vgmapi_obj.fetch_vals_from_webpage("<h1>System Message</h1>")
+    assert vgmapi_obj.not_found == True
+    assert vgmapi_obj.set_cached_vals(fake_redis) == True
+    assert fake_redis.json().get('game:65091', '$.NotFound') == [True]
+    assert 0 < fake_redis.ttl('game:65091') <= 5 * 60
+    
+    cached = VGMDataForVGMAPI(65091)
+    assert cached.get_cached_vals(fake_redis) == True
+    assert cached.not_found == True
+    assert cached.title == "Not Found"
+    
+def test_upstream_errors_not_cached(vgmapi_obj, fake_redis, monkeypatch):
+    
+    def failing_get(*args, **kwargs):
+        raise requests.ConnectionError("vgmdb is down")
+    
+    monkeypatch.setattr(requests, "get", failing_get)
+    vgmapi_obj.fetch_vals_from_webpage()
+    assert vgmapi_obj.fetch_error == True
+    assert vgmapi_obj.set_cached_vals(fake_redis) == False
+    assert fake_redis.exists('game:65091') == 0
+    
+    throttled = VGMDataForVGMAPI(65091)
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: type("Throttled", (), {"status_code": 429, "headers": {}, "content": b"<h1>Slow down</h1>"})())
+    throttled.fetch_vals_from_webpage()
+    assert throttled.fetch_error == True
+    assert throttled.set_cached_vals(fake_redis) == False
+    
+@pytest.mark.parametrize("status_code,cached", [(403, False), (410, False), (404, True)])
+def test_only_404_is_cached_as_not_found(vgmapi_obj, fake_redis, monkeypatch, status_code, cached):
+    response = type("Response", (), {"status_code": status_code, "headers": {}, "content": b"<h1>Access denied</h1>"})()
+    monkeypatch.setattr(requests, "get", lambda *args, **kwargs: response)
+    vgmapi_obj.fetch_vals_from_webpage()
+    assert vgmapi_obj.fetch_error == (not cached)
+    assert vgmapi_obj.set_cached_vals(fake_redis) == cached
+    if cached:
+        assert fake_redis.json().get('game:65091', '$.NotFound') == [True]
+        assert VGMDataForVGMAPI(65091).get_cached_vals(fake_redis) == True
+    else:
+        assert fake_redis.exists('game:65091') == 0
+
+def test_conditional_revalidation(monkeypatch, fake_async_redis):
+    requests_seen = []
+    
+    def etag_handler(request: httpx.Request) -> httpx.Response:
+        requests_seen.append(request)
+        if request.headers.get("If-None-Match") in ('"v1"', '"v2"'):
+            # The validators can change without the page changing
+            return httpx.Response(304, headers={"ETag": '"v2"', "Last-Modified": "Thu, 22 Oct 2015 07:28:00 GMT"})
+        with open('./tests/examples/example-vgmdb-page.html', 'rb') as file:
+            return httpx.Response(200, content=file.read(), headers={"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    
+    monkeypatch.setattr(httpclient, "create_http_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(etag_handler)))
+    
+    async def run():
+        album, source = await vgmdbcrawl.fetch_album_async(65091, fake_async_redis)
+        assert source == "miss"
+        assert await fake_async_redis.json().get('game:65091', '$.ETag') == ['"v1"']
+        await fake_async_redis.json().set('game:65091', '$.FreshUntil', 0)
+        
+        revalidated, source = await vgmdbcrawl.fetch_album_async(65091, fake_async_redis)
+        assert source == "revalidated"
+        assert requests_seen[-1].headers["If-None-Match"] == '"v1"'
+        assert requests_seen[-1].headers["If-Modified-Since"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+        assert revalidated.cache_stale == False
+        assert revalidated.as_pydantic() == album.as_pydantic()
+        assert (await fake_async_redis.json().get('game:65091', '$.FreshUntil'))[0] > 0
+        assert await fake_async_redis.json().get('game:65091', '$.ETag') == ['"v2"']
+        assert await fake_async_redis.json().get('game:65091', '$.LastModified') == ["Thu, 22 Oct 2015 07:28:00 GMT"]
+        
+        await fake_async_redis.json().set('game:65091', '$.FreshUntil', 0)
+        await vgmdbcrawl.fetch_album_async(65091, fake_async_redis)
+        assert requests_seen[-1].headers["If-None-Match"] == '"v2"'
+        assert requests_seen[-1].headers["If-Modified-Since"] == "Thu, 22 Oct 2015 07:28:00 GMT"
+        
+    asyncio.run(run())
+    assert len(requests_seen) == 3
+
+def test_fetch_album_sources(fake_async_redis):
+    
+    async def run():
+        assert (await vgmdbcrawl.fetch_album_async(65091))[1] == "bypass"
+        assert (await vgmdbcrawl.fetch_album_async(65091, fake_async_redis))[1] == "miss"
+        await fake_async_redis.json().set('game:65091', '$.FreshUntil', 0)
+        for _ in range(vgmdbcrawl.vgmdb_breaker.min_calls):
+            vgmdbcrawl.vgmdb_breaker.record_failure()
+        # The cache-only fallback while the circuit is open
+        album, source = await vgmdbcrawl.fetch_album_async(65091, fake_async_redis)
+        assert source == "stale"
+        assert album.title == "NieR:Automata Original Soundtrack"
+        
+    asyncio.run(run())
+
+def test_get_game_info_batch(fastapi_client: TestClient, route_redis, monkeypatch):
+    fastapi_client.get("/api/vgmdb/65091")
+    album_cache.clear()
+    original_fetch = vgmdbcrawl.fetch_album_async
+    
+    async def failing_fetch(catalog, *args, **kwargs):
+        if catalog == "broken":
+            raise ValueError("Parser failure")
+        return await original_fetch(catalog, *args, **kwargs)
+    
+    monkeypatch.setattr(vgmdbcrawl, "fetch_album_async", failing_fetch)
+    response = fastapi_client.post("/api/vgmdb/batch", json={"catalogs": ["65091", "1", "broken", "65091"]})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = {line["catalog"]: line for line in map(json.loads, response.text.splitlines())}
+    assert len(lines) == 3
+    assert lines["65091"]["cache"] == "fresh"
+    assert lines["65091"]["album"]["Title"] == "NieR:Automata Original Soundtrack"
+    assert lines["1"]["cache"] == "miss"
+    assert lines["broken"] == {"catalog": "broken", "error": "Internal error"}
+    
+    response = fastapi_client.post("/api/vgmdb/batch", json={"catalogs": [str(i) for i in range(101)]})
+    assert response.status_code == 422
+
+def test_circuit_open_serves_cache_or_503(fastapi_client: TestClient, route_redis):
+    fake_redis = route_redis
+    assert fastapi_client.get("/api/vgmdb/65091").status_code == 200
+    
+    for _ in range(vgmdbcrawl.vgmdb_breaker.min_calls):
+        vgmdbcrawl.vgmdb_breaker.record_failure()
+    response = fastapi_client.get("/api/vgmdb/65091", params={"nocache":1})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+    
+    fake_redis.json().set('game:65091', '$.FreshUntil', 0)
+    album_cache.clear()
+    response = fastapi_client.get("/api/vgmdb/65091")
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "stale"
+    assert fake_redis.json().get('game:65091', '$.Title') == ["NieR:Automata Original Soundtrack"]
+    assert vgmdbcrawl.vgmdb_breaker.stats()["rejected"] >= 2
+
+def test_cached_response_body(fastapi_client: TestClient, route_redis, monkeypatch):
+    fake_redis = route_redis
+    expected = fastapi_client.get("/api/vgmdb/65091").json()
+    assert json.loads(fake_redis.get('body:game:65091')) == expected
+    assert fake_redis.ttl('body:game:65091') == fake_redis.ttl('game:65091')
+    
+    def no_models(*args, **kwargs):
+        raise AssertionError("cache hits should not build the response model")
+    
+    as_pydantic = VGMDataForVGMAPI.as_pydantic
+    monkeypatch.setattr(VGMDataForVGMAPI, "as_pydantic", no_models)
+    album_cache.clear()
+    for cache in ("fresh", "fresh"): # from redis, then from L1
+        response = fastapi_client.get("/api/vgmdb/65091")
+        assert response.headers["X-Cache"] == cache
+        assert response.json() == expected
+    assert album_cache.stats()["hits"] == 1
+    
+    # Batch lines splice the stored body in too
+    album_cache.clear()
+    line, = map(json.loads, fastapi_client.post("/api/vgmdb/batch", json={"catalogs": ["65091"]}).text.splitlines())
+    assert line["cache"] == "fresh"
+    assert line["album"] == expected
+    
+    # An entry without a body is built from its cached values
+    monkeypatch.setattr(VGMDataForVGMAPI, "as_pydantic", as_pydantic)
+    fake_redis.delete('body:game:65091')
+    album_cache.clear()
+    line, = map(json.loads, fastapi_client.post("/api/vgmdb/batch", json={"catalogs": ["65091"]}).text.splitlines())
+    assert line["cache"] == "fresh"
+    assert line["album"] == expected
+
+def test_cache_write_is_one_round_trip(vgmapi_obj, fake_redis, monkeypatch):
+    commands = []
+    original = fakeredis.FakeRedis.execute_command
+    monkeypatch.setattr(fakeredis.FakeRedis, "execute_command", lambda self, *args, **kwargs: commands.append(args[0]) or original(self, *args, **kwargs))
+    vgmapi_obj.fetch_vals_from_webpage()
+    assert vgmapi_obj.set_cached_vals(fake_redis) == True
+    assert vgmapi_obj.extend_cached_vals(fake_redis) == True
+    # Everything went through the MULTI pipelines, nothing was sent on its own
+    assert commands == []
+    assert fake_redis.ttl('game:65091') > 0
+    assert fake_redis.ttl('body:game:65091') == fake_redis.ttl('game:65091')
+
+def test_read_cached_albums(vgmapi_obj, fake_redis):
+    vgmapi_obj.fetch_vals_from_webpage()
+    vgmapi_obj.set_cached_vals(fake_redis)
+    cached, missing = vgmdbcrawl.read_cached_albums(fake_redis, ["65091", "1"])
+    assert cached["Title"] == "NieR:Automata Original Soundtrack"
+    assert missing is None
+
+def test_check_cache_format(monkeypatch):
+    vgmdbcrawl.check_cache_format("json")
+    with pytest.raises(RuntimeError):
+        vgmdbcrawl.check_cache_format("pickle")
+    # A None entry makes the import fail like a missing package
+    monkeypatch.setitem(sys.modules, "msgpack", None)
+    with pytest.raises(RuntimeError):
+        vgmdbcrawl.check_cache_format("msgpack")
+
+def test_msgpack_cache_format(vgmapi_obj, fake_redis, fake_async_redis, monkeypatch):
+    pytest.importorskip("msgpack")
+    monkeypatch.setattr(vgmdbcrawl, "CACHE_FORMAT", "msgpack")
+    vgmapi_obj.fetch_vals_from_webpage()
+    assert vgmapi_obj.set_cached_vals(fake_redis) == True
+    assert fake_redis.type('game:65091') == b"hash"
+    assert fake_redis.exists('body:game:65091') == 0
+    
+    cached = VGMDataForVGMAPI(65091)
+    assert cached.get_cached_vals(fake_redis) == True
+    assert cached.as_pydantic() == vgmapi_obj.as_pydantic()
+    assert cached.extend_cached_vals(fake_redis, timelimit=60, validators={"ETag": '"v2"', "LastModified": None}) == True
+    extended = VGMDataForVGMAPI(65091)
+    assert extended.get_cached_vals(fake_redis) == True
+    assert extended.etag == '"v2"'
+    assert extended.last_modified == vgmapi_obj.last_modified
+    
+    async def run():
+        assert await vgmapi_obj.set_cached_vals_async(fake_async_redis) == True
+        body, fresh_until = await vgmdbcrawl.get_response_body_async(fake_async_redis, "65091")
+        assert json.loads(body)["Title"] == "NieR:Automata Original Soundtrack"
+        assert fresh_until > 0
+        assert await vgmdbcrawl.read_cached_albums_async(fake_async_redis, ["1"]) == [None]
+    
+    asyncio.run(run())